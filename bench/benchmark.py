@@ -0,0 +1,309 @@
+"""Load test of the HTTP API
+
+Starts src/app.py against the given PostgreSQL and Redis (or targets a running server with --url),
+seeds users and replays, then drives a weighted mix of login, submit, score/get and leaderboard requests
+for a fixed time. Reports throughput and latency percentiles per route, saves them as json,
+and compares them with an earlier run given as the baseline. No baseline ships with the repository,
+numbers only compare on one machine, so the first run on a machine saves it.
+
+    python bench/benchmark.py --postgres postgresql://... --redis redis://... --save baseline.json
+    python bench/benchmark.py --postgres postgresql://... --redis redis://... --baseline baseline.json
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import shlex
+import subprocess
+import sys
+import time
+from typing import Any, Optional
+
+import aiohttp
+import asyncpg
+from argon2 import PasswordHasher
+
+routes = ('login', 'submit', 'get', 'leaderboard')
+srcDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+password = 'benchmark-password'
+
+
+def parse_args(argv: list[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog='benchmark', description="Load test of the Score API Server. ")
+    parser.add_argument('--postgres', help='Connection URL for PostgreSQL, seeded with the benchmark users', required=True)
+    parser.add_argument('--redis', help='Connection URL for Redis, used by the started server', default=None)
+    parser.add_argument('--url', help='Benchmark a running server instead of starting one', default=None)
+    parser.add_argument('--port', help='Port of the started server', type=int, default=8090)
+    # Every request comes from one address, the per-client limits would measure themselves
+    parser.add_argument('--server-args', help='More arguments for the started server, e.g. "--workers 4"', default='--rate-limit-scale 0')
+    parser.add_argument('--game', help='Game the replays are submitted to', default='default_game')
+    parser.add_argument('--users', help='Benchmark users, each logs in once before the run', type=int, default=50)
+    parser.add_argument('--replays', help='Replays seeded per user', type=int, default=20)
+    parser.add_argument('--levels', help='Levels the replays are spread over', type=int, default=10)
+    parser.add_argument('--replay-events', help='Events per replay', type=int, default=500)
+    parser.add_argument('--duration', help='Seconds of measured load', type=float, default=30.0)
+    parser.add_argument('--warmup', help='Seconds of load before measuring', type=float, default=5.0)
+    parser.add_argument('--concurrency', help='Requests kept in flight', type=int, default=32)
+    parser.add_argument('--mix', help='Weight of each route', default='login=1,submit=4,get=10,leaderboard=5')
+    parser.add_argument('--seed', help='Seed of the request mix and replay contents', type=int, default=1)
+    parser.add_argument('--save', help='Write the results to this json file', default=None)
+    parser.add_argument('--baseline', help='Compare with the results of an earlier run', default=None)
+    parser.add_argument('--max-regression', help='Exit with 1 when a p99 grows by more than this percentage over the baseline', type=float, default=None)
+    args = parser.parse_args(argv)
+
+    weights: dict[str, float] = {}
+    for entry in args.mix.split(','):
+        route, _, weight = entry.partition('=')
+        if route.strip() not in routes:
+            parser.error(f"unknown route in --mix: {route}")
+        weights[route.strip()] = float(weight)
+    args.weights = weights
+    return args
+
+
+class Recorder:
+    """Latencies and status codes of every request, per route
+    """
+
+    def __init__(self):
+        self.latencies: dict[str, list[float]] = {route: [] for route in routes}
+        self.statuses: dict[str, dict[int, int]] = {route: {} for route in routes}
+        self.recording = False
+
+    def record(self, route: str, status: int, latency: float):
+        if not self.recording:
+            return
+        self.latencies[route].append(latency)
+        self.statuses[route][status] = self.statuses[route].get(status, 0) + 1
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    # Nearest rank, values sorted
+    return values[min(len(values) - 1, max(0, math.ceil(fraction * len(values)) - 1))]
+
+def makeReplay(rng: random.Random, uid: int, nickname: str, levels: int, events: int, nonce: int) -> dict[str, Any]:
+    duration = rng.randint(1000, 600000)
+    return {
+        "player": {"uid": uid, "nickname": nickname},
+        "info": {"level_id": rng.randint(1, levels), "score": rng.randint(0, 10 ** 6), "time": duration},
+        # The nonce keeps replays of every run distinct, so submissions are stored rather than refused as duplicates
+        "replay": [{"t": i * duration // max(events, 1), "k": rng.choice('udlrab'), "n": nonce} for i in range(events)]
+    }
+
+
+class Benchmark:
+    def __init__(self, args: argparse.Namespace, base: str):
+        self.args = args
+        self.base = base
+        self.rng = random.Random(args.seed)
+        self.recorder = Recorder()
+        self.nonce = time.time_ns()
+        self.users: list[dict[str, Any]] = []
+        self.replayUids: list[int] = []
+
+    async def seedUsers(self):
+        """Create the benchmark users straight in the database, all with one password hash
+
+        Users of an earlier run with the same seed are reused, usernames aren't unique in the users table.
+        """
+        passwordHash = PasswordHasher().hash(password)
+        conn = await asyncpg.connect(self.args.postgres)
+        try:
+            for index in range(self.args.users):
+                name = f'bench{self.args.seed}u{index}'
+                await conn.execute('''
+                    INSERT INTO users(username, display_name, email, password_hash, status)
+                    SELECT $1, $1, $1 || '@bench.invalid', $2, 'active'
+                    WHERE NOT EXISTS (SELECT 1 FROM users WHERE username = $1)
+                ''', name, passwordHash)
+                uid = await conn.fetchval('SELECT uid FROM users WHERE username = $1', name)
+                self.users.append({"uid": uid, "name": name, "token": None})
+        finally:
+            await conn.close()
+
+    async def login(self, session: aiohttp.ClientSession, user: dict[str, Any]) -> int:
+        async with session.post(self.base + '/auth/client/login', json={"username": user['name'], "password": password}) as response:
+            body = await response.json()
+            if response.status == 200:
+                user['token'] = body['token']
+            return response.status
+
+    async def seedReplays(self, session: aiohttp.ClientSession):
+        for user in self.users:
+            if await self.login(session, user) != 200:
+                raise RuntimeError(f"Login of {user['name']} failed")
+            replays = [
+                makeReplay(self.rng, user['uid'], user['name'], self.args.levels, self.args.replay_events, self.nonce + index)
+                for index in range(self.args.replays)
+            ]
+            # Batches of the submission limit
+            for start in range(0, len(replays), 100):
+                async with session.post(
+                    self.base + f'/client/{self.args.game}/score/submit/batch',
+                    json={"replays": replays[start:start + 100]},
+                    headers={"Authorization": f"Bearer {user['token']}"}
+                ) as response:
+                    body = await response.json()
+                    if response.status != 200:
+                        raise RuntimeError(f"Seeding replays failed: {body}")
+                    self.replayUids += [result['replay_uid'] for result in body['results'] if 'replay_uid' in result]
+
+    async def request(self, session: aiohttp.ClientSession, route: str):
+        user = self.rng.choice(self.users)
+        headers = {"Authorization": f"Bearer {user['token']}"}
+        start = time.perf_counter()
+        if route == 'login':
+            status = await self.login(session, user)
+        elif route == 'submit':
+            self.nonce += 1
+            replay = makeReplay(self.rng, user['uid'], user['name'], self.args.levels, self.args.replay_events, self.nonce)
+            async with session.post(
+                self.base + f'/client/{self.args.game}/score/submit', json={"replay": json.dumps(replay)}, headers=headers
+            ) as response:
+                await response.read()
+                status = response.status
+        elif route == 'get':
+            async with session.get(
+                self.base + f'/client/{self.args.game}/score/get', params={"uid": self.rng.choice(self.replayUids)}, headers=headers
+            ) as response:
+                await response.read()
+                status = response.status
+        else:
+            async with session.get(
+                self.base + f'/client/{self.args.game}/score/leaderboard', params={"level": self.rng.randint(1, self.args.levels)}, headers=headers
+            ) as response:
+                await response.read()
+                status = response.status
+        self.recorder.record(route, status, time.perf_counter() - start)
+
+    async def worker(self, session: aiohttp.ClientSession, until: float):
+        names = list(self.args.weights)
+        weights = [self.args.weights[name] for name in names]
+        while time.monotonic() < until:
+            route = self.rng.choices(names, weights)[0]
+            try:
+                await self.request(session, route)
+            except aiohttp.ClientError:
+                self.recorder.record(route, 0, 0.0)
+
+    async def run(self) -> dict[str, Any]:
+        await self.seedUsers()
+        connector = aiohttp.TCPConnector(limit=self.args.concurrency)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            await self.seedReplays(session)
+            if self.args.warmup > 0:
+                until = time.monotonic() + self.args.warmup
+                await asyncio.gather(*[self.worker(session, until) for _ in range(self.args.concurrency)])
+            self.recorder.recording = True
+            started = time.monotonic()
+            until = started + self.args.duration
+            await asyncio.gather(*[self.worker(session, until) for _ in range(self.args.concurrency)])
+            elapsed = time.monotonic() - started
+        return self.results(elapsed)
+
+    def results(self, elapsed: float) -> dict[str, Any]:
+        report: dict[str, Any] = {}
+        for route in routes:
+            latencies = sorted(self.recorder.latencies[route])
+            if not latencies:
+                continue
+            statuses = self.recorder.statuses[route]
+            report[route] = {
+                "requests": len(latencies),
+                "throughput": len(latencies) / elapsed,
+                "errors": sum(count for status, count in statuses.items() if status == 0 or status >= 500),
+                "statuses": {str(status): count for status, count in sorted(statuses.items())},
+                "p50_ms": percentile(latencies, 0.5) * 1000,
+                "p99_ms": percentile(latencies, 0.99) * 1000,
+                "p999_ms": percentile(latencies, 0.999) * 1000
+            }
+        total = sum(route['requests'] for route in report.values())
+        return {
+            "settings": {key: value for key, value in vars(self.args).items() if key not in ('postgres', 'redis', 'save', 'baseline')},
+            "host": {"python": platform.python_version(), "machine": platform.machine(), "cpus": os.cpu_count()},
+            "elapsed": elapsed,
+            "throughput": total / elapsed,
+            "routes": report
+        }
+
+
+def startServer(args: argparse.Namespace) -> subprocess.Popen:
+    command = [sys.executable, 'app.py', '--port', str(args.port), '--postgres', args.postgres]
+    if args.redis:
+        command += ['--redis', args.redis]
+    command += shlex.split(args.server_args)
+    return subprocess.Popen(command, cwd=srcDir, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+async def waitReady(base: str, server: Optional[subprocess.Popen], timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            if server is not None and server.poll() is not None:
+                raise RuntimeError(f"Server exited: {server.stderr.read().decode()}")
+            try:
+                async with session.get(base + '/') as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError("Server didn't start in time")
+
+def printReport(results: dict[str, Any], baseline: Optional[dict[str, Any]]) -> list[str]:
+    """Print the results next to the baseline
+
+    Returns:
+        list[str]: routes whose p99 grew past --max-regression
+    """
+    regressions: list[str] = []
+    limit = results['settings'].get('max_regression')
+    print(f"{'route':<12}{'requests':>10}{'req/s':>10}{'errors':>8}{'p50 ms':>10}{'p99 ms':>10}{'p99.9 ms':>10}")
+    for route, stats in results['routes'].items():
+        print(
+            f"{route:<12}{stats['requests']:>10}{stats['throughput']:>10.1f}{stats['errors']:>8}"
+            f"{stats['p50_ms']:>10.2f}{stats['p99_ms']:>10.2f}{stats['p999_ms']:>10.2f}"
+        )
+        if baseline is None or (before := baseline['routes'].get(route)) is None:
+            continue
+        change = lambda key: (stats[key] - before[key]) / before[key] * 100 if before[key] else 0.0
+        print(
+            f"{'  vs base':<12}{'':>10}{change('throughput'):>+9.1f}%{'':>8}"
+            f"{change('p50_ms'):>+9.1f}%{change('p99_ms'):>+9.1f}%{change('p999_ms'):>+9.1f}%"
+        )
+        if limit is not None and change('p99_ms') > limit:
+            regressions.append(route)
+    print(f"total {results['throughput']:.1f} req/s over {results['elapsed']:.1f}s")
+    return regressions
+
+async def main(argv: list[str]) -> int:
+    args = parse_args(argv)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    server = None
+    base = args.url.rstrip('/') if args.url else f'http://127.0.0.1:{args.port}'
+    if not args.url:
+        server = startServer(args)
+    try:
+        await waitReady(base, server)
+        results = await Benchmark(args, base).run()
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    regressions = printReport(results, baseline)
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(results, file, indent=2)
+    if regressions:
+        print(f"p99 regressed past {args.max_regression}% on {', '.join(regressions)}")
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main(sys.argv[1:])))
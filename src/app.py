@@ -1,16 +1,41 @@
+import logging
+import shutil
 import sys
+import tempfile
+from typing import Any
+
 from aiohttp import web
 
-from server import server, setup
+from server import codec, metrics, preprocess, server, setup, workers
 
-if __name__ == '__main__':
-    app = web.Application()
 
-    app[setup.config_key] = setup.parse_config(sys.argv)
+def create_app(config: dict[str, Any]) -> web.Application:
+    app = web.Application(middlewares=[metrics.middleware, preprocess.admission])
+
+    app[setup.config_key] = config
+    codec.use(config['json_codec'])
 
+    app.cleanup_ctx.append(setup.init_hasher)
     app.cleanup_ctx.append(setup.init_database)
     app.cleanup_ctx.append(setup.init_cache)
+    app.cleanup_ctx.append(setup.init_submissions)
 
     app.add_routes(server.routes)
 
-    web.run_app(app)
+    return app
+
+if __name__ == '__main__':
+    config = setup.parse_config(sys.argv)
+
+    if config['workers'] > 1:
+        logging.basicConfig(level=logging.INFO)
+        # Workers count into files of a shared directory, so /metrics of any worker covers all of them
+        directory = config['metrics_dir'] or tempfile.mkdtemp(prefix='score-metrics-')
+        metrics.useDirectory(directory)
+        try:
+            workers.run(create_app, config)
+        finally:
+            if not config['metrics_dir']:
+                shutil.rmtree(directory, ignore_errors=True)
+    else:
+        web.run_app(create_app(config), host=config['host'], port=config['port'], handler_cancellation=True)
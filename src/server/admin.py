@@ -1,14 +1,154 @@
+import argparse
+import asyncio
 import os
+import sys
+from typing import Any
 
+import asyncpg
+import redis.asyncio as aioredis
+
+from . import migrations, partitioning, storage
 from .database import PostgresDB
+from .ranking import Rankings
+
 
+def connection_info() -> dict[str, Any]:
+    return {
+        "host": os.getenv("POSTGRES_HOST", "127.0.0.1"),
+        "port": os.getenv("POSTGRES_PORT", 5432),
+        "user": os.getenv("POSTGRES_USER", "score-server"),
+        "password": os.getenv("POSTGRES_PASS", "password"),
+        "database": os.getenv("POSTGRES_DB", "scores")
+    }
 
 async def prepare():
     global db
-    db = await PostgresDB(
-        host=os.getenv("POSTGRES_HOST", "127.0.0.1"), 
-        port=os.getenv("POSTGRES_PORT", 5432), 
-        user=os.getenv("POSTGRES_USER", "score-server"),
-        password=os.getenv("POSTGRES_PASS", "password"), 
-        database=os.getenv("POSTGRES_DB", "scores")
-    )
+    db = await PostgresDB(**connection_info(), min_size=1)
+
+async def prepare_cache():
+    global cache
+    cache = await aioredis.from_url(os.getenv("REDIS_URL", "redis://127.0.0.1"))
+
+async def rebuild_rankings(games: list[str]):
+    rankings = Rankings(cache)
+    for game in games or [game['name'] for game in await db.fetchPrepared('fetchGames')]:
+        levels = await rankings.rebuild(game, db.fetchLevelBests(game))
+        print(f"{game}: rebuilt rankings of {levels} levels")
+
+async def create_game(name: str, display_name: str, partition_by: str | None, partitions: int):
+    await db.createGame(name, display_name, partition_by, partitions)
+    print(f"{name}: created")
+
+async def partition_game(game: str, layout: str, partitions: int):
+    # Runs on its own connection, the copy takes a while on large tables and never holds a lock until the swap
+    conn: asyncpg.Connection = await asyncpg.connect(**connection_info())
+    try:
+        copied = await partitioning.partitionGame(conn, game, layout, partitions)
+        print(f"{game}: partitioned by {layout}, copied {copied} replays. Drop game_{game}_unpartitioned once satisfied")
+    finally:
+        await conn.close()
+
+async def partition_months(games: list[str]):
+    conn: asyncpg.Connection = await asyncpg.connect(**connection_info())
+    try:
+        for game in games or [game['name'] for game in await conn.fetch('SELECT name FROM games')]:
+            if await partitioning.layoutOf(conn, f'game_{game}') != 'month':
+                continue
+            created = await partitioning.ensureMonths(conn, f'game_{game}')
+            print(f"{game}: {', '.join(created) if created else 'up to date'}")
+            if released := await partitioning.releaseDigests(conn, game):
+                print(f"{game}: released {released} digests of dropped replays")
+    finally:
+        await conn.close()
+
+async def rebuild_best(games: list[str]):
+    async with db.acquire() as conn:
+        for game in games or [game['name'] for game in await conn.fetch('SELECT name FROM games')]:
+            await migrations.rebuildBestTable(conn, game)
+            players = await conn.fetchval(f'SELECT count(*) FROM game_{game}_best')
+            print(f"{game}: rebuilt {players} player bests")
+
+async def train_dictionaries(games: list[str]):
+    # Replays stored before keep their dictionary, servers compress with the new one after a restart
+    for game in games or [game['name'] for game in await db.fetchPrepared('fetchGames')]:
+        async with db.acquire() as conn:
+            rows = await conn.fetch(f'''
+                SELECT replay_header, replay_events FROM game_{game} ORDER BY random() LIMIT $1
+            ''', storage.dictionaryMaxSamples)
+            samples = [replay.eventsEncoded() for replay in await db.storedReplays(rows)]
+            uid = await migrations.trainDictionary(conn, game, samples)
+        if uid is None:
+            print(f"{game}: {len(samples)} replays, need {storage.dictionaryMinSamples} to train a dictionary")
+        else:
+            print(f"{game}: trained dictionary {uid} on {len(samples)} replays")
+
+async def migrate(games: list[str]):
+    # Runs on its own connection, the server can't prepare its statements until this is done
+    conn: asyncpg.Connection = await asyncpg.connect(**connection_info())
+    try:
+        for game in games or [game['name'] for game in await conn.fetch('SELECT name FROM games')]:
+            applied = await migrations.migrateGame(conn, game)
+            print(f"{game}: {', '.join(applied) if applied else 'up to date'}")
+    finally:
+        await conn.close()
+
+async def main(argv: list[str]):
+    parser = argparse.ArgumentParser(prog='python -m server.admin', description="Score Server maintenance commands. ")
+    commands = parser.add_subparsers(dest='command', required=True)
+    migrate_parser = commands.add_parser('migrate', help='Apply pending schema migrations to the game tables')
+    migrate_parser.add_argument('games', nargs='*', help='games to migrate, all games when omitted')
+    rebuild_parser = commands.add_parser('rebuild-rankings', help='Rebuild the Redis rankings from the game tables')
+    rebuild_parser.add_argument('games', nargs='*', help='games to rebuild, all games when omitted')
+    best_parser = commands.add_parser('rebuild-best', help='Rebuild the best replay of each player from the game tables')
+    best_parser.add_argument('games', nargs='*', help='games to rebuild, all games when omitted')
+    create_parser = commands.add_parser('create-game', help='Create the table of a new game')
+    create_parser.add_argument('name', help='game name, used in the urls')
+    create_parser.add_argument('display_name', help='name shown to players')
+    create_parser.add_argument('--partition-by', choices=partitioning.layouts, help='partition the table by level_id hash or submission month')
+    create_parser.add_argument('--partitions', type=int, default=partitioning.hashPartitions, help='hash partitions when partitioned by level')
+    partition_parser = commands.add_parser('partition', help='Move a game table into a partitioned one, without stopping the servers')
+    partition_parser.add_argument('game', help='game to partition')
+    partition_parser.add_argument('--by', choices=partitioning.layouts, required=True, help='partition by level_id hash or submission month')
+    partition_parser.add_argument('--partitions', type=int, default=partitioning.hashPartitions, help='hash partitions when partitioned by level')
+    months_parser = commands.add_parser('partition-months', help='Create the coming month partitions of month partitioned games and release the digests of dropped ones')
+    months_parser.add_argument('games', nargs='*', help='games to partition, all games when omitted')
+    train_parser = commands.add_parser('train-dictionary', help='Train a new zstd dictionary on the stored replays')
+    train_parser.add_argument('games', nargs='*', help='games to train, all games when omitted')
+    args = parser.parse_args(argv)
+
+    match args.command:
+        case 'migrate':
+            await migrate(args.games)
+        case 'rebuild-rankings':
+            await prepare()
+            await prepare_cache()
+            try:
+                await rebuild_rankings(args.games)
+            finally:
+                await cache.aclose()
+                await db.close()
+        case 'create-game':
+            await prepare()
+            try:
+                await create_game(args.name, args.display_name, args.partition_by, args.partitions)
+            finally:
+                await db.close()
+        case 'partition':
+            await partition_game(args.game, args.by, args.partitions)
+        case 'partition-months':
+            await partition_months(args.games)
+        case 'rebuild-best':
+            await prepare()
+            try:
+                await rebuild_best(args.games)
+            finally:
+                await db.close()
+        case 'train-dictionary':
+            await prepare()
+            try:
+                await train_dictionaries(args.games)
+            finally:
+                await db.close()
+
+if __name__ == '__main__':
+    asyncio.run(main(sys.argv[1:]))
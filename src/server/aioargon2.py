@@ -1,20 +1,172 @@
 import asyncio
 import concurrent.futures
-from typing import Literal
+import contextlib
+import functools
+import os
+import time
+from typing import Any, Callable, Literal, Optional
 
 from argon2 import PasswordHasher
 
-HasherProcessPool = concurrent.futures.ProcessPoolExecutor()
+from . import deadlines, metrics
+
 Hasher = PasswordHasher()
 
+
+class HasherBusyError(Exception):
+    """Raised when the hashing queue can't take more work
+    """
+
+
+def timedCall(func: Callable[..., Any], *args: Any) -> tuple[float, float, Any, Optional[Exception]]:
+    """Run in the hashing process, report when the call started and ended on the shared monotonic clock
+    """
+    start = time.monotonic()
+    try:
+        result, error = func(*args), None
+    except Exception as e:
+        result, error = None, e
+    return start, time.monotonic(), result, error
+
+
+class OperationStats:
+    def __init__(self):
+        self.count: int = 0
+        self.waitTotal: float = 0.0
+        self.execTotal: float = 0.0
+        self.latencyMax: float = 0.0
+
+    def record(self, wait: float, execution: float):
+        self.count += 1
+        self.waitTotal += wait
+        self.execTotal += execution
+        self.latencyMax = max(self.latencyMax, wait + execution)
+
+    def to_json(self) -> dict[str, float]:
+        return {
+            "count": self.count,
+            "wait_avg": self.waitTotal / self.count if self.count else 0.0,
+            "exec_avg": self.execTotal / self.count if self.count else 0.0,
+            "latency_max": self.latencyMax
+        }
+
+
+class HasherPool:
+    """Fixed size argon2 process pool with a bounded queue
+
+    Work is refused with HasherBusyError when the queue is full,
+    or when the queue is expected to take longer than max_wait, or than the request has left, to drain.
+    Work still queued when the request deadline passes is dropped.
+    Processes are started on first use.
+    """
+
+    def __init__(self, workers: int, queue_size: int, max_wait: float):
+        self.workers = workers
+        self.queueSize = queue_size
+        self.maxWait = max_wait
+        self.executor: Optional[concurrent.futures.ProcessPoolExecutor] = None
+        self.pending: int = 0
+        self.rejected: int = 0
+        # Moving average of one hash / verify execution time
+        self.execAverage: Optional[float] = None
+        self.stats: dict[str, OperationStats] = {}
+
+    def queued(self) -> int:
+        return max(0, self.pending - self.workers)
+
+    def admit(self, remaining: Optional[float]):
+        queued = self.queued()
+        maxWait = self.maxWait if remaining is None else min(self.maxWait, remaining)
+        if queued >= self.queueSize or (
+            self.execAverage is not None and (queued + 1) * self.execAverage / self.workers > maxWait
+        ):
+            self.rejected += 1
+            metrics.hasherRejected.inc()
+            raise HasherBusyError()
+
+    async def run(self, operation: str, func: Callable[..., Any], *args: Any) -> Any:
+        remaining = deadlines.remaining()
+        self.admit(remaining)
+        if self.executor is None:
+            self.executor = concurrent.futures.ProcessPoolExecutor(self.workers)
+        self.pending += 1
+        submitted = time.monotonic()
+        loop = asyncio.get_running_loop()
+        future = self.executor.submit(timedCall, func, *args)
+        # Runs once the call really ended or was dropped before starting, from the executor thread
+        future.add_done_callback(functools.partial(self.finishedThreadsafe, loop))
+        # Cancelling drops the call when no process picked it up yet, a running call completes unobserved but still counted
+        start, end, result, error = await asyncio.wait_for(asyncio.wrap_future(future, loop=loop), remaining)
+        execution = end - start
+        wait = max(0.0, start - submitted)
+        self.stats.setdefault(operation, OperationStats()).record(wait, execution)
+        metrics.hasherWaitSeconds.labels(operation).observe(wait)
+        metrics.hasherSeconds.labels(operation).observe(execution)
+        if error is not None:
+            raise error
+        return result
+
+    def finishedThreadsafe(self, loop: asyncio.AbstractEventLoop, future: concurrent.futures.Future):
+        with contextlib.suppress(RuntimeError):
+            # The loop closed first, the pool goes with it
+            loop.call_soon_threadsafe(self.finished, future)
+
+    def finished(self, future: concurrent.futures.Future):
+        self.pending -= 1
+        if future.cancelled() or future.exception() is not None:
+            return
+        start, end, _, _ = future.result()
+        execution = end - start
+        self.execAverage = execution if self.execAverage is None else self.execAverage * 0.8 + execution * 0.2
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def metrics(self) -> dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "started": self.executor is not None,
+            "pending": self.pending,
+            "queued": self.queued(),
+            "queue_size": self.queueSize,
+            "rejected": self.rejected,
+            "operations": {operation: stats.to_json() for operation, stats in self.stats.items()}
+        }
+
+
+HasherProcessPool: Optional[HasherPool] = None
+
+def configure(workers: Optional[int] = None, queue_size: int = 64, max_wait: float = 2.0):
+    """Replace the hashing pool of this process
+
+    Args:
+        workers (Optional[int], optional): hashing processes. Defaults to the number of CPUs.
+        queue_size (int, optional): calls allowed to wait for a process. Defaults to 64.
+        max_wait (float, optional): longest expected queue wait in seconds before refusing work. Defaults to 2.0.
+    """
+    global HasherProcessPool
+    shutdown()
+    HasherProcessPool = HasherPool(workers or os.cpu_count() or 1, queue_size, max_wait)
+
+def shutdown():
+    global HasherProcessPool
+    if HasherProcessPool is not None:
+        HasherProcessPool.shutdown()
+        HasherProcessPool = None
+
+def pool() -> HasherPool:
+    if HasherProcessPool is None:
+        configure()
+    return HasherProcessPool
+
 async def hash(password: str | bytes) -> str:
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(HasherProcessPool, Hasher.hash, password)
+    return await pool().run('hash', Hasher.hash, password)
 
 async def verify(hash: str, password: str | bytes) -> Literal[True]:
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(HasherProcessPool, Hasher.verify, hash, password)
+    return await pool().run('verify', Hasher.verify, hash, password)
 
-async def check_needs_rehash(hash: str) -> bool:
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(HasherProcessPool, Hasher.check_needs_rehash, hash)
+def check_needs_rehash(hash: str) -> bool:
+    # Only parses the parameters out of the hash, not worth a process round trip
+    return Hasher.check_needs_rehash(hash)
@@ -0,0 +1,388 @@
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Generic, Mapping, Optional, TypeVar
+
+import redis.asyncio as aioredis
+
+from . import metrics
+
+K = TypeVar("K")
+V = TypeVar("V")
+
+# Loader result: serialized response body and time of the last entry on a full board
+LeaderboardLoader = Callable[[], Awaitable[Optional[tuple[bytes, Optional[int]]]]]
+
+# Only store if no submission invalidated the board since the loader started
+STORE_SCRIPT = '''
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'body:' .. ARGV[2], ARGV[3], 'etag:' .. ARGV[2], ARGV[4], 'cutoff', ARGV[5])
+redis.call('EXPIRE', KEYS[1], ARGV[6])
+return 1
+'''
+
+# Drop the board when the submitted time would make it into the cached top entries
+INVALIDATE_SCRIPT = '''
+local cutoff = redis.call('HGET', KEYS[1], 'cutoff')
+if cutoff == false then
+    redis.call('INCR', KEYS[2])
+    return 0
+end
+if cutoff == '' or tonumber(ARGV[1]) <= tonumber(cutoff) then
+    redis.call('DEL', KEYS[1])
+    redis.call('INCR', KEYS[2])
+    return 1
+end
+return 0
+'''
+
+
+def entityTag(body: bytes) -> str:
+    return '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+
+class LeaderboardCache:
+    """### Serialized leaderboard responses in Redis, keyed on (game, level)
+
+    Every view of a board is stored in the same hash, so a submission drops all of them together.
+    """
+
+    def __init__(self, redis: aioredis.Redis, ttl: int):
+        self.redis = redis
+        self.ttl = ttl
+        self.inflight: dict[str, asyncio.Future[Optional[tuple[bytes, str]]]] = {}
+        self.storeScript = redis.register_script(STORE_SCRIPT)
+        self.invalidateScript = redis.register_script(INVALIDATE_SCRIPT)
+        self.hits: int = 0
+        self.misses: int = 0
+        self.coalesced: int = 0
+        self.invalidations: int = 0
+
+    @staticmethod
+    def key(game: str, level: int) -> str:
+        return f'leaderboard:{game}:{level}'
+
+    async def fetch(self, game: str, level: int, loader: LeaderboardLoader, view: str = 'full') -> Optional[tuple[bytes, str]]:
+        """### Get the serialized leaderboard, concurrent misses share one loader call
+
+        Args:
+            game (str): game name
+            level (int): level id
+            loader (LeaderboardLoader): builds the response body on a miss, returns None when not cacheable
+            view (str, optional): variant of the board built by the loader. Defaults to 'full'.
+
+        Returns:
+            Optional[tuple[bytes, str]]: response body and its ETag, None when the loader refused
+        """
+        key = self.key(game, level)
+        flight = f'{key}:{view}'
+        if (pending := self.inflight.get(flight)) is None:
+            body, etag = await self.redis.hmget(key, f'body:{view}', f'etag:{view}')
+            if body is not None and etag is not None:
+                self.hits += 1
+                metrics.cacheLookups.labels('leaderboard', 'hit').inc()
+                return body, etag.decode()
+            pending = self.inflight.get(flight)
+        if pending is not None:
+            self.coalesced += 1
+            metrics.cacheLookups.labels('leaderboard', 'coalesced').inc()
+            return await asyncio.shield(pending)
+
+        self.misses += 1
+        metrics.cacheLookups.labels('leaderboard', 'miss').inc()
+        pending = asyncio.ensure_future(self.load(key, view, loader))
+        self.inflight[flight] = pending
+        pending.add_done_callback(lambda _: self.inflight.pop(flight, None))
+        return await asyncio.shield(pending)
+
+    async def load(self, key: str, view: str, loader: LeaderboardLoader) -> Optional[tuple[bytes, str]]:
+        version = await self.redis.get(f'{key}:version') or b'0'
+        if (loaded := await loader()) is None:
+            return None
+        body, cutoff = loaded
+        etag = entityTag(body)
+        await self.storeScript(
+            keys=[key, f'{key}:version'],
+            args=[version, view, body, etag, '' if cutoff is None else cutoff, self.ttl]
+        )
+        return body, etag
+
+    async def etag(self, game: str, level: int, view: str = 'full') -> Optional[str]:
+        """### ETag of the cached board, without fetching the body
+        """
+        if (etag := await self.redis.hget(self.key(game, level), f'etag:{view}')) is None:
+            return None
+        return etag.decode()
+
+    async def submitted(self, game: str, level: int, time: int) -> bool:
+        """### Invalidate the cached board if a new score lands on it
+
+        Args:
+            game (str): game name
+            level (int): level id of the submitted replay
+            time (int): time of the submitted replay
+
+        Returns:
+            bool: whether the cached board was dropped
+        """
+        key = self.key(game, level)
+        dropped = bool(await self.invalidateScript(keys=[key, f'{key}:version'], args=[time]))
+        self.invalidations += dropped
+        return dropped
+
+    def metrics(self) -> dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "invalidations": self.invalidations
+        }
+
+
+class LocalCache(Generic[K, V]):
+    """### In-process LRU cache whose entries expire after ttl seconds
+    """
+
+    def __init__(self, maxsize: int, ttl: float, on_drop: Optional[Callable[[K, V], None]] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # Called for every entry leaving the cache, expired, evicted or popped
+        self.onDrop = on_drop
+        self.entries: OrderedDict[K, tuple[float, V]] = OrderedDict()
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def get(self, key: K) -> Optional[V]:
+        if (entry := self.entries.get(key)) is None or entry[0] < time.monotonic():
+            self.pop(key)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: K, value: V):
+        self.pop(key)
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        while len(self.entries) > self.maxsize:
+            self.pop(next(iter(self.entries)))
+
+    def pop(self, key: K):
+        if (entry := self.entries.pop(key, None)) is not None and self.onDrop is not None:
+            self.onDrop(key, entry[1])
+
+    def clear(self):
+        for key in list(self.entries):
+            self.pop(key)
+
+    def metrics(self) -> dict[str, int]:
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+class SizedCache:
+    """### In-process LRU cache of byte strings, bounded by their total size
+    """
+
+    def __init__(self, max_bytes: int):
+        self.maxBytes = max_bytes
+        self.entries: OrderedDict[str, bytes] = OrderedDict()
+        self.size: int = 0
+
+    def get(self, key: str) -> Optional[bytes]:
+        if (value := self.entries.get(key)) is not None:
+            self.entries.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: bytes):
+        # One entry may not push out most of the cache
+        if len(value) > self.maxBytes // 8:
+            return
+        self.pop(key)
+        self.entries[key] = value
+        self.size += len(value)
+        while self.size > self.maxBytes:
+            self.pop(next(iter(self.entries)))
+
+    def pop(self, key: str):
+        if (value := self.entries.pop(key, None)) is not None:
+            self.size -= len(value)
+
+
+class ReplayCache:
+    """### Encoded replay responses, in a byte bounded LRU of every worker backed by Redis
+
+    Stored replays never change, entries only leave for space or when their Redis ttl ends.
+    Concurrent misses of a replay in a worker share one Redis lookup and one loader call.
+    """
+
+    def __init__(self, redis: aioredis.Redis, max_bytes: int, ttl: int):
+        self.redis = redis
+        self.ttl = ttl
+        self.local = SizedCache(max_bytes)
+        self.inflight: dict[str, asyncio.Future[Optional[bytes]]] = {}
+        self.hits: int = 0
+        self.remoteHits: int = 0
+        self.misses: int = 0
+        self.coalesced: int = 0
+
+    @staticmethod
+    def key(game: str, uid: int) -> str:
+        return f'replay:{game}:{uid}'
+
+    async def fetch(self, game: str, uid: int, loader: Callable[[], Awaitable[Optional[bytes]]]) -> Optional[bytes]:
+        """### Get the encoded response of a replay
+
+        Args:
+            game (str): game name
+            uid (int): replay uid
+            loader (Callable[[], Awaitable[Optional[bytes]]]): encodes the response on a miss, None when there is no such replay
+
+        Returns:
+            Optional[bytes]: response body, None when the loader found nothing, which isn't cached
+        """
+        key = self.key(game, uid)
+        if (body := self.local.get(key)) is not None:
+            self.hits += 1
+            metrics.cacheLookups.labels('replays', 'hit').inc()
+            return body
+        if (pending := self.inflight.get(key)) is not None:
+            self.coalesced += 1
+            metrics.cacheLookups.labels('replays', 'coalesced').inc()
+            return await asyncio.shield(pending)
+
+        pending = asyncio.ensure_future(self.load(key, loader))
+        self.inflight[key] = pending
+        pending.add_done_callback(lambda _: self.inflight.pop(key, None))
+        return await asyncio.shield(pending)
+
+    async def load(self, key: str, loader: Callable[[], Awaitable[Optional[bytes]]]) -> Optional[bytes]:
+        if (body := await self.redis.get(key)) is not None:
+            self.remoteHits += 1
+            metrics.cacheLookups.labels('replays', 'redis').inc()
+        else:
+            self.misses += 1
+            metrics.cacheLookups.labels('replays', 'miss').inc()
+            if (body := await loader()) is None:
+                return None
+            await self.redis.set(key, body, ex=self.ttl)
+        self.local.set(key, body)
+        return body
+
+    def metrics(self) -> dict[str, int]:
+        return {
+            "size": len(self.local.entries),
+            "bytes": self.local.size,
+            "max_bytes": self.local.maxBytes,
+            "hits": self.hits,
+            "redis_hits": self.remoteHits,
+            "misses": self.misses,
+            "coalesced": self.coalesced
+        }
+
+
+class UserCache:
+    """### User records of this process, found by uid, username, display name or lowercased email
+
+    Only existing users are cached, lookups of unknown names always reach the database.
+    Changes are published on a Redis channel once attached, so every worker drops its copy.
+    Users changed in the last stale_ttl seconds are remembered, replicas may not have the change yet.
+    """
+    channel = 'users:invalidate'
+    fields = ('username', 'display_name', 'email')
+
+    def __init__(self, maxsize: int, ttl: float, stale_ttl: float = 0.0):
+        self.records: LocalCache[int, Mapping[str, Any]] = LocalCache(maxsize, ttl, on_drop=self.unindex)
+        self.changed: LocalCache[int, bool] = LocalCache(maxsize, stale_ttl)
+        self.index: dict[tuple[str, Any], int] = {}
+        self.redis: Optional[aioredis.Redis] = None
+        # Bumped on every invalidation, loads started before it are not stored
+        self.generation: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+        self.invalidations: int = 0
+
+    @staticmethod
+    def indexKey(field: str, value: Any) -> tuple[str, Any]:
+        return (field, value.lower() if field == 'email' else value)
+
+    def unindex(self, uid: int, record: Mapping[str, Any]):
+        for field in self.fields:
+            key = self.indexKey(field, record[field])
+            if self.index.get(key) == uid:
+                del self.index[key]
+
+    def get(self, field: str, value: Any) -> Optional[Mapping[str, Any]]:
+        """### Cached user record
+
+        Args:
+            field (str): uid, username, display_name or email
+            value (Any): value to look up
+
+        Returns:
+            Optional[Mapping[str, Any]]: user record, None on a miss
+        """
+        uid = value if field == 'uid' else self.index.get(self.indexKey(field, value))
+        if uid is None or (record := self.records.get(uid)) is None:
+            self.misses += 1
+            metrics.cacheLookups.labels('users', 'miss').inc()
+            return None
+        self.hits += 1
+        metrics.cacheLookups.labels('users', 'hit').inc()
+        return record
+
+    def set(self, record: Mapping[str, Any], generation: int):
+        """### Cache a user record loaded while self.generation was generation
+        """
+        if generation != self.generation:
+            return
+        self.records.set(record['uid'], record)
+        for field in self.fields:
+            self.index[self.indexKey(field, record[field])] = record['uid']
+
+    def drop(self, uid: int):
+        self.generation += 1
+        self.invalidations += 1
+        self.records.pop(uid)
+        if self.changed.ttl:
+            self.changed.set(uid, True)
+
+    def changedRecently(self, uid: int) -> bool:
+        return self.changed.get(uid) is not None
+
+    async def invalidate(self, uid: int):
+        """### Drop a changed user here and on every other worker
+        """
+        self.drop(uid)
+        if self.redis is not None:
+            await self.redis.publish(self.channel, uid)
+
+    async def listen(self, redis: aioredis.Redis):
+        """### Publish invalidations through redis and apply the ones of other workers, runs until cancelled
+        """
+        self.redis = redis
+        while True:
+            try:
+                async with redis.pubsub() as pubsub:
+                    await pubsub.subscribe(self.channel)
+                    # Anything missed while not subscribed
+                    self.records.clear()
+                    async for message in pubsub.listen():
+                        if message['type'] == 'message':
+                            self.drop(int(message['data']))
+            except aioredis.ConnectionError:
+                await asyncio.sleep(1.0)
+
+    def metrics(self) -> dict[str, int]:
+        return {
+            "size": len(self.records.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations
+        }
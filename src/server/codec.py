@@ -0,0 +1,80 @@
+import json
+import secrets
+from typing import Any, Optional
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# orjson.JSONDecodeError is a subclass of it
+DecodeError = json.JSONDecodeError
+
+# orjson decodes integers past 64 bits as floats, the json module keeps them exact
+backend: str = 'orjson' if orjson is not None else 'json'
+
+
+class Fragment:
+    """Already encoded json, written into the output as is
+    """
+    __slots__ = ('encoded',)
+
+    def __init__(self, encoded: bytes | str):
+        self.encoded = encoded.encode() if isinstance(encoded, str) else encoded
+
+
+def use(name: Optional[str] = None):
+    """Select the json backend of this process
+
+    Args:
+        name (Optional[str], optional): 'orjson' or 'json'. Defaults to orjson when installed.
+
+    Raises:
+        ValueError: when the backend is unknown or not installed
+    """
+    global backend
+    if name in (None, ''):
+        name = 'orjson' if orjson is not None else 'json'
+    if name not in ('orjson', 'json') or (name == 'orjson' and orjson is None):
+        raise ValueError(f"JSON backend {name} is not available")
+    backend = name
+
+def loads(data: bytes | str) -> Any:
+    if backend == 'orjson':
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # NaN and Infinity are only understood by the json module
+            pass
+    return json.loads(data)
+
+def dumps(value: Any) -> bytes:
+    """Encode to compact json, Fragment values are written out without re-encoding
+    """
+    if backend == 'orjson':
+        try:
+            return orjson.dumps(value, default=orjsonDefault, option=orjson.OPT_NON_STR_KEYS)
+        except orjson.JSONEncodeError:
+            pass
+    fragments: dict[str, bytes] = {}
+    marker = secrets.token_hex(8)
+
+    def placeholder(fragment: Any) -> str:
+        if not isinstance(fragment, Fragment):
+            raise TypeError(f"Object of type {type(fragment).__name__} is not JSON serializable")
+        key = f'{marker}:{len(fragments)}'
+        fragments[key] = fragment.encoded
+        return key
+
+    encoded = json.dumps(value, separators=(',', ':'), ensure_ascii=False, default=placeholder).encode()
+    for key, fragment in fragments.items():
+        encoded = encoded.replace(f'"{key}"'.encode(), fragment, 1)
+    return encoded
+
+def dumpsText(value: Any) -> str:
+    return dumps(value).decode()
+
+def orjsonDefault(value: Any) -> Any:
+    if isinstance(value, Fragment):
+        return orjson.Fragment(value.encoded)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
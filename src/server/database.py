@@ -1,18 +1,59 @@
-import json
+import asyncio
+import contextlib
+import inspect
+import logging
 import os
+import time
+from datetime import datetime
 from enum import StrEnum
-from typing import Optional, TypeAlias
+from typing import AsyncIterator, Callable, Iterator, Optional, TypeAlias
 
 import asyncpg
 import asyncpg.prepared_stmt
 from argon2 import exceptions as argon2Excepts
 from email_validator import EmailNotValidError, validate_email
 
-from . import aioargon2, replay
+from . import aioargon2, codec, deadlines, metrics, migrations, partitioning, replay, storage
+from .cache import LocalCache, UserCache
+from .session import SessionStore
 
 JSON: TypeAlias = dict[str, "JSON"] | list["JSON"] | str | int | float | bool | None
 defaultGame = os.getenv('SCORE_DEFAULT_GAME_ID', 'default_game')
 defaultGameName = os.getenv('SCORE_DEFAULT_GAME_NAME', 'Default Game')
+leaderboardSize = 50
+# Replays accepted by one batch submission
+submitBatchSize = 100
+# Leaderboard page orderings: ORDER BY, keyset condition on ($2 sort value, $3 uid) and the sort value before the first row
+# Nickname of the player of a replay, kept in its header
+nicknameColumn = "replay_header -> 'player' ->> 'nickname' AS nickname"
+
+leaderboardOrders: dict[str, tuple[str, str, int]] = {
+    'time': ('time ASC, uid ASC', '(time, uid) > ($2, $3)', -2 ** 31),
+    # score <= $2 bounds the index scan, the OR alone would be filtered from the top of the level
+    'score': ('score DESC, uid ASC', 'score <= $2 AND (score < $2 OR uid > $3)', 2 ** 63 - 1)
+}
+
+# Seconds a replica is behind the primary, 0 once it replayed everything it received or when it isn't a standby
+replicaLagQuery = '''
+    SELECT (CASE
+        WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp())
+    END)::float8
+'''
+# Replica failures after which a read is retried on the primary
+replicaErrors = (
+    OSError, asyncio.TimeoutError, asyncpg.InterfaceError, asyncpg.exceptions.PostgresConnectionError,
+    asyncpg.exceptions.CannotConnectNowError, asyncpg.exceptions.TransactionRollbackError
+)
+
+# Seconds without use after which the statements of a game are dropped, asyncpg closes cached statements as often
+gameIdleTime = 300.0
+# Seconds a name missing from the games table is refused without asking the database again
+unknownGameTtl = 30.0
+# Statements cached by each connection, enough for the busy games
+statementCacheSize = 1000
+
+logger = logging.getLogger(__name__)
 
 class userStatus(StrEnum):
     Active = 'active'
@@ -21,6 +62,124 @@ class userStatus(StrEnum):
     Disabled = 'disabled'
 
 
+def checkPrepareCache():
+    """### Fail on import when asyncpg no longer has the private method ScoreConnection relies on
+
+    Statements made with the public prepare() can't be used once their connection went back to the pool,
+    filling the statement cache of the connection needs Connection._prepare(use_cache=True).
+    requirements.txt pins asyncpg to the releases checked to have it.
+    """
+    method = getattr(asyncpg.Connection, '_prepare', None)
+    if method is None or 'use_cache' not in inspect.signature(method).parameters:
+        raise ImportError(f"asyncpg {asyncpg.__version__} can't prepare statements into the connection cache, install a version from requirements.txt")
+
+checkPrepareCache()
+
+
+class ScoreConnection(asyncpg.Connection):
+    """### asyncpg Connection able to prepare queries into its own statement cache
+    """
+    __slots__ = ()
+
+    async def prepareCached(self, query: str):
+        """### Prepare a query into the statement cache, later fetch() calls with the same query reuse it
+
+        Args:
+            query (str): query to prepare
+        """
+        await self._prepare(query, use_cache=True)
+
+
+class Replica:
+    """### Connection pool of a read replica, with its health as of the last check
+    """
+
+    def __init__(self, pool: asyncpg.Pool, index: int):
+        self.pool = pool
+        self.index = index
+        self.healthy: bool = False
+        self.lag: Optional[float] = None
+        self.reads: int = 0
+        self.failures: int = 0
+
+    def metrics(self) -> dict[str, JSON]:
+        return {
+            "healthy": self.healthy,
+            "lag": self.lag,
+            "reads": self.reads,
+            "failures": self.failures
+        }
+
+
+class GameRegistry:
+    """### Index of the games, the statements of a game are built on its first use
+
+    Statements are named kind:game or kind:game:variant. Games idle for idle_time seconds drop theirs,
+    so new connections only prepare the statements of busy games.
+    """
+
+    def __init__(self, build: Callable[[str], dict[str, str]], idle_time: float = gameIdleTime, unknown_ttl: float = unknownGameTtl):
+        self.build = build
+        self.idleTime = idle_time
+        # Game name to display name
+        self.names: dict[str, str] = {}
+        self.statements: dict[str, dict[str, str]] = {}
+        self.lastUsed: dict[str, float] = {}
+        self.unknown: LocalCache[str, bool] = LocalCache(10000, unknown_ttl)
+        self.built: int = 0
+        self.evicted: int = 0
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.names
+
+    def add(self, name: str, display_name: str):
+        self.names[name] = display_name
+        self.unknown.pop(name)
+
+    def query(self, statement: str) -> str:
+        """### Query of a game statement, building the statements of the game if idle
+
+        Raises:
+            KeyError: when the game or the statement is unknown
+        """
+        _, sep, rest = statement.partition(':')
+        if not sep:
+            raise KeyError(f'{statement} is not a game statement')
+        game = rest.partition(':')[0]
+        if game not in self.names:
+            raise KeyError(statement)
+        if (queries := self.statements.get(game)) is None:
+            queries = self.statements[game] = self.build(game)
+            self.built += 1
+        self.lastUsed[game] = time.monotonic()
+        return queries[statement]
+
+    def active(self) -> list[str]:
+        return [query for queries in self.statements.values() for query in queries.values()]
+
+    def evictIdle(self) -> list[str]:
+        """### Drop the statements of games unused for idle_time seconds
+
+        Returns:
+            list[str]: games evicted
+        """
+        cutoff = time.monotonic() - self.idleTime
+        idle = [game for game, used in self.lastUsed.items() if used < cutoff]
+        for game in idle:
+            del self.statements[game]
+            del self.lastUsed[game]
+        self.evicted += len(idle)
+        return idle
+
+    def metrics(self) -> dict[str, int]:
+        return {
+            "games": len(self.names),
+            "active": len(self.statements),
+            "built": self.built,
+            "evicted": self.evicted
+        }
+
+
 class PostgresDB:
 
     # For async init
@@ -29,45 +188,398 @@ class PostgresDB:
         await instance.__init__(*a, **kw)
         return instance
 
-    async def __init__(self, **connection_info):
-        self.db: asyncpg.Connection = await asyncpg.connect(**connection_info)
+    async def __init__(
+        self, *, min_size: int = 2, max_size: int = 10, user_cache_size: int = 10000, user_cache_ttl: float = 60.0,
+        replicas: Optional[list[str]] = None, replica_max_lag: float = 5.0, statement_timeout: Optional[float] = None, **connection_info
+    ):
+        self.queries: dict[str, str] = {}
+        self.games = GameRegistry(self.gameQueries)
+        self.users = UserCache(user_cache_size, user_cache_ttl, replica_max_lag if replicas else 0.0)
+        # Sessions of users who get banned or disabled are ended once attached
+        self.sessions: Optional[SessionStore] = None
+        self.replicaMaxLag = replica_max_lag
+        self.replicas: list[Replica] = []
+        self.nextReplica: int = 0
+        self.replays = storage.ReplayStorage()
+        self.acquireCount: int = 0
+        self.acquireWaitTotal: float = 0.0
+        self.acquireWaitMax: float = 0.0
+        self.connectionsInUse: int = 0
+        # Server side limit of every statement, for queries whose cancellation never reached the server
+        settings = {'statement_timeout': str(int(statement_timeout * 1000))} if statement_timeout else {}
+        self.pool: asyncpg.Pool = await asyncpg.create_pool(
+            min_size=min_size,
+            max_size=max_size,
+            init=self.prepareConnection,
+            connection_class=ScoreConnection,
+            statement_cache_size=statementCacheSize,
+            server_settings=settings,
+            **connection_info
+        )
         try:
             await self.initSearchQuery()
         except asyncpg.exceptions.UndefinedTableError:
             await self.initTables()
             await self.createGame(defaultGame, defaultGameName)
             await self.initSearchQuery()
+        # Connections opened before the statements were known get re-initialized on next acquire
+        await self.pool.expire_connections()
+        for index, dsn in enumerate(replicas or []):
+            # Connections open on first use, an unreachable replica doesn't keep the server from starting
+            pool = await asyncpg.create_pool(
+                dsn, min_size=0, max_size=max_size, connection_class=ScoreConnection, statement_cache_size=statementCacheSize,
+                server_settings=settings
+            )
+            self.replicas.append(Replica(pool, index))
+        await self.checkReplicas()
 
     async def close(self):
-        await self.db.close()
+        await self.pool.close()
+        for replica in self.replicas:
+            await replica.pool.close()
+
+    async def checkReplicas(self, timeout: float = 1.0):
+        """### Measure the lag of every replica, replicas unreachable or too far behind stop taking reads
+
+        Args:
+            timeout (float, optional): seconds a replica gets to answer. Defaults to 1.0.
+        """
+        for replica in self.replicas:
+            try:
+                async with asyncio.timeout(timeout):
+                    async with replica.pool.acquire() as conn:
+                        replica.lag = await conn.fetchval(replicaLagQuery)
+            except replicaErrors:
+                replica.lag = None
+            healthy = replica.lag is not None and replica.lag <= self.replicaMaxLag
+            if healthy != replica.healthy:
+                if healthy:
+                    logger.info(f"Replica {replica.index} is taking reads")
+                else:
+                    logger.warning(f"Replica {replica.index} stopped taking reads, lag {replica.lag}")
+            replica.healthy = healthy
+
+    async def monitorReplicas(self, interval: float = 1.0):
+        """### Check the replicas every interval seconds, runs until cancelled
+        """
+        while True:
+            await asyncio.sleep(interval)
+            await self.checkReplicas(interval)
+
+    async def evictIdleGames(self, interval: float = 60.0):
+        """### Drop the statements of idle games every interval seconds, runs until cancelled
+        """
+        while True:
+            await asyncio.sleep(interval)
+            if evicted := self.games.evictIdle():
+                logger.debug(f"Dropped the statements of idle games {', '.join(evicted)}")
+
+    def readReplica(self) -> Optional[Replica]:
+        """### Next healthy replica, round robin
+
+        Returns:
+            Optional[Replica]: None when no replica is healthy
+        """
+        for _ in range(len(self.replicas)):
+            replica = self.replicas[self.nextReplica % len(self.replicas)]
+            self.nextReplica += 1
+            if replica.healthy:
+                return replica
+        return None
+
+    async def prepareConnection(self, conn: ScoreConnection):
+        """### Pool init hook, prepare the shared statements and those of busy games on a new connection
+
+        Args:
+            conn (ScoreConnection): newly opened connection
+        """
+        for query in [*self.queries.values(), *self.games.active()]:
+            await conn.prepareCached(query)
+
+    @contextlib.asynccontextmanager
+    async def acquire(self) -> AsyncIterator[ScoreConnection]:
+        """### Acquire a connection from the pool, recording wait time and usage, waiting no longer than the request deadline
+        """
+        start = time.perf_counter()
+        async with self.pool.acquire(timeout=deadlines.remaining()) as conn:
+            waited = time.perf_counter() - start
+            metrics.poolWaitSeconds.observe(waited)
+            self.acquireCount += 1
+            self.acquireWaitTotal += waited
+            self.acquireWaitMax = max(self.acquireWaitMax, waited)
+            self.connectionsInUse += 1
+            try:
+                yield conn
+            finally:
+                self.connectionsInUse -= 1
+
+    async def fetchPrepared(self, name: str, *args) -> list[asyncpg.Record]:
+        """### Run a registered statement
+
+        Statements registered after a connection was opened get prepared on it at first use. 
+
+        Args:
+            name (str): name of the statement
+
+        Raises:
+            KeyError: when the statement is not registered
+
+        Returns:
+            list[asyncpg.Record]: fetched rows
+        """
+        query = self.statement(name)
+        async with self.acquire() as conn:
+            with self.timed(name, 'primary'):
+                return await conn.fetch(query, *args, timeout=deadlines.remaining())
+
+    async def fetchReadOnly(self, name: str, *args, primary: bool = False) -> list[asyncpg.Record]:
+        """### Run a registered read-only statement on a replica
+
+        Goes to the primary when asked, when no replica is healthy, or when the replica fails.
+
+        Args:
+            name (str): name of the statement
+            primary (bool, optional): read from the primary. Defaults to False.
+
+        Raises:
+            KeyError: when the statement is not registered
+
+        Returns:
+            list[asyncpg.Record]: fetched rows
+        """
+        query = self.statement(name)
+        if not primary and (replica := self.readReplica()) is not None:
+            try:
+                async with replica.pool.acquire(timeout=deadlines.remaining()) as conn:
+                    replica.reads += 1
+                    with self.timed(name, 'replica'):
+                        return await conn.fetch(query, *args, timeout=deadlines.remaining())
+            except replicaErrors:
+                if deadlines.expired():
+                    # The request ran out of time, not the replica
+                    raise
+                replica.failures += 1
+                replica.healthy = False
+                logger.warning(f"Replica {replica.index} failed a read, reading from the primary")
+        async with self.acquire() as conn:
+            with self.timed(name, 'primary'):
+                return await conn.fetch(query, *args, timeout=deadlines.remaining())
+
+    @staticmethod
+    @contextlib.contextmanager
+    def timed(name: str, target: str) -> Iterator[None]:
+        """### Record the run time of a statement, failed runs included
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            metrics.statementSeconds.labels(metrics.statementName(name), target).observe(time.perf_counter() - start)
+
+    async def execute(self, query: str, *args) -> str:
+        async with self.acquire() as conn:
+            return await conn.execute(query, *args, timeout=deadlines.remaining())
+
+    def statement(self, name: str) -> str:
+        """### Query of a registered statement, statements of a game are named kind:game[:variant]
+
+        Raises:
+            KeyError: when the statement or its game is unknown
+        """
+        if (query := self.queries.get(name)) is not None:
+            return query
+        return self.games.query(name)
+
+    async def hasGame(self, name: str) -> bool:
+        """### Whether a game exists, names missing from the index are looked up once per unknownGameTtl
+
+        Games created by another worker or the admin command are found on their first request.
+        """
+        if name in self.games:
+            return True
+        if self.games.unknown.get(name):
+            return False
+        if rows := await self.fetchPrepared('fetchGame', name):
+            self.games.add(name, rows[0]['display_name'])
+            return True
+        self.games.unknown.set(name, True)
+        return False
+
+    def poolMetrics(self) -> dict[str, JSON]:
+        """### Connection pool usage, for sizing the pool
+
+        Returns:
+            JSON: pool size, connections in use and acquire wait times in seconds
+        """
+        return {
+            "size": self.pool.get_size(),
+            "idle": self.pool.get_idle_size(),
+            "in_use": self.connectionsInUse,
+            "min_size": self.pool.get_min_size(),
+            "max_size": self.pool.get_max_size(),
+            "acquired": self.acquireCount,
+            "wait_total": self.acquireWaitTotal,
+            "wait_avg": self.acquireWaitTotal / self.acquireCount if self.acquireCount else 0.0,
+            "wait_max": self.acquireWaitMax,
+            "replicas": [replica.metrics() for replica in self.replicas]
+        }
+
+    @staticmethod
+    def gameQueries(name: str) -> dict[str, str]:
+        """### Statements needed for each game
+
+        Args:
+            name (str): game name
+
+        Returns:
+            dict[str, str]: statement name to query
+        """
+        return {
+            f'fetchScoreByGame:{name}': f'SELECT replay_header, replay_events FROM game_{name} WHERE uid = $1',
+            # The level lets partitioned tables skip every other partition
+            f'fetchScoreByGameLevel:{name}': f'SELECT replay_header, replay_events FROM game_{name} WHERE uid = $1 AND level_id = $2',
+            f'fetchScoreByDigest:{name}': f'SELECT uid, false AS inserted FROM game_{name} WHERE replay_digest = $1 AND level_id = $2',
+            # Insert, or return the uid of the replay already holding the digest.
+            # Without a conflict target, so the unique digest index may hold the partition key
+            f'insertScore:{name}': f'''
+                WITH submitted AS (
+                    INSERT INTO game_{name}(user_uid, replay_header, replay_events, replay_digest, level_id, score, time, player_uid)
+                    VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
+                    ON CONFLICT DO NOTHING
+                    RETURNING uid
+                )
+                SELECT uid, true AS inserted FROM submitted
+                UNION ALL
+                SELECT uid, false AS inserted FROM game_{name} WHERE replay_digest = $4 AND level_id = $5
+                LIMIT 1
+            ''',
+            f'fetchScoresByDigest:{name}': f'SELECT uid, replay_digest, false AS inserted FROM game_{name} WHERE replay_digest = ANY($1)',
+            # Insert a batch in order, along with the replays already holding one of its digests
+            f'insertScores:{name}': f'''
+                WITH batch AS (
+                    SELECT * FROM unnest($1::integer[], $2::json[], $3::bytea[], $4::bytea[], $5::integer[], $6::bigint[], $7::integer[], $8::integer[])
+                    WITH ORDINALITY AS batch(user_uid, replay_header, replay_events, replay_digest, level_id, score, time, player_uid, position)
+                ), submitted AS (
+                    INSERT INTO game_{name}(user_uid, replay_header, replay_events, replay_digest, level_id, score, time, player_uid)
+                    SELECT user_uid, replay_header, replay_events, replay_digest, level_id, score, time, player_uid FROM batch ORDER BY position
+                    ON CONFLICT DO NOTHING
+                    RETURNING uid, replay_digest
+                )
+                SELECT uid, replay_digest, true AS inserted FROM submitted
+                UNION ALL
+                SELECT uid, replay_digest, false AS inserted FROM game_{name} WHERE replay_digest = ANY($4) AND level_id = ANY($5)
+            ''',
+            f'fetchScoreLeaderboard:{name}': PostgresDB.withReplayColumns(name, f'''
+                SELECT uid, time FROM game_{name}
+                WHERE level_id = $1
+                ORDER BY time ASC, uid ASC LIMIT {leaderboardSize}
+            ''', 'replay_header, replay_events', 'time ASC, uid ASC'),
+            f'fetchScoreLeaderboardSummary:{name}': PostgresDB.withReplayColumns(name, f'''
+                SELECT uid, player_uid, score, time FROM game_{name}
+                WHERE level_id = $1
+                ORDER BY time ASC, uid ASC LIMIT {leaderboardSize}
+            ''', nicknameColumn, 'time ASC, uid ASC')
+        } | PostgresDB.leaderboardPageQueries(name)
+
+    @staticmethod
+    def withReplayColumns(name: str, top: str, columns: str, order: str) -> str:
+        """### Add columns the leaderboard indexes don't hold to the rows of a top-N query, looked up by uid
+
+        top only reads indexed columns so it runs as an index-only scan, the heap is only read for the rows it returns.
+
+        Args:
+            name (str): game name
+            top (str): query of the entries, with uid among its columns and the level as $1
+            columns (str): columns to add, read from the row as replays
+            order (str): order of the entries
+
+        Returns:
+            str: query
+        """
+        return f'''
+            SELECT top.*, replays.* FROM ({top}) AS top
+            CROSS JOIN LATERAL (
+                SELECT {columns} FROM game_{name} WHERE game_{name}.uid = top.uid AND game_{name}.level_id = $1
+            ) AS replays
+            ORDER BY {order}
+        '''
+
+    @staticmethod
+    def leaderboardPageQueries(name: str) -> dict[str, str]:
+        """### Keyset paginated leaderboard statements of a game, one per ordering, player mode and window
+
+        Every variant takes the level as $1, the key of the last row of the previous page as $2 and $3,
+        the page size as $4, and the start of the window as $5 when windowed.
+
+        Args:
+            name (str): game name
+
+        Returns:
+            dict[str, str]: statement name to query
+        """
+        queries: dict[str, str] = {}
+        for sort, (order, after, _) in leaderboardOrders.items():
+            for windowed in (False, True):
+                window = 'AND submitted_at >= $5' if windowed else ''
+                scope = 'window' if windowed else 'all'
+                queries[f'fetchScorePage:{name}:{sort}:all:{scope}'] = PostgresDB.withReplayColumns(name, f'''
+                    SELECT uid, player_uid, score, time FROM game_{name}
+                    WHERE level_id = $1 {window} AND {after}
+                    ORDER BY {order} LIMIT $4
+                ''', f'{nicknameColumn}, submitted_at', order)
+                if sort == 'time' and not windowed:
+                    # Kept by a trigger, see migrations.createBestTable
+                    queries[f'fetchScorePage:{name}:time:best:all'] = f'''
+                        SELECT uid, player_uid, nickname, score, time, submitted_at FROM game_{name}_best
+                        WHERE level_id = $1 AND {after}
+                        ORDER BY {order} LIMIT $4
+                    '''
+                    continue
+                # Best replay of each player first, then the page over those
+                queries[f'fetchScorePage:{name}:{sort}:best:{scope}'] = PostgresDB.withReplayColumns(name, f'''
+                    SELECT uid, player_uid, score, time FROM (
+                        SELECT DISTINCT ON (player_uid) uid, player_uid, score, time
+                        FROM game_{name}
+                        WHERE level_id = $1 {window}
+                        ORDER BY player_uid, {order}
+                    ) AS best
+                    WHERE {after}
+                    ORDER BY {order} LIMIT $4
+                ''', f'{nicknameColumn}, submitted_at', order)
+        return queries
 
     async def initSearchQuery(self):
-        self.fetchUserByUid: asyncpg.prepared_stmt.PreparedStatement = await self.db.prepare('SELECT * FROM users WHERE uid = $1')
-        self.fetchUserByUsername: asyncpg.prepared_stmt.PreparedStatement = await self.db.prepare('SELECT * FROM users WHERE username = $1')
-        self.fetchUserByNickname: asyncpg.prepared_stmt.PreparedStatement = await self.db.prepare('SELECT * FROM users WHERE display_name = $1')
-        self.fetchUserByEmail: asyncpg.prepared_stmt.PreparedStatement = await self.db.prepare('SELECT * FROM users WHERE lower(email) = LOWER($1)')
-        self.fetchGames: asyncpg.prepared_stmt.PreparedStatement = await self.db.prepare('SELECT * FROM games')
-        self.fetchScoreByGame: dict[str, asyncpg.prepared_stmt.PreparedStatement] = {}
-        self.fetchScoreLeaderboard: dict[str, asyncpg.prepared_stmt.PreparedStatement] = {}
-        for game in await self.fetchGames.fetch():
-            self.fetchScoreByGame[game['name']] = await self.db.prepare(f'SELECT * FROM game_{game['name']} WHERE uid = $1')
-            self.fetchScoreByGame[f"{game['name']}_json"] = await self.db.prepare(f'SELECT * FROM game_{game['name']} WHERE replay_json::jsonb @> $1::jsonb AND replay_json::jsonb <@ $1::jsonb')
-            self.fetchScoreLeaderboard[game['name']] = await self.db.prepare(f'''
-                SELECT * FROM game_{game['name']}
-                WHERE (replay_json -> 'info' ->> 'level_id')::integer = $1
-                ORDER BY (replay_json -> 'info' ->> 'time')::integer ASC LIMIT 50
-            ''')
+        queries = {
+            'fetchUserByUid': 'SELECT * FROM users WHERE uid = $1',
+            'fetchUserByUsername': 'SELECT * FROM users WHERE username = $1',
+            'fetchUserByNickname': 'SELECT * FROM users WHERE display_name = $1',
+            'fetchUserByEmail': 'SELECT * FROM users WHERE lower(email) = LOWER($1)',
+            'fetchGames': 'SELECT * FROM games',
+            'fetchGame': 'SELECT * FROM games WHERE name = $1'
+        }
+        async with self.acquire() as conn:
+            rows = await conn.fetch(queries['fetchGames'])
+            games = [game['name'] for game in rows]
+            if pending := await migrations.pendingGames(conn, games):
+                raise RuntimeError(f"Tables of {', '.join(pending)} need migrating, run: python -m server.admin migrate")
+            await storage.ensureTable(conn)
+            await self.replays.load(conn)
+            await partitioning.maintain(conn, games)
+        # Statements of each game are built on its first request
+        for game in rows:
+            self.games.add(game['name'], game['display_name'])
+        self.queries = queries
 
     async def initTables(self):
         """### Create Type user_status and Table users and games
         """
         # Create user_status type
-        await self.db.execute('''
+        await self.execute('''
             CREATE TYPE user_status AS ENUM ('active', 'unverified', 'banned', 'disabled')
         ''')
 
         # Create users table
-        await self.db.execute('''
+        await self.execute('''
             CREATE TABLE IF NOT EXISTS users (
                 uid SERIAL NOT NULL PRIMARY KEY, 
                 username text NOT NULL,
@@ -79,7 +591,7 @@ class PostgresDB:
         ''')
 
         # Create games table
-        await self.db.execute('''
+        await self.execute('''
             CREATE TABLE IF NOT EXISTS games (
                 uid SERIAL NOT NULL PRIMARY KEY, 
                 name text NOT NULL,
@@ -87,6 +599,28 @@ class PostgresDB:
             )
         ''')
 
+    async def searchUser(self, field: str, statement: str, value: int | str) -> list[asyncpg.Record]:
+        """### Get All Users matching a field, from the user cache when possible
+
+        Args:
+            field (str): uid, username, display_name or email
+            statement (str): registered statement looking up the field
+            value (int | str): value to look up
+
+        Returns:
+            list[asyncpg.Record]: users matching
+        """
+        if (record := self.users.get(field, value)) is not None:
+            return [record]
+        generation = self.users.generation
+        users = await self.fetchReadOnly(statement, value)
+        if self.replicas and (not users or any(self.users.changedRecently(user['uid']) for user in users)):
+            # Replicas may not have a user just created or changed yet
+            users = await self.fetchPrepared(statement, value)
+        for user in users:
+            self.users.set(user, generation)
+        return users
+
     async def searchUserByUid(self, uid: int) -> list[asyncpg.Record]:
         """### Get All Users with the uid
 
@@ -96,7 +630,7 @@ class PostgresDB:
         Returns:
             list[asyncpg.Record]: users with the uid
         """
-        return await self.fetchUserByUid.fetch(uid)
+        return await self.searchUser('uid', 'fetchUserByUid', uid)
 
     async def searchUserByUsername(self, username: str) -> list[asyncpg.Record]:
         """### Get All Users with the username
@@ -107,7 +641,7 @@ class PostgresDB:
         Returns:
             list[asyncpg.Record]: users with the username
         """
-        return await self.fetchUserByUsername.fetch(username)
+        return await self.searchUser('username', 'fetchUserByUsername', username)
 
     async def searchUserByNickname(self, nickname: str) -> list[asyncpg.Record]:
         """### Get All Users with the nickname
@@ -118,7 +652,7 @@ class PostgresDB:
         Returns:
             list[asyncpg.Record]: users with the nickname
         """
-        return await self.fetchUserByNickname.fetch(nickname)
+        return await self.searchUser('display_name', 'fetchUserByNickname', nickname)
 
     async def searchUserByEmail(self, email: str) -> list[asyncpg.Record]:
         """### Get All Users with the email
@@ -129,7 +663,7 @@ class PostgresDB:
         Returns:
             list[asyncpg.Record]: users with the email
         """
-        return await self.fetchUserByEmail.fetch(email)
+        return await self.searchUser('email', 'fetchUserByEmail', email)
 
     async def createUser(self, username: str, display_name: str, email: str, *, password: Optional[str] = None, status: userStatus = userStatus('unverified')) -> dict[str, JSON]:
         """### Create User in db
@@ -183,9 +717,11 @@ class PostgresDB:
             }
 
         password_hash = await aioargon2.hash(password) if password else 'null'
-        await self.db.execute('''
-            INSERT INTO users(username, display_name, email, password_hash, status) VALUES ($1, $2, $3, $4, $5)
-        ''', username, display_name, email, password_hash, status)
+        async with self.acquire() as conn:
+            uid = await conn.fetchval('''
+                INSERT INTO users(username, display_name, email, password_hash, status) VALUES ($1, $2, $3, $4, $5) RETURNING uid
+            ''', username, display_name, email, password_hash, status)
+        await self.users.invalidate(uid)
         return {
             "status": 200, 
             "message": "Success, User Created. "
@@ -216,18 +752,22 @@ class PostgresDB:
                     "status": 400, 
                     "message": "Email already exist. "
                 }
-            await self.db.execute('''
+            await self.execute('''
                 UPDATE users SET email = $1 WHERE uid = $2
             ''', email, uid)
         if password:
             password_hash = await aioargon2.hash(password)
-            await self.db.execute('''
+            await self.execute('''
                 UPDATE users SET password_hash = $1 WHERE uid = $2
             ''', password_hash, uid)
         if status:
-            await self.db.execute('''
+            await self.execute('''
                 UPDATE users SET status = $1 WHERE uid = $2
             ''', status, uid)
+            if status != userStatus.Active and self.sessions is not None:
+                # Submissions trust the session, a banned or disabled user must lose theirs
+                await self.sessions.endUser(uid)
+        await self.users.invalidate(uid)
         return {
             "status": 200, 
             "message": "Success, User Updated. "
@@ -253,7 +793,7 @@ class PostgresDB:
         password_hash: str = user_entry['password_hash']
         try:
             await aioargon2.verify(password_hash, password)
-            if await aioargon2.check_needs_rehash(password_hash):
+            if aioargon2.check_needs_rehash(password_hash):
                 await self.modifyUser(user_entry['uid'], password=password)
             return user_entry['uid'], user_entry['display_name']
         except argon2Excepts.VerifyMismatchError:
@@ -261,79 +801,368 @@ class PostgresDB:
         except argon2Excepts.InvalidHashError:
             return -2, ""
 
-    async def createGame(self, name: str, display_name: str):
-        await self.db.execute(f'''
-            CREATE TABLE IF NOT EXISTS game_{name} (
-                uid SERIAL NOT NULL PRIMARY KEY,
-                user_uid SERIAL NOT NULL,
-                replay_json json NOT NULL
-            )
-        ''')
-        await self.db.execute('''
-            INSERT INTO games(name, display_name) VALUES ($1, $2)
-        ''', name, display_name)
-        self.fetchScoreByGame[name] = await self.db.prepare(f'SELECT * FROM game_{name} WHERE uid = $1')
-        self.fetchScoreByGame[f"{name}_json"] = await self.db.prepare(f'SELECT * FROM game_{name} WHERE replay_json::jsonb @> $1::jsonb AND replay_json::jsonb <@ $1::jsonb')
-        self.fetchScoreLeaderboard[name] = await self.db.prepare(f'''
-            SELECT * FROM game_{name}
-            WHERE CAST(replay_json -> 'info' ->> 'level_id' AS INTEGER) = $1
-            ORDER BY (replay_json -> 'info' ->> 'time')::integer ASC LIMIT 50
-        ''')
+    async def createGame(self, name: str, display_name: str, partitionBy: Optional[str] = None, partitionCount: int = partitioning.hashPartitions):
+        """### Create the table of a new game
 
-    async def submitScore(self, gameName: str, userUID: int, replayJson: JSON) -> dict[str, JSON]:
+        Args:
+            name (str): game name
+            display_name (str): name shown to players
+            partitionBy (Optional[str], optional): 'level' or 'month' to partition the table. Defaults to a plain table.
+            partitionCount (int, optional): hash partitions when partitioned by level. Defaults to partitioning.hashPartitions.
+        """
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                await partitioning.createTable(conn, name, f'game_{name}', partitionBy, partitionCount)
+                await migrations.createBestTable(conn, name)
+                await conn.execute('''
+                    INSERT INTO games(name, display_name) VALUES ($1, $2)
+                ''', name, display_name)
+                await migrations.markApplied(conn, name)
+        self.games.add(name, display_name)
+
+    async def submitScore(self, gameName: str, userUID: int, replayJson: JSON, *, verifiedUser: bool = False) -> dict[str, JSON]:
         if not replay.validateReplayJson(replayJson):
             return {
                 "status": 400, 
                 "message": "Invalid Replay File! "
             }
-        if not await self.searchUserByUid(userUID):
+        if (columns := replay.replayColumns(replayJson)) is None:
+            return {
+                "status": 400, 
+                "message": "Invalid Replay File! "
+            }
+        # A session already proves the user exists
+        if not verifiedUser and not await self.searchUserByUid(userUID):
             return {
                 "status": 400, 
                 "message": "Invalid UID! "
             }
 
+        header = {key: value for key, value in replayJson.items() if key != 'replay'}
+        return await self.storeScore(
+            gameName, userUID, header, codec.dumps(replayJson['replay']), replay.replayDigest(replayJson), columns
+        )
+
+    async def storeScore(self, gameName: str, userUID: int, header: JSON, events: bytes, digest: bytes, columns: dict[str, int]) -> dict[str, JSON]:
+        """### Insert a validated replay unless one with the same digest is stored
+
+        Args:
+            gameName (str): game name
+            userUID (int): uid of the submitting user
+            header (JSON): replay without its event list
+            events (bytes): event list as json
+            digest (bytes): content digest of the replay
+            columns (dict[str, int]): typed columns of the replay
+
+        Returns:
+            JSON: operation status, with the replay uid unless the game is invalid
+        """
+        if not await self.hasGame(gameName):
+            return {
+                "status": 400, 
+                "message": "Invalid Game! "
+            }
         try:
-            replayJson = json.dumps(replayJson)
-            if fetched_result := await self.fetchScoreByGame[f"{gameName}_json"].fetch(replayJson):
+            args = (
+                userUID, codec.dumpsText(header), self.replays.encodeEvents(gameName, events), digest, 
+                columns['level_id'], columns['score'], columns['time'], columns['player_uid']
+            )
+            submitted = await self.fetchPrepared(f'insertScore:{gameName}', *args)
+            if not submitted:
+                # Lost the race against a concurrent submission of the same replay
+                submitted = await self.fetchPrepared(f'fetchScoreByDigest:{gameName}', digest, columns['level_id'])
+            if not submitted and await self.releaseDigests(gameName, [digest]):
+                # The digest was claimed by a replay deleted since
+                submitted = await self.fetchPrepared(f'insertScore:{gameName}', *args)
+            if not submitted:
+                return {
+                    "status": 400, 
+                    "message": "Replay File already submitted! "
+                }
+            if not submitted[0]['inserted']:
                 return  {
                     "status": 400, 
                     "message": "Replay File already submitted! ",
-                    "replay_uid": fetched_result[0]['uid']
+                    "replay_uid": submitted[0]['uid']
                 }
-            await self.db.execute(f'''
-                INSERT INTO game_{gameName}(user_uid, replay_json) VALUES ($1, $2)
-            ''', userUID, replayJson)
             return {
                 "status": 200, 
                 "message": "Success, Score Submitted. ", 
-                "replay_uid": (await self.fetchScoreByGame[f"{gameName}_json"].fetch(replayJson))[0]['uid']
+                "replay_uid": submitted[0]['uid']
+            }
+        except (asyncpg.exceptions.InvalidTextRepresentationError, codec.DecodeError):
+            return {
+                "status": 415, 
+                "message": "Replay file must be in json format! "
             }
-        except (asyncpg.exceptions.UndefinedTableError, KeyError):
+
+    async def submitScores(self, gameName: str, userUID: int, replayJsons: list[JSON], *, verifiedUser: bool = False) -> dict[str, JSON]:
+        """### Submit a batch of replays with a single insert
+
+        Args:
+            gameName (str): game name
+            userUID (int): uid of the submitting user
+            replayJsons (list[JSON]): decoded replays
+            verifiedUser (bool, optional): skip the user lookup, for callers holding a session. Defaults to False.
+
+        Returns:
+            JSON: operation status, with the status of every replay in order under results
+        """
+        if not verifiedUser and not await self.searchUserByUid(userUID):
             return {
                 "status": 400, 
-                "message": "Invalid Game! "
+                "message": "Invalid UID! "
             }
-        except (asyncpg.exceptions.InvalidTextRepresentationError, json.decoder.JSONDecodeError):
+
+        results: list[Optional[dict[str, JSON]]] = [None] * len(replayJsons)
+        valid: list[int] = []
+        scores: list[tuple[int, JSON, bytes, bytes, dict[str, int]]] = []
+        for index, replayJson in enumerate(replayJsons):
+            if not replay.validateReplayJson(replayJson) or (columns := replay.replayColumns(replayJson)) is None:
+                results[index] = {
+                    "status": 400, 
+                    "message": "Invalid Replay File! "
+                }
+                continue
+            valid.append(index)
+            scores.append((
+                userUID, 
+                {key: value for key, value in replayJson.items() if key != 'replay'}, 
+                codec.dumps(replayJson['replay']), 
+                replay.replayDigest(replayJson), 
+                columns
+            ))
+
+        if scores:
+            status = await self.storeScores(gameName, scores)
+            if status["status"] != 200:
+                return status
+            for index, result in zip(valid, status['results']):
+                results[index] = result
+        return {
+            "status": 200, 
+            "message": "Success, Batch Processed. ", 
+            "results": results
+        }
+
+    async def storeScores(self, gameName: str, scores: list[tuple[int, JSON, bytes, bytes, dict[str, int]]]) -> dict[str, JSON]:
+        """### Insert validated replays with a single insert, skipping the ones whose digest is stored
+
+        Args:
+            gameName (str): game name
+            scores (list[tuple[int, JSON, bytes, bytes, dict[str, int]]]): uid of the submitting user, header, event list as json, 
+                digest and typed columns of each replay
+
+        Returns:
+            JSON: operation status, with the status of every replay in order under results
+        """
+        if not await self.hasGame(gameName):
             return {
-                "status": 415, 
-                "message": "Replay file must be in json format! "
+                "status": 400, 
+                "message": "Invalid Game! "
+            }
+        results: list[Optional[dict[str, JSON]]] = [None] * len(scores)
+        # First copy of each digest in the batch, later copies are reported as duplicates of it
+        firsts: dict[bytes, int] = {}
+        copies: list[tuple[int, bytes]] = []
+        rows: list[tuple] = []
+        for index, (userUID, header, events, digest, columns) in enumerate(scores):
+            if digest in firsts:
+                copies.append((index, digest))
+                continue
+            firsts[digest] = index
+            rows.append((
+                userUID, 
+                codec.dumpsText(header), 
+                self.replays.encodeEvents(gameName, events), 
+                digest, 
+                columns['level_id'], columns['score'], columns['time'], columns['player_uid']
+            ))
+
+        submitted = await self.fetchPrepared(f'insertScores:{gameName}', *map(list, zip(*rows)))
+        stored = {row['replay_digest']: row for row in submitted}
+        if missing := [digest for digest in firsts if digest not in stored]:
+            # Lost the race against concurrent submissions of the same replays
+            stored |= {row['replay_digest']: row for row in await self.fetchPrepared(f'fetchScoresByDigest:{gameName}', missing)}
+        if (missing := [digest for digest in firsts if digest not in stored]) and await self.releaseDigests(gameName, missing):
+            # Digests claimed by replays deleted since
+            retry = [row for row in rows if row[3] in missing]
+            stored |= {row['replay_digest']: row for row in await self.fetchPrepared(f'insertScores:{gameName}', *map(list, zip(*retry)))}
+
+        for digest, index in firsts.items():
+            if digest not in stored:
+                results[index] = {
+                    "status": 400, 
+                    "message": "Replay File already submitted! "
+                }
+            elif stored[digest]['inserted']:
+                results[index] = {
+                    "status": 200, 
+                    "message": "Success, Score Submitted. ", 
+                    "replay_uid": stored[digest]['uid']
+                }
+            else:
+                results[index] = {
+                    "status": 400, 
+                    "message": "Replay File already submitted! ",
+                    "replay_uid": stored[digest]['uid']
+                }
+        for index, digest in copies:
+            results[index] = {
+                "status": 400, 
+                "message": "Replay File already submitted! "
             }
+            if digest in stored:
+                results[index]["replay_uid"] = stored[digest]['uid']
+        return {
+            "status": 200, 
+            "message": "Success, Batch Processed. ", 
+            "results": results
+        }
+
+    async def releaseDigests(self, gameName: str, digests: list[bytes]) -> int:
+        """### Drop digest claims of a month partitioned game that no replay holds
+
+        Returns:
+            int: claims dropped
+        """
+        async with self.acquire() as conn:
+            return await partitioning.releaseDigests(conn, gameName, digests)
 
-    async def fetchScore(self, gameName: str, replayUid: int) -> dict[str, JSON]:
-        if result := await self.fetchScoreByGame[gameName].fetch(replayUid):
-            return json.loads(result[0]['replay_json'])
+    async def storedReplays(self, rows: list[asyncpg.Record]) -> list[storage.StoredReplay]:
+        """### Wrap fetched replay rows, loading the dictionaries they need
+
+        Args:
+            rows (list[asyncpg.Record]): rows with replay_header and replay_events
+
+        Returns:
+            list[storage.StoredReplay]: replays decompressed on first use
+        """
+        if missing := self.replays.missingDictionaries([row['replay_events'] for row in rows]):
+            # Trained after this process started
+            async with self.acquire() as conn:
+                await self.replays.load(conn, missing)
+        return [storage.StoredReplay(row['replay_header'], row['replay_events'], self.replays) for row in rows]
+
+    async def fetchScore(self, gameName: str, replayUid: int, level: Optional[int] = None) -> dict[str, JSON]:
+        if not await self.hasGame(gameName):
+            return {
+                "status": 400, 
+                "message": "Invalid Game! "
+            }
+        if level is None:
+            statement, args = f'fetchScoreByGame:{gameName}', (replayUid,)
+        else:
+            statement, args = f'fetchScoreByGameLevel:{gameName}', (replayUid, level)
+        result = await self.fetchReadOnly(statement, *args)
+        if not result and self.replicas:
+            # Replicas may not have a replay just submitted yet
+            result = await self.fetchPrepared(statement, *args)
+        if result:
+            stored = (await self.storedReplays(result))[0]
+            # The event list goes out without being decoded
+            return stored.header | {"replay": codec.Fragment(stored.eventsEncoded())}
         else:
             return {
                 "status": 400, 
                 "message": "Invalid Replay UID! "
             }
 
-    async def fetchLeaderBoard(self, gameName: str, level: int) -> dict[str, JSON] | list[JSON]:
-        try:
-            leaderboard: list[asyncpg.Record] = await self.fetchScoreLeaderboard[gameName].fetch(level)
-            return [json.loads(replay["replay_json"]) for replay in leaderboard]
-        except KeyError:
+    async def fetchLeaderBoard(self, gameName: str, level: int, *, primary: bool = False) -> dict[str, JSON] | list[JSON]:
+        if not await self.hasGame(gameName):
             return {
                 "status": 400, 
                 "message": "Invalid Game! "
             }
+        leaderboard: list[asyncpg.Record] = await self.fetchReadOnly(f'fetchScoreLeaderboard:{gameName}', level, primary=primary)
+        return [replay.to_json() for replay in await self.storedReplays(leaderboard)]
+
+    async def fetchLeaderBoardEncoded(self, gameName: str, level: int, *, primary: bool = False) -> Optional[list[tuple[int, codec.Fragment]]]:
+        """### Leaderboard with the stored replays left encoded
+
+        Args:
+            gameName (str): game name
+            level (int): level id
+            primary (bool, optional): read from the primary instead of a replica. Defaults to False.
+
+        Returns:
+            Optional[list[tuple[int, codec.Fragment]]]: time and replay of each entry, None for an invalid game
+        """
+        if not await self.hasGame(gameName):
+            return None
+        leaderboard: list[asyncpg.Record] = await self.fetchReadOnly(f'fetchScoreLeaderboard:{gameName}', level, primary=primary)
+        replays = await self.storedReplays(leaderboard)
+        return [(row["time"], replay.fragment()) for row, replay in zip(leaderboard, replays)]
+
+    async def fetchLeaderBoardSummary(self, gameName: str, level: int, *, primary: bool = False) -> Optional[list[dict[str, JSON]]]:
+        """### Leaderboard entries without the replays
+
+        Args:
+            gameName (str): game name
+            level (int): level id
+            primary (bool, optional): read from the primary instead of a replica. Defaults to False.
+
+        Returns:
+            Optional[list[dict[str, JSON]]]: rank, player, score, time and replay uid of each entry, None for an invalid game
+        """
+        if not await self.hasGame(gameName):
+            return None
+        leaderboard: list[asyncpg.Record] = await self.fetchReadOnly(f'fetchScoreLeaderboardSummary:{gameName}', level, primary=primary)
+        return [{
+            "rank": rank,
+            "player": {"uid": entry['player_uid'], "nickname": entry['nickname']},
+            "score": entry['score'],
+            "time": entry['time'],
+            "replay_uid": entry['uid']
+        } for rank, entry in enumerate(leaderboard, start=1)]
+
+    async def fetchLeaderBoardPage(
+        self, gameName: str, level: int, *, sort: str = 'time', best: bool = False,
+        since: Optional[datetime] = None, after: Optional[tuple[int, int]] = None, size: int = leaderboardSize,
+        primary: bool = False
+    ) -> Optional[list[dict[str, JSON]]]:
+        """### One page of a leaderboard, without the replays
+
+        Args:
+            gameName (str): game name
+            level (int): level id
+            sort (str, optional): 'time' fastest first or 'score' highest first. Defaults to 'time'.
+            best (bool, optional): only the best replay of each player. Defaults to False.
+            since (Optional[datetime], optional): only replays submitted from then on. Defaults to None.
+            after (Optional[tuple[int, int]], optional): sort value and uid of the last entry of the previous page. Defaults to the top.
+            size (int, optional): entries per page. Defaults to leaderboardSize.
+            primary (bool, optional): read from the primary instead of a replica. Defaults to False.
+
+        Returns:
+            Optional[list[dict[str, JSON]]]: player, score, time, submission time and replay uid of each entry, None for an invalid game
+        """
+        if after is None:
+            after = (leaderboardOrders[sort][2], 0)
+        name = f"fetchScorePage:{gameName}:{sort}:{'best' if best else 'all'}:{'all' if since is None else 'window'}"
+        args = (level, *after, size) if since is None else (level, *after, size, since)
+        if not await self.hasGame(gameName):
+            return None
+        page: list[asyncpg.Record] = await self.fetchReadOnly(name, *args, primary=primary)
+        return [{
+            "player": {"uid": entry['player_uid'], "nickname": entry['nickname']},
+            "score": entry['score'],
+            "time": entry['time'],
+            "submitted_at": entry['submitted_at'].isoformat(),
+            "replay_uid": entry['uid']
+        } for entry in page]
+
+    async def fetchLevelBests(self, gameName: str) -> AsyncIterator[asyncpg.Record]:
+        """### Best replay of every player on every level, ordered by level_id
+
+        Args:
+            gameName (str): game name
+
+        Yields:
+            asyncpg.Record: level_id, player_uid, time and uid of the replay
+        """
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                async for best in conn.cursor(f'''
+                    SELECT level_id, player_uid, time, uid FROM game_{gameName}_best ORDER BY level_id
+                '''):
+                    yield best
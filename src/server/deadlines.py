@@ -0,0 +1,58 @@
+import contextlib
+import time
+from contextvars import ContextVar
+from typing import Iterator, Optional
+
+# Monotonic time the current request has to be answered by, None outside of requests
+current: ContextVar[Optional[float]] = ContextVar('deadline', default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    """Raised when the current request ran out of time before starting more work
+    """
+
+
+@contextlib.contextmanager
+def within(seconds: Optional[float]) -> Iterator[None]:
+    """Give the work done inside, and the tasks it starts, a deadline seconds from now
+
+    A deadline already set and sooner is kept.
+    """
+    if seconds is None:
+        yield
+        return
+    deadline = time.monotonic() + seconds
+    if (outer := current.get()) is not None:
+        deadline = min(deadline, outer)
+    token = current.set(deadline)
+    try:
+        yield
+    finally:
+        current.reset(token)
+
+@contextlib.contextmanager
+def detached(seconds: Optional[float]) -> Iterator[None]:
+    """Replace the deadline of the work done inside with one seconds from now, None for no deadline
+
+    For work that must finish even when the request it belongs to ran out of time.
+    """
+    token = current.set(None if seconds is None else time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        current.reset(token)
+
+def remaining() -> Optional[float]:
+    """Seconds left to the deadline, None without one
+
+    Raises:
+        DeadlineExceeded: when the deadline passed
+    """
+    if (deadline := current.get()) is None:
+        return None
+    if (left := deadline - time.monotonic()) <= 0:
+        raise DeadlineExceeded()
+    return left
+
+def expired() -> bool:
+    return (deadline := current.get()) is not None and deadline <= time.monotonic()
@@ -0,0 +1,160 @@
+from typing import Any, Optional
+
+import ijson
+from aiohttp import StreamReader, web
+
+from .replay import JSON, EventsDigest, headerDigest, replayColumns, toInteger, validateReplayBlock, validateReplayJson
+
+# Bytes asked from the request body per read
+readChunk = 64 * 1024
+
+headerBlocks = {
+    "player": ["uid", "nickname"],
+    "info": ["level_id", "score", "time"]
+}
+
+
+class ReplayRejected(Exception):
+    """Raised when a streamed replay can't be stored
+    """
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class LimitedReader:
+    """Async file over a request body, refuses more than max_size bytes
+
+    Content-Encoding gzip / zstd is already removed by aiohttp, so the limit applies to the decompressed replay.
+    """
+
+    def __init__(self, content: StreamReader, max_size: int):
+        self.content = content
+        self.maxSize = max_size
+        self.size: int = 0
+
+    async def read(self, size: int = -1) -> bytes:
+        try:
+            chunk = await self.content.read(readChunk if size < 0 else min(size, readChunk))
+        except web.RequestPayloadError as e:
+            raise ReplayRejected(400, "Invalid request body! ") from e
+        self.size += len(chunk)
+        if self.size > self.maxSize:
+            raise ReplayRejected(413, "Replay file too large! ")
+        return chunk
+
+
+class StreamedReplay:
+    """A replay read from a request body, the event list is only kept encoded
+    """
+
+    def __init__(self, header: dict[str, JSON], events: bytes, digest: bytes, columns: dict[str, int], count: int):
+        self.header = header
+        self.events = events
+        self.digest = digest
+        self.columns = columns
+        self.count = count
+
+
+def checkBlock(header: dict[str, JSON], name: str, player_uid: Optional[int]):
+    """Validate a header block as soon as it is complete
+    """
+    if not validateReplayBlock(header, name, headerBlocks[name]):
+        raise ReplayRejected(400, "Invalid Replay File! ")
+    if name == "player" and player_uid is not None:
+        try:
+            uid = toInteger(header["player"]["uid"])
+        except (TypeError, ValueError) as e:
+            raise ReplayRejected(400, "Invalid Replay File! ") from e
+        if uid != player_uid:
+            raise ReplayRejected(403, "Replay belongs to another player! ")
+
+async def readReplay(content: StreamReader, max_size: int, player_uid: Optional[int] = None) -> StreamedReplay:
+    """Parse a replay from a request body as it arrives
+
+    Header blocks are built as objects and validated as soon as they end,
+    events are digested and re-encoded one at a time, never held as Python objects.
+
+    Args:
+        content (StreamReader): request body
+        max_size (int): largest accepted replay in bytes
+        player_uid (Optional[int], optional): refuse replays of other players. Defaults to None.
+
+    Raises:
+        ReplayRejected: when the body is too large, not json or not a valid replay
+
+    Returns:
+        StreamedReplay: header, canonical event list, digest and typed columns of the replay
+    """
+    reader = LimitedReader(content, max_size)
+    header = ijson.ObjectBuilder()
+    events = EventsDigest(keep=True)
+    event: Optional[ijson.ObjectBuilder] = None
+    key: Optional[str] = None
+    seen: set[str] = set()
+    # Containers open inside the replay value, 1 is the event list itself
+    depth = 0
+
+    try:
+        async for prefix, kind, value in ijson.parse_async(reader, use_float=True):
+            if prefix == '':
+                if kind == 'map_key':
+                    if key in headerBlocks:
+                        checkBlock(header.value, key, player_uid)
+                    if value == 'replay' and 'replay' in seen:
+                        raise ReplayRejected(400, "Invalid Replay File! ")
+                    key = value
+                    seen.add(value)
+                    if key == 'replay':
+                        continue
+                elif kind == 'end_map':
+                    if key in headerBlocks:
+                        checkBlock(header.value, key, player_uid)
+                elif kind != 'start_map':
+                    raise ReplayRejected(400, "Invalid Replay File! ")
+                header.event(kind, value)
+                continue
+            if key != 'replay':
+                header.event(kind, value)
+                continue
+
+            if kind in ('start_map', 'start_array'):
+                depth += 1
+                if depth == 1:
+                    if kind != 'start_array':
+                        raise ReplayRejected(400, "Invalid Replay File! ")
+                    continue
+                if depth == 2:
+                    event = ijson.ObjectBuilder()
+                event.event(kind, value)
+            elif kind in ('end_map', 'end_array'):
+                depth -= 1
+                if depth == 0:
+                    continue
+                event.event(kind, value)
+                if depth == 1:
+                    events.update(event.value)
+                    event = None
+            elif depth == 0:
+                raise ReplayRejected(400, "Invalid Replay File! ")
+            elif depth == 1:
+                events.update(value)
+            else:
+                event.event(kind, value)
+    except ijson.JSONError as e:
+        raise ReplayRejected(415, "Replay file must be in json format! ") from e
+
+    replayHeader: dict[str, Any] = header.value
+    if not validateReplayJson(replayHeader | {"replay": []}) or 'replay' not in seen:
+        raise ReplayRejected(400, "Invalid Replay File! ")
+    if (columns := replayColumns(replayHeader)) is None:
+        raise ReplayRejected(400, "Invalid Replay File! ")
+    return StreamedReplay(
+        replayHeader,
+        events.events(),
+        headerDigest(replayHeader, events.digest()),
+        columns,
+        events.count
+    )
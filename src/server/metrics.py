@@ -0,0 +1,78 @@
+import os
+import time
+from typing import Optional
+
+from aiohttp import web
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
+
+# Database statements mostly take under a millisecond, finer than the prometheus defaults
+dbBuckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+hasherBuckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0)
+
+requests = Counter('score_http_requests', 'Requests answered', ['method', 'route', 'status'])
+requestSeconds = Histogram('score_http_request_duration_seconds', 'Time to answer a request', ['method', 'route'])
+jsonSeconds = Histogram('score_json_duration_seconds', 'Time reading parameters from a request and encoding its response', ['stage'], buckets=dbBuckets)
+
+statementSeconds = Histogram('score_db_statement_duration_seconds', 'Time running a prepared statement, once connected', ['statement', 'target'], buckets=dbBuckets)
+poolWaitSeconds = Histogram('score_db_pool_wait_seconds', 'Time waiting for a primary pool connection', buckets=dbBuckets)
+
+hasherWaitSeconds = Histogram('score_hasher_queue_wait_seconds', 'Time argon2 calls waited for a hashing process', ['operation'], buckets=hasherBuckets)
+hasherSeconds = Histogram('score_hasher_duration_seconds', 'Time argon2 calls ran in a hashing process', ['operation'], buckets=hasherBuckets)
+hasherRejected = Counter('score_hasher_rejected', 'argon2 calls refused by a full queue')
+
+refused = Counter('score_requests_refused', 'Requests refused before their handler, shed past the in-flight limit or rate limited', ['reason'])
+timedOut = Counter('score_requests_timed_out', 'Requests answered with 503 after running out of time', ['route'])
+
+cacheLookups = Counter('score_cache_lookups', 'Cache lookups by outcome, hit ratio is hit over all of them', ['cache', 'result'])
+
+
+def statementName(name: str) -> str:
+    # Statements are registered per game as name:game[:variant], keep one series per statement
+    return name.split(':', 1)[0]
+
+def routeName(request: web.Request) -> str:
+    # Route template rather than path, so /client/{game}/score/get is one series
+    resource = request.match_info.route.resource
+    return resource.canonical if resource is not None else 'unmatched'
+
+@web.middleware
+async def middleware(request: web.Request, handler) -> web.StreamResponse:
+    """Count requests by route and status, and time them
+    """
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        route = routeName(request)
+        requests.labels(request.method, route, status).inc()
+        requestSeconds.labels(request.method, route).observe(time.perf_counter() - start)
+
+def multiprocessDir() -> Optional[str]:
+    return os.getenv('PROMETHEUS_MULTIPROC_DIR') or None
+
+def useDirectory(directory: str):
+    """Share metrics of every worker through files in directory, set before the workers start
+
+    Files left by an earlier run are removed, their counts would add up with the new ones.
+    """
+    os.makedirs(directory, exist_ok=True)
+    for name in os.listdir(directory):
+        if name.endswith('.db'):
+            os.remove(os.path.join(directory, name))
+    os.environ['PROMETHEUS_MULTIPROC_DIR'] = directory
+
+def export() -> web.Response:
+    """Every metric in the prometheus text format, summed over the workers when they share a directory
+    """
+    if (directory := multiprocessDir()) is not None:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry, directory)
+    else:
+        registry = REGISTRY
+    return web.Response(body=generate_latest(registry), headers={'Content-Type': CONTENT_TYPE_LATEST})
@@ -0,0 +1,332 @@
+import json
+import logging
+from typing import Awaitable, Callable, Optional
+
+import asyncpg
+
+from . import codec, partitioning, replay, storage
+
+# Rows updated per statement while backfilling, keeps each transaction short
+backfillBatch = 5000
+
+Migration = Callable[[asyncpg.Connection, str], Awaitable[None]]
+
+logger = logging.getLogger(__name__)
+
+
+async def ensureTable(conn: asyncpg.Connection):
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS migrations (
+            game text NOT NULL,
+            name text NOT NULL,
+            applied_at timestamptz NOT NULL DEFAULT now(),
+            PRIMARY KEY (game, name)
+        )
+    ''')
+
+async def markApplied(conn: asyncpg.Connection, game: str):
+    """### Mark every migration as applied, for a game table created with the latest schema
+    """
+    await ensureTable(conn)
+    await conn.executemany('''
+        INSERT INTO migrations(game, name) VALUES ($1, $2) ON CONFLICT DO NOTHING
+    ''', [(game, name) for name, _ in gameMigrations])
+
+async def typedScoreColumns(conn: asyncpg.Connection, game: str):
+    """### Copy level_id, score, time and player uid out of replay_json into indexed columns
+    """
+    await conn.execute(f'''
+        ALTER TABLE game_{game}
+            ADD COLUMN IF NOT EXISTS level_id integer,
+            ADD COLUMN IF NOT EXISTS score bigint,
+            ADD COLUMN IF NOT EXISTS time integer,
+            ADD COLUMN IF NOT EXISTS player_uid integer
+    ''')
+    await conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS game_{game}_quarantine AS
+        SELECT uid, replay_json, now() AS quarantined_at FROM game_{game} WITH NO DATA
+    ''')
+
+    async def fill() -> int:
+        # Keyset over uid, rows without integer columns are moved out so none is read twice
+        last = 0
+        quarantined = 0
+        while rows := await conn.fetch(f'''
+            SELECT uid, replay_json FROM game_{game} WHERE uid > $1 AND level_id IS NULL ORDER BY uid LIMIT $2
+        ''', last, backfillBatch):
+            typed: dict[str, list[int]] = {'uid': [], 'level_id': [], 'score': [], 'time': [], 'player_uid': []}
+            invalid: list[int] = []
+            for row in rows:
+                if (columns := replay.replayColumns(json.loads(row['replay_json']))) is None:
+                    invalid.append(row['uid'])
+                    continue
+                typed['uid'].append(row['uid'])
+                for name, value in columns.items():
+                    typed[name].append(value)
+            await conn.execute(f'''
+                UPDATE game_{game} SET level_id = typed.level_id, score = typed.score, time = typed.time, player_uid = typed.player_uid
+                FROM unnest($1::integer[], $2::integer[], $3::bigint[], $4::integer[], $5::integer[])
+                    AS typed(uid, level_id, score, time, player_uid)
+                WHERE game_{game}.uid = typed.uid
+            ''', typed['uid'], typed['level_id'], typed['score'], typed['time'], typed['player_uid'])
+            if invalid:
+                await conn.execute(f'''
+                    WITH moved AS (DELETE FROM game_{game} WHERE uid = ANY($1) RETURNING uid, replay_json)
+                    INSERT INTO game_{game}_quarantine(uid, replay_json, quarantined_at) SELECT uid, replay_json, now() FROM moved
+                ''', invalid)
+                quarantined += len(invalid)
+            last = rows[-1]['uid']
+        return quarantined
+
+    quarantined = await fill()
+    # Rows written meanwhile by servers not storing the columns yet are filled under the lock
+    async with conn.transaction():
+        await conn.execute(f'LOCK TABLE game_{game} IN ACCESS EXCLUSIVE MODE')
+        quarantined += await fill()
+        await conn.execute(f'''
+            ALTER TABLE game_{game}
+                ALTER COLUMN level_id SET NOT NULL,
+                ALTER COLUMN score SET NOT NULL,
+                ALTER COLUMN time SET NOT NULL,
+                ALTER COLUMN player_uid SET NOT NULL
+        ''')
+    if quarantined:
+        logger.warning(
+            f"Moved {quarantined} replays of {game} without integer level_id, score, time or player uid to game_{game}_quarantine"
+        )
+    await conn.execute(f'''
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS game_{game}_leaderboard
+        ON game_{game} (level_id, time, uid) INCLUDE (player_uid, score)
+    ''')
+
+async def replayDigest(conn: asyncpg.Connection, game: str):
+    """### Store the content digest of each replay under a unique index
+    """
+    await conn.execute(f'ALTER TABLE game_{game} ADD COLUMN IF NOT EXISTS replay_digest bytea')
+    last = 0
+    while rows := await conn.fetch(f'''
+        SELECT uid, replay_json FROM game_{game} WHERE uid > $1 ORDER BY uid LIMIT $2
+    ''', last, backfillBatch):
+        await conn.execute(f'''
+            UPDATE game_{game} SET replay_digest = digests.digest
+            FROM unnest($1::integer[], $2::bytea[]) AS digests(uid, digest)
+            WHERE game_{game}.uid = digests.uid
+        ''', [row['uid'] for row in rows], [replay.replayDigest(json.loads(row['replay_json'])) for row in rows])
+        last = rows[-1]['uid']
+    # Duplicates that slipped past the old containment check keep no digest, the first copy holds it
+    await conn.execute(f'''
+        UPDATE game_{game} SET replay_digest = NULL WHERE uid IN (
+            SELECT uid FROM (
+                SELECT uid, row_number() OVER (PARTITION BY replay_digest ORDER BY uid) AS copy
+                FROM game_{game} WHERE replay_digest IS NOT NULL
+            ) AS digests WHERE copy > 1
+        )
+    ''')
+    await conn.execute(f'''
+        CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS game_{game}_digest ON game_{game} (replay_digest)
+    ''')
+
+async def trainDictionary(conn: asyncpg.Connection, game: str, samples: list[bytes]) -> Optional[int]:
+    """### Train and store a zstd dictionary for the replays of a game
+
+    Args:
+        conn (asyncpg.Connection): database connection
+        game (str): game name
+        samples (list[bytes]): encoded event lists
+
+    Returns:
+        Optional[int]: uid of the dictionary, None with too few samples
+    """
+    if (dictionary := storage.ReplayStorage.train(samples)) is None:
+        return None
+    await storage.ensureTable(conn)
+    return await conn.fetchval('''
+        INSERT INTO replay_dictionaries(game, dictionary) VALUES ($1, $2) RETURNING uid
+    ''', game, dictionary)
+
+async def compactReplays(conn: asyncpg.Connection, game: str):
+    """### Split replay_json into a json header and a zstd compressed event payload
+    """
+    await conn.execute(f'''
+        ALTER TABLE game_{game}
+            ADD COLUMN IF NOT EXISTS replay_header json,
+            ADD COLUMN IF NOT EXISTS replay_events bytea
+    ''')
+    replays = storage.ReplayStorage()
+    await storage.ensureTable(conn)
+    await replays.load(conn)
+    if game not in replays.current:
+        samples = await conn.fetch(f'''
+            SELECT replay_json -> 'replay' AS events FROM game_{game} ORDER BY random() LIMIT $1
+        ''', storage.dictionaryMaxSamples)
+        if (uid := await trainDictionary(conn, game, [sample['events'].encode() for sample in samples])) is not None:
+            await replays.load(conn, [uid])
+
+    async def convert() -> int:
+        rows = await conn.fetch(f'''
+            SELECT uid, replay_json FROM game_{game} WHERE replay_header IS NULL ORDER BY uid LIMIT $1
+        ''', backfillBatch)
+        headers: list[str] = []
+        payloads: list[bytes] = []
+        for row in rows:
+            replayJson = json.loads(row['replay_json'])
+            events = replayJson.pop('replay', [])
+            headers.append(codec.dumpsText(replayJson))
+            payloads.append(replays.encodeEvents(game, codec.dumps(events)))
+        await conn.execute(f'''
+            UPDATE game_{game} SET replay_header = converted.header, replay_events = converted.events
+            FROM unnest($1::integer[], $2::json[], $3::bytea[]) AS converted(uid, header, events)
+            WHERE game_{game}.uid = converted.uid
+        ''', [row['uid'] for row in rows], headers, payloads)
+        return len(rows)
+
+    while await convert():
+        pass
+    # Rows written meanwhile by servers still storing replay_json are converted under the lock
+    async with conn.transaction():
+        await conn.execute(f'LOCK TABLE game_{game} IN ACCESS EXCLUSIVE MODE')
+        while await convert():
+            pass
+        await conn.execute(f'''
+            ALTER TABLE game_{game}
+                ALTER COLUMN replay_header SET NOT NULL,
+                ALTER COLUMN replay_events SET NOT NULL,
+                ALTER COLUMN replay_events SET STORAGE EXTERNAL,
+                DROP COLUMN replay_json
+        ''')
+
+async def submittedAt(conn: asyncpg.Connection, game: str):
+    """### Record when replays were submitted and index the score and window leaderboards
+
+    Replays stored before this migration all get the time it ran.
+    """
+    await conn.execute(f'ALTER TABLE game_{game} ADD COLUMN IF NOT EXISTS submitted_at timestamptz NOT NULL DEFAULT now()')
+    await conn.execute(f'''
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS game_{game}_score
+        ON game_{game} (level_id, score DESC, uid) INCLUDE (player_uid, time)
+    ''')
+    await conn.execute(f'''
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS game_{game}_submitted ON game_{game} (level_id, submitted_at)
+    ''')
+
+async def createBestTable(conn: asyncpg.Connection, game: str):
+    """### Table of the best replay of each player on each level, kept current by a trigger on the game table
+
+    Its size follows players times levels, not submissions, so leaderboards of player bests never scan every replay.
+    """
+    await conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS game_{game}_best (
+            level_id integer NOT NULL,
+            player_uid integer NOT NULL,
+            uid integer NOT NULL,
+            time integer NOT NULL,
+            score bigint NOT NULL,
+            nickname text,
+            submitted_at timestamptz NOT NULL,
+            PRIMARY KEY (level_id, player_uid)
+        )
+    ''')
+    await conn.execute(f'''
+        CREATE INDEX IF NOT EXISTS game_{game}_best_leaderboard ON game_{game}_best (level_id, time, uid)
+    ''')
+    await conn.execute(f'''
+        CREATE OR REPLACE FUNCTION game_{game}_best_submitted() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO game_{game}_best(level_id, player_uid, uid, time, score, nickname, submitted_at)
+            VALUES (NEW.level_id, NEW.player_uid, NEW.uid, NEW.time, NEW.score, NEW.replay_header -> 'player' ->> 'nickname', NEW.submitted_at)
+            {bestUpsert(game)};
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    ''')
+    await conn.execute(f'DROP TRIGGER IF EXISTS game_{game}_best ON game_{game}')
+    await conn.execute(f'''
+        CREATE TRIGGER game_{game}_best AFTER INSERT ON game_{game}
+        FOR EACH ROW EXECUTE FUNCTION game_{game}_best_submitted()
+    ''')
+
+def bestUpsert(game: str) -> str:
+    """ON CONFLICT clause keeping the faster replay, the older one on equal times
+    """
+    return f'''
+        ON CONFLICT (level_id, player_uid) DO UPDATE SET
+            uid = EXCLUDED.uid, time = EXCLUDED.time, score = EXCLUDED.score,
+            nickname = EXCLUDED.nickname, submitted_at = EXCLUDED.submitted_at
+        WHERE (EXCLUDED.time, EXCLUDED.uid) < (game_{game}_best.time, game_{game}_best.uid)
+    '''
+
+async def fillBestTable(conn: asyncpg.Connection, game: str):
+    """### Upsert the best replay of every player from the game table
+    """
+    await conn.execute(f'''
+        INSERT INTO game_{game}_best(level_id, player_uid, uid, time, score, nickname, submitted_at)
+        SELECT DISTINCT ON (level_id, player_uid)
+            level_id, player_uid, uid, time, score, replay_header -> 'player' ->> 'nickname', submitted_at
+        FROM game_{game}
+        ORDER BY level_id, player_uid, time, uid
+        {bestUpsert(game)}
+    ''')
+
+async def rebuildBestTable(conn: asyncpg.Connection, game: str):
+    """### Refill the best replay table from scratch
+
+    Submissions wait on the table lock until the rebuild commits, then update it as usual.
+    """
+    async with conn.transaction():
+        await conn.execute(f'TRUNCATE game_{game}_best')
+        await fillBestTable(conn, game)
+
+async def bestTable(conn: asyncpg.Connection, game: str):
+    """### Create the best replay table, the trigger goes in first so no submission is missed while filling
+    """
+    await createBestTable(conn, game)
+    await fillBestTable(conn, game)
+
+async def digestRelease(conn: asyncpg.Connection, game: str):
+    """### Release the digest of deleted rows of month partitioned games, and drop the claims left so far
+    """
+    if await partitioning.layoutOf(conn, f'game_{game}') != 'month':
+        return
+    await partitioning.createDigestRelease(conn, game, f'game_{game}')
+    if released := await partitioning.releaseDigests(conn, game):
+        logger.warning(f"Released {released} digests of {game} no replay held")
+
+gameMigrations: list[tuple[str, Migration]] = [
+    ('typed-score-columns', typedScoreColumns),
+    ('replay-digest', replayDigest),
+    ('compact-replays', compactReplays),
+    ('submitted-at', submittedAt),
+    ('best-table', bestTable),
+    ('digest-release', digestRelease),
+]
+
+async def pendingGames(conn: asyncpg.Connection, games: list[str]) -> list[str]:
+    """### Games whose table is missing migrations
+    """
+    await ensureTable(conn)
+    applied = await conn.fetch('''
+        SELECT game, count(*) AS applied FROM migrations WHERE name = ANY($1) GROUP BY game
+    ''', [name for name, _ in gameMigrations])
+    counts = {row['game']: row['applied'] for row in applied}
+    return [game for game in games if counts.get(game, 0) < len(gameMigrations)]
+
+async def migrateGame(conn: asyncpg.Connection, game: str) -> list[str]:
+    """### Apply pending migrations to a game table
+
+    Args:
+        conn (asyncpg.Connection): connection outside of a transaction
+        game (str): game name
+
+    Returns:
+        list[str]: names of the migrations applied
+    """
+    await ensureTable(conn)
+    applied = {row['name'] for row in await conn.fetch('SELECT name FROM migrations WHERE game = $1', game)}
+    done: list[str] = []
+    for name, migration in gameMigrations:
+        if name in applied:
+            continue
+        await migration(conn, game)
+        await conn.execute('INSERT INTO migrations(game, name) VALUES ($1, $2)', game, name)
+        done.append(name)
+    return done
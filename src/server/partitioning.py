@@ -0,0 +1,299 @@
+import logging
+from datetime import datetime, timezone
+from typing import Optional
+
+import asyncpg
+
+from . import migrations
+
+logger = logging.getLogger(__name__)
+
+# Partition layouts of a game table: hash of level_id, or range of submission month
+layouts = ('level', 'month')
+hashPartitions = 16
+# Months partitioned ahead of the current one
+monthsAhead = 2
+# Rows copied per statement while partitioning online
+copyBatch = 5000
+
+# Indexes of a game table, renamed along with it
+indexSuffixes = ('pkey', 'leaderboard', 'score', 'submitted', 'digest')
+columns = 'uid, user_uid, replay_header, replay_events, replay_digest, level_id, score, time, player_uid, submitted_at'
+
+
+def monthStart(year: int, month: int) -> datetime:
+    # Normalizes month overflow, monthStart(2026, 13) is January 2027
+    return datetime(year + (month - 1) // 12, (month - 1) % 12 + 1, 1, tzinfo=timezone.utc)
+
+async def layoutOf(conn: asyncpg.Connection, table: str) -> Optional[str]:
+    """### Partition layout of a table
+
+    Returns:
+        Optional[str]: 'level', 'month', or None for a plain table
+    """
+    strategy = await conn.fetchval('SELECT partstrat::text FROM pg_partitioned_table WHERE partrelid = to_regclass($1)', table)
+    return {'h': 'level', 'r': 'month'}.get(strategy)
+
+async def createTable(
+    conn: asyncpg.Connection, game: str, table: str, layout: Optional[str] = None,
+    partitions: int = hashPartitions, sequence: Optional[str] = None, since: Optional[datetime] = None
+):
+    """### Create a game table with its indexes, partitioned or not
+
+    Unique indexes of a partitioned table have to hold the partition key.
+    Equal digests mean equal level ids, so the level layout keeps digests unique per table,
+    the month layout keeps them unique through game_{game}_digests.
+
+    Args:
+        conn (asyncpg.Connection): connection inside a transaction
+        game (str): game name
+        table (str): table name, game_{game} unless partitioning online
+        layout (Optional[str], optional): 'level' or 'month'. Defaults to a plain table.
+        partitions (int, optional): hash partitions of the level layout. Defaults to hashPartitions.
+        sequence (Optional[str], optional): existing sequence of replay uids. Defaults to a new one.
+        since (Optional[datetime], optional): first month partitioned with the month layout. Defaults to the current month.
+    """
+    uid = 'SERIAL NOT NULL' if sequence is None else f"integer NOT NULL DEFAULT nextval('{sequence}')"
+    key, partitionBy = {
+        None: ('uid', ''),
+        'level': ('uid, level_id', 'PARTITION BY HASH (level_id)'),
+        'month': ('uid, submitted_at', 'PARTITION BY RANGE (submitted_at)')
+    }[layout]
+    await conn.execute(f'''
+        CREATE TABLE {table} (
+            uid {uid},
+            user_uid integer NOT NULL,
+            replay_header json NOT NULL,
+            replay_events bytea NOT NULL,
+            replay_digest bytea,
+            level_id integer NOT NULL,
+            score bigint NOT NULL,
+            time integer NOT NULL,
+            player_uid integer NOT NULL,
+            submitted_at timestamptz NOT NULL DEFAULT now(),
+            PRIMARY KEY ({key})
+        ) {partitionBy}
+    ''')
+    # Event payloads are compressed already, keep TOAST from compressing them again
+    await conn.execute(f'ALTER TABLE {table} ALTER COLUMN replay_events SET STORAGE EXTERNAL')
+    await conn.execute(f'CREATE INDEX {table}_leaderboard ON {table} (level_id, time, uid) INCLUDE (player_uid, score)')
+    await conn.execute(f'CREATE INDEX {table}_score ON {table} (level_id, score DESC, uid) INCLUDE (player_uid, time)')
+    await conn.execute(f'CREATE INDEX {table}_submitted ON {table} (level_id, submitted_at)')
+
+    if layout is None:
+        await conn.execute(f'CREATE UNIQUE INDEX {table}_digest ON {table} (replay_digest)')
+    elif layout == 'level':
+        await conn.execute(f'CREATE UNIQUE INDEX {table}_digest ON {table} (replay_digest, level_id)')
+        for remainder in range(partitions):
+            await conn.execute(f'''
+                CREATE TABLE {table}_p{remainder} PARTITION OF {table}
+                FOR VALUES WITH (MODULUS {partitions}, REMAINDER {remainder})
+            ''')
+    else:
+        await conn.execute(f'CREATE INDEX {table}_digest ON {table} (replay_digest)')
+        await createDigestTable(conn, game, table)
+        # Catches rows of months nobody partitioned yet
+        await conn.execute(f'CREATE TABLE {table}_default PARTITION OF {table} DEFAULT')
+        await ensureMonths(conn, table, since)
+
+async def createDigestTable(conn: asyncpg.Connection, game: str, table: str):
+    """### Digests of a month partitioned table, a replay whose digest is taken is skipped like ON CONFLICT DO NOTHING
+
+    Deleting a row releases its digest. Dropped or truncated partitions leave their claims behind,
+    releaseDigests drops those.
+    """
+    await conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS game_{game}_digests (
+            replay_digest bytea NOT NULL PRIMARY KEY
+        )
+    ''')
+    await conn.execute(f'''
+        CREATE OR REPLACE FUNCTION game_{game}_digest_claim() RETURNS trigger AS $$
+        BEGIN
+            IF NEW.replay_digest IS NULL THEN
+                RETURN NEW;
+            END IF;
+            INSERT INTO game_{game}_digests(replay_digest) VALUES (NEW.replay_digest) ON CONFLICT DO NOTHING;
+            IF NOT FOUND THEN
+                RETURN NULL;
+            END IF;
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+    ''')
+    await conn.execute(f'''
+        CREATE TRIGGER {table}_digest BEFORE INSERT ON {table}
+        FOR EACH ROW EXECUTE FUNCTION game_{game}_digest_claim()
+    ''')
+    await createDigestRelease(conn, game, table)
+
+async def createDigestRelease(conn: asyncpg.Connection, game: str, table: str):
+    await conn.execute(f'''
+        CREATE OR REPLACE FUNCTION game_{game}_digest_release() RETURNS trigger AS $$
+        BEGIN
+            DELETE FROM game_{game}_digests WHERE replay_digest = OLD.replay_digest;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    ''')
+    await conn.execute(f'DROP TRIGGER IF EXISTS {table}_digest_release ON {table}')
+    await conn.execute(f'''
+        CREATE TRIGGER {table}_digest_release AFTER DELETE ON {table}
+        FOR EACH ROW WHEN (OLD.replay_digest IS NOT NULL) EXECUTE FUNCTION game_{game}_digest_release()
+    ''')
+
+async def releaseDigests(conn: asyncpg.Connection, game: str, digests: Optional[list[bytes]] = None) -> int:
+    """### Drop the claims no row of the game holds, left by dropped or truncated partitions
+
+    Claims of rows still being inserted aren't visible yet, and are kept.
+
+    Args:
+        conn (asyncpg.Connection): database connection
+        game (str): game name
+        digests (Optional[list[bytes]], optional): claims to check. Defaults to all of them.
+
+    Returns:
+        int: claims dropped, 0 for games without a digest table
+    """
+    if await conn.fetchval('SELECT to_regclass($1)', f'game_{game}_digests') is None:
+        return 0
+    result = await conn.execute(f'''
+        DELETE FROM game_{game}_digests AS claims
+        WHERE ($1::bytea[] IS NULL OR claims.replay_digest = ANY($1))
+        AND NOT EXISTS (SELECT 1 FROM game_{game} WHERE replay_digest = claims.replay_digest)
+    ''', digests)
+    return int(result.split()[-1])
+
+async def ensureMonths(conn: asyncpg.Connection, table: str, since: Optional[datetime] = None) -> list[str]:
+    """### Create the month partitions from a month up to monthsAhead after the current one
+
+    Args:
+        conn (asyncpg.Connection): database connection
+        table (str): month partitioned table
+        since (Optional[datetime], optional): first month. Defaults to the current month.
+
+    Raises:
+        asyncpg.exceptions.CheckViolationError: when the default partition already holds rows of a missing month
+
+    Returns:
+        list[str]: partitions created
+    """
+    now = datetime.now(timezone.utc)
+    since = since or now
+    created: list[str] = []
+    month = monthStart(since.year, since.month)
+    last = monthStart(now.year, now.month + monthsAhead)
+    while month <= last:
+        following = monthStart(month.year, month.month + 1)
+        partition = f'{table}_y{month.year:04d}m{month.month:02d}'
+        if await conn.fetchval('SELECT to_regclass($1)', partition) is None:
+            await conn.execute(f'''
+                CREATE TABLE {partition} PARTITION OF {table}
+                FOR VALUES FROM ('{month.isoformat()}') TO ('{following.isoformat()}')
+            ''')
+            created.append(partition)
+        month = following
+    return created
+
+async def maintain(conn: asyncpg.Connection, games: list[str]):
+    """### Partition the coming months of every month partitioned game, logging instead of failing
+    """
+    # One lookup for every game, startup shouldn't grow a query per game
+    monthly = [row['relname'].removeprefix('game_') for row in await conn.fetch('''
+        SELECT relname FROM pg_partitioned_table JOIN pg_class ON pg_class.oid = partrelid
+        WHERE partstrat = 'r' AND relname = ANY($1)
+    ''', [f'game_{game}' for game in games])]
+    for game in monthly:
+        try:
+            if created := await ensureMonths(conn, f'game_{game}'):
+                logger.info(f"Created partitions {', '.join(created)}")
+        except asyncpg.exceptions.DuplicateTableError:
+            # Another worker starting at the same time got there first
+            pass
+        except asyncpg.exceptions.CheckViolationError:
+            logger.warning(f"Default partition of game_{game} holds rows of a month without a partition, move them out to partition it")
+
+async def renameTable(conn: asyncpg.Connection, table: str, name: str):
+    """### Rename a game table along with its indexes and partitions
+    """
+    await conn.execute(f'ALTER TABLE {table} RENAME TO {name}')
+    for suffix in indexSuffixes:
+        await conn.execute(f'ALTER INDEX IF EXISTS {table}_{suffix} RENAME TO {name}_{suffix}')
+    for partition in await conn.fetch('''
+        SELECT relname FROM pg_inherits JOIN pg_class ON pg_class.oid = inhrelid WHERE inhparent = to_regclass($1)
+    ''', name):
+        suffix = partition['relname'].removeprefix(table)
+        await conn.execute(f'ALTER TABLE {partition["relname"]} RENAME TO {name}{suffix}')
+
+async def partitionGame(conn: asyncpg.Connection, game: str, layout: str, partitions: int = hashPartitions) -> int:
+    """### Move a plain game table into a partitioned one while it keeps taking submissions
+
+    Submissions are mirrored into the new table by a trigger while the existing rows are copied over in batches,
+    then both tables swap names in one short transaction. The old table is kept as game_{game}_unpartitioned.
+
+    Args:
+        conn (asyncpg.Connection): connection outside of a transaction
+        game (str): game name
+        layout (str): 'level' or 'month'
+        partitions (int, optional): hash partitions of the level layout. Defaults to hashPartitions.
+
+    Raises:
+        ValueError: when the table is partitioned already or has pending migrations
+
+    Returns:
+        int: rows copied
+    """
+    table = f'game_{game}'
+    target = f'game_{game}_partitioned'
+    if await layoutOf(conn, table) is not None:
+        raise ValueError(f"{table} is partitioned already")
+    if await migrations.pendingGames(conn, [game]):
+        raise ValueError(f"{table} needs migrating first")
+    sequence = await conn.fetchval('SELECT pg_get_serial_sequence($1, $2)', table, 'uid')
+
+    if await conn.fetchval('SELECT to_regclass($1)', target) is None:
+        async with conn.transaction():
+            since = await conn.fetchval(f'SELECT min(submitted_at) FROM {table}')
+            await createTable(conn, game, target, layout, partitions, sequence, since)
+            # Waits for running submissions, every later one is mirrored
+            await conn.execute(f'''
+                CREATE OR REPLACE FUNCTION {target}_mirror() RETURNS trigger AS $$
+                BEGIN
+                    INSERT INTO {target}({columns}) VALUES ({', '.join('NEW.' + column for column in columns.split(', '))})
+                    ON CONFLICT DO NOTHING;
+                    RETURN NULL;
+                END
+                $$ LANGUAGE plpgsql
+            ''')
+            await conn.execute(f'''
+                CREATE TRIGGER {target}_mirror AFTER INSERT ON {table}
+                FOR EACH ROW EXECUTE FUNCTION {target}_mirror()
+            ''')
+
+    copied = 0
+    last = 0
+    while (batch := await conn.fetchrow(f'''
+        WITH batch AS (
+            SELECT {columns} FROM {table} WHERE uid > $1 ORDER BY uid LIMIT $2
+        ), copied AS (
+            INSERT INTO {target}({columns}) SELECT {columns} FROM batch ON CONFLICT DO NOTHING
+        )
+        SELECT max(uid) AS last, count(*) AS rows FROM batch
+    ''', last, copyBatch))['rows']:
+        copied += batch['rows']
+        last = batch['last']
+
+    async with conn.transaction():
+        await conn.execute(f'LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE')
+        await conn.execute(f'DROP TRIGGER {target}_mirror ON {table}')
+        await conn.execute(f'DROP TRIGGER IF EXISTS game_{game}_best ON {table}')
+        await renameTable(conn, table, f'game_{game}_unpartitioned')
+        await renameTable(conn, target, table)
+        if layout == 'month':
+            await conn.execute(f'ALTER TRIGGER {target}_digest ON {table} RENAME TO {table}_digest')
+            await conn.execute(f'ALTER TRIGGER {target}_digest_release ON {table} RENAME TO {table}_digest_release')
+        await conn.execute(f'DROP FUNCTION {target}_mirror()')
+        # Dropping the old table must not take the uid sequence with it
+        await conn.execute(f'ALTER SEQUENCE {sequence} OWNED BY {table}.uid')
+        await migrations.createBestTable(conn, game)
+    return copied
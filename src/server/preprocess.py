@@ -1,27 +1,39 @@
+import asyncio
 import functools
-import json
+import math
+import time
 from typing import Any, Awaitable, Callable, Optional, Protocol
 
+import asyncpg
 from aiohttp import web
 
-from .setup import postgres_key, redis_key
+from . import codec, deadlines, metrics
+from .aioargon2 import HasherBusyError
+from .ratelimit import exemptRoutes
+from .setup import config_key, leaderboard_key, limiter_key, postgres_key, rankings_key, redis_key, replays_key, sessions_key, submissions_key
+
+# Seconds a request has to be answered in, unless its route sets another
+defaultTimeout = 10.0
 
 
 class Response:
     status: int = 200
     message: str = ''
     body: Optional[dict[str, Any]] = None
+    headers: Optional[dict[str, str]] = None
 
     def __init__(self, 
             status: int = 200, 
             message: str = 'Success. ', 
-            body: Optional[dict[str, Any]] = None
+            body: Optional[dict[str, Any]] = None,
+            headers: Optional[dict[str, str]] = None
         ):
         self.status = status
         self.message = message
         self.body = body
+        self.headers = headers
 
-    def to_json_respond(self) -> web.Response:
+    def to_json(self) -> dict[str, Any]:
         response_body = {
             'status': self.status,
             'message': self.message,
@@ -31,11 +43,56 @@ class Response:
                 response_body |= self.body
             else:
                 response_body['payload'] = self.body
-        return web.json_response(
-            response_body, 
-            status=self.status
+        return response_body
+
+    def encode(self) -> bytes:
+        return codec.dumps(self.to_json())
+
+    def to_json_respond(self) -> web.Response:
+        return web.Response(
+            body=self.encode(), 
+            status=self.status, 
+            headers=self.headers, 
+            content_type='application/json'
+        )
+
+class EncodedResponse(Response):
+    """Response with an already serialized json body
+    """
+    encoded: bytes = b''
+
+    def __init__(self, encoded: bytes, status: int = 200, headers: Optional[dict[str, str]] = None):
+        super().__init__(status=status, headers=headers)
+        self.encoded = encoded
+
+    def to_json_respond(self) -> web.Response:
+        return web.Response(
+            body=self.encoded, 
+            status=self.status, 
+            headers=self.headers, 
+            content_type='application/json'
         )
 
+class NotModifiedResponse(Response):
+    """304 answer to a matching If-None-Match
+    """
+
+    def __init__(self, etag: str):
+        super().__init__(status=304, headers={"ETag": etag})
+
+    def to_json_respond(self) -> web.Response:
+        return web.Response(status=self.status, headers=self.headers)
+
+def etag_matches(request: web.Request, etag: Optional[str]) -> bool:
+    """Whether If-None-Match of the request lists etag, compared weakly
+    """
+    if etag is None or not (header := request.headers.get('If-None-Match')):
+        return False
+    if header.strip() == '*':
+        return True
+    strip = lambda tag: tag.strip().removeprefix('W/')
+    return strip(etag) in {strip(tag) for tag in header.split(',')}
+
 class RequestProcessor(Protocol):
     def __call__(self, request: web.Request, *args: Any, **kwds: Any) -> Awaitable[Response]:
         ...
@@ -43,6 +100,7 @@ class RequestProcessor(Protocol):
 async def extract_params(
         request: web.Request, *,
         query_param: Optional[list[str]] = None,
+        query_default: Optional[dict[str, str]] = None,
         body_param: Optional[list[str]] = None,
         url_match: Optional[list[str]] = None
     ) -> dict[str, Any]:
@@ -51,6 +109,7 @@ async def extract_params(
     Args:
         request (web.Request): request object
         query_param (list[str], optional): list of query parameters to parse. Defaults to None.
+        query_default (dict[str, str], optional): optional query parameters with their default values. Defaults to None.
         body_param (list[str], optional): list of parameters extracts from the json body. Defaults to None.
         url_match (list[str], optional): list of parameters from the url variables. Defaults to None.
 
@@ -71,30 +130,34 @@ async def extract_params(
             except KeyError as e:
                 raise web.HTTPBadRequest(
                     content_type="application/json", 
-                    text=json.dumps({
+                    text=codec.dumpsText({
                         "status": 400,
                         "message": f"Missing parameter: {str(e)}! "
                     })
                 ) from e
 
+    if query_default:
+        for param, default in query_default.items():
+            params[param] = request.rel_url.query.get(param, default)
+
     if body_param:
         try:
-            body = await request.json()
+            body = await request.json(loads=codec.loads)
             for param in body_param:
                 value = body[param]
                 params[param] = value
         except KeyError as e:
             raise web.HTTPBadRequest(
                 content_type="application/json",
-                text=json.dumps({
+                text=codec.dumpsText({
                         "status": 400,
                         "message": f"Missing payload: {str(e)}! "
                 })
             ) from e
-        except json.decoder.JSONDecodeError as e:
+        except codec.DecodeError as e:
             raise web.HTTPBadRequest(
                 content_type="application/json",
-                text=json.dumps({
+                text=codec.dumpsText({
                         "status": 400,
                         "message": "Invalid request body! "
                 })
@@ -108,30 +171,72 @@ async def extract_params(
 
 def request_to_params(
         query_param: Optional[list[str]] = None,
+        query_default: Optional[dict[str, str]] = None,
         body_param: Optional[list[str]] = None,
-        url_match: Optional[list[str]] = None
+        url_match: Optional[list[str]] = None,
+        timeout: Optional[float] = defaultTimeout
     ):
     """Parse request parameters from the request and put them into the function parameters
 
+    The request is answered with 503 once it ran longer than timeout,
+    the database and hashing calls it makes wait no longer than the time it has left.
+
     Args:
         query_param (Optional[list[str]], optional): list of query parameters to parse. Defaults to None.
+        query_default (Optional[dict[str, str]], optional): optional query parameters with their default values. Defaults to None.
         body_param (Optional[list[str]], optional): list of parameters extracts from the json body. Defaults to None.
         url_match (Optional[list[str]], optional): list of parameters from the url variables. Defaults to None.
+        timeout (Optional[float], optional): seconds the request has to be answered in, None for no limit. Defaults to defaultTimeout.
     """
     def decorator(func: RequestProcessor) -> Callable[[web.Request], Awaitable[web.Response]]:
         @functools.wraps(func)
         async def wrapper(request: web.Request, *args, **kwargs) -> web.Response:
-            params = await extract_params(
-                request, 
-                query_param=query_param, 
-                body_param=body_param, 
-                url_match=url_match
-            )
-            result = await func(request, *args, **kwargs, **params)
-            return result.to_json_respond()
+            try:
+                with deadlines.within(timeout):
+                    async with asyncio.timeout(timeout):
+                        start = time.perf_counter()
+                        params = await extract_params(
+                            request, 
+                            query_param=query_param, 
+                            query_default=query_default, 
+                            body_param=body_param, 
+                            url_match=url_match
+                        )
+                        metrics.jsonSeconds.labels('params').observe(time.perf_counter() - start)
+                        result = await func(request, *args, **kwargs, **params)
+            except (TimeoutError, asyncpg.exceptions.QueryCanceledError) as e:
+                # Out of time here, in the pool, in a query or in the hashing queue
+                metrics.timedOut.labels(metrics.routeName(request)).inc()
+                raise web.HTTPServiceUnavailable(
+                    content_type="application/json",
+                    headers={"Retry-After": "1"},
+                    text=codec.dumpsText({
+                        "status": 503,
+                        "message": "Request timed out, try again later! "
+                    })
+                ) from e
+            except HasherBusyError as e:
+                raise web.HTTPServiceUnavailable(
+                    content_type="application/json",
+                    headers={"Retry-After": "1"},
+                    text=codec.dumpsText({
+                        "status": 503,
+                        "message": "Server busy, try again later! "
+                    })
+                ) from e
+            start = time.perf_counter()
+            response = result.to_json_respond()
+            metrics.jsonSeconds.labels('encode').observe(time.perf_counter() - start)
+            return response
         return wrapper
     return decorator
 
+def with_config(func: RequestProcessor) -> RequestProcessor:
+    @functools.wraps(func)
+    async def wrapper(request: web.Request, *args, **kwargs) -> Response:
+        return await func(request, *args, **kwargs, config=request.app[config_key])
+    return wrapper
+
 def with_database(func: RequestProcessor) -> RequestProcessor:
     @functools.wraps(func)
     async def wrapper(request: web.Request, *args, **kwargs) -> Response:
@@ -143,3 +248,105 @@ def with_cache(func: RequestProcessor) -> RequestProcessor:
     async def wrapper(request: web.Request, *args, **kwargs) -> Response:
         return await func(request, *args, **kwargs, cache=request.app[redis_key])
     return wrapper
+
+def with_leaderboard(func: RequestProcessor) -> RequestProcessor:
+    @functools.wraps(func)
+    async def wrapper(request: web.Request, *args, **kwargs) -> Response:
+        return await func(request, *args, **kwargs, leaderboard=request.app[leaderboard_key])
+    return wrapper
+
+def with_replays(func: RequestProcessor) -> RequestProcessor:
+    @functools.wraps(func)
+    async def wrapper(request: web.Request, *args, **kwargs) -> Response:
+        return await func(request, *args, **kwargs, replays=request.app[replays_key])
+    return wrapper
+
+def with_limiter(func: RequestProcessor) -> RequestProcessor:
+    @functools.wraps(func)
+    async def wrapper(request: web.Request, *args, **kwargs) -> Response:
+        return await func(request, *args, **kwargs, limiter=request.app[limiter_key])
+    return wrapper
+
+def with_rankings(func: RequestProcessor) -> RequestProcessor:
+    @functools.wraps(func)
+    async def wrapper(request: web.Request, *args, **kwargs) -> Response:
+        return await func(request, *args, **kwargs, rankings=request.app[rankings_key])
+    return wrapper
+
+def with_sessions(func: RequestProcessor) -> RequestProcessor:
+    @functools.wraps(func)
+    async def wrapper(request: web.Request, *args, **kwargs) -> Response:
+        return await func(request, *args, **kwargs, sessions=request.app[sessions_key])
+    return wrapper
+
+def with_submissions(func: RequestProcessor) -> RequestProcessor:
+    # None unless the write-behind queue is enabled
+    @functools.wraps(func)
+    async def wrapper(request: web.Request, *args, **kwargs) -> Response:
+        return await func(request, *args, **kwargs, submissions=request.app.get(submissions_key))
+    return wrapper
+
+def bearer_token(request: web.Request) -> Optional[str]:
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not token:
+        return None
+    return token.strip()
+
+def client_identity(request: web.Request) -> str:
+    """Session of a correctly signed token, checked without a lookup, or the address of the client
+    """
+    if (token := bearer_token(request)) is not None and (session_id := request.app[sessions_key].verify(token)) is not None:
+        return f'session:{session_id}'
+    return f'addr:{request.remote}'
+
+@web.middleware
+async def admission(request: web.Request, handler) -> web.StreamResponse:
+    """Shed requests past the in-flight limit of the worker, and limit the rate of each client on each route
+    """
+    limiter = request.app.get(limiter_key)
+    resource = request.match_info.route.resource
+    if limiter is None or resource is None or resource.canonical in exemptRoutes:
+        return await handler(request)
+    if limiter.overloaded():
+        metrics.refused.labels('shed').inc()
+        raise web.HTTPServiceUnavailable(
+            content_type="application/json",
+            headers={"Retry-After": "1"},
+            text=codec.dumpsText({
+                "status": 503,
+                "message": "Server busy, try again later! "
+            })
+        )
+    limiter.inflight += 1
+    try:
+        if (wait := await limiter.admit(client_identity(request), resource.canonical)) > 0:
+            metrics.refused.labels('rate_limited').inc()
+            raise web.HTTPTooManyRequests(
+                content_type="application/json",
+                headers={"Retry-After": str(math.ceil(wait))},
+                text=codec.dumpsText({
+                    "status": 429,
+                    "message": "Too many requests, slow down! "
+                })
+            )
+        return await handler(request)
+    finally:
+        limiter.inflight -= 1
+
+def require_session(func: RequestProcessor) -> RequestProcessor:
+    """Reject requests without a valid session token, put the session into the function parameters
+    """
+    @functools.wraps(func)
+    async def wrapper(request: web.Request, *args, **kwargs) -> Response:
+        token = bearer_token(request)
+        if token is None or (session := await request.app[sessions_key].validate(token)) is None:
+            raise web.HTTPUnauthorized(
+                content_type="application/json",
+                headers={"WWW-Authenticate": "Bearer"},
+                text=codec.dumpsText({
+                    "status": 401,
+                    "message": "Invalid or expired session! "
+                })
+            )
+        return await func(request, *args, **kwargs, session=session)
+    return wrapper
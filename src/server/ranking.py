@@ -0,0 +1,146 @@
+from typing import AsyncIterable
+
+import asyncpg
+import redis.asyncio as aioredis
+
+# Keep only the best (lowest) time of each player, with the replay it came from
+RECORD_SCRIPT = '''
+local current = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if current and tonumber(current) <= tonumber(ARGV[2]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[3])
+return 1
+'''
+
+
+class Rankings:
+    """### Per (game, level) sorted sets of each player's best time
+
+    Rank lookups and ranges are O(log N) in the number of ranked players.
+    """
+
+    def __init__(self, redis: aioredis.Redis):
+        self.redis = redis
+        self.recordScript = redis.register_script(RECORD_SCRIPT)
+
+    @staticmethod
+    def key(game: str, level: int) -> str:
+        return f'ranking:{game}:{level}'
+
+    async def record(self, game: str, level: int, player: int, time: int, replayUid: int) -> bool:
+        """### Record a submitted replay
+
+        Args:
+            game (str): game name
+            level (int): level id
+            player (int): player uid
+            time (int): time of the replay
+            replayUid (int): uid of the replay
+
+        Returns:
+            bool: whether it became the player's best
+        """
+        key = self.key(game, level)
+        return bool(await self.recordScript(keys=[key, f'{key}:replay'], args=[player, time, replayUid]))
+
+    async def entries(self, game: str, level: int, start: int, stop: int) -> list[dict[str, int]]:
+        """### Ranked entries between two 0-based positions, inclusive
+
+        Returns:
+            list[dict[str, int]]: rank, player, time and replay_uid of each entry
+        """
+        key = self.key(game, level)
+        members: list[tuple[bytes, float]] = await self.redis.zrange(key, start, stop, withscores=True)
+        if not members:
+            return []
+        replays = await self.redis.hmget(f'{key}:replay', [member for member, _ in members])
+        return [{
+            "rank": start + position + 1,
+            "player": int(member),
+            "time": int(time),
+            "replay_uid": int(replayUid) if replayUid is not None else None
+        } for position, ((member, time), replayUid) in enumerate(zip(members, replays))]
+
+    async def rank(self, game: str, level: int, player: int) -> dict[str, int] | None:
+        """### Rank of a player, None when the player has no score on the level
+        """
+        key = self.key(game, level)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.zrank(key, player)
+            pipe.zscore(key, player)
+            pipe.hget(f'{key}:replay', player)
+            pipe.zcard(key)
+            position, time, replayUid, total = await pipe.execute()
+        if position is None:
+            return None
+        return {
+            "rank": position + 1,
+            "player": player,
+            "time": int(time),
+            "replay_uid": int(replayUid) if replayUid is not None else None,
+            "total": total
+        }
+
+    async def around(self, game: str, level: int, player: int, count: int) -> list[dict[str, int]] | None:
+        """### Entries within count places of a player, None when the player has no score on the level
+        """
+        if (position := await self.redis.zrank(self.key(game, level), player)) is None:
+            return None
+        return await self.entries(game, level, max(0, position - count), position + count)
+
+    async def page(self, game: str, level: int, page: int, size: int) -> dict[str, int | list[dict[str, int]]]:
+        """### 1-based page of the ranking
+        """
+        start = (page - 1) * size
+        return {
+            "page": page,
+            "size": size,
+            "total": await self.redis.zcard(self.key(game, level)),
+            "entries": await self.entries(game, level, start, start + size - 1)
+        }
+
+    async def rebuild(self, game: str, bests: AsyncIterable[asyncpg.Record]) -> int:
+        """### Replace the rankings of a game
+
+        Args:
+            game (str): game name
+            bests (AsyncIterable[asyncpg.Record]): best replay of each player, ordered by level_id
+
+        Returns:
+            int: number of levels rebuilt
+        """
+        stale: set[bytes] = set()
+        async for key in self.redis.scan_iter(match=f'ranking:{game}:*'):
+            if not key.endswith(b':replay') and not key.endswith(b':rebuild'):
+                stale.add(key)
+
+        levels = 0
+        level: int | None = None
+        pipe = self.redis.pipeline(transaction=False)
+        async for best in bests:
+            if best['level_id'] != level:
+                if level is not None:
+                    await self.swap(pipe, game, level)
+                level = best['level_id']
+                levels += 1
+                stale.discard(self.key(game, level).encode())
+                pipe.delete(f'{self.key(game, level)}:rebuild', f'{self.key(game, level)}:replay:rebuild')
+            key = self.key(game, level)
+            pipe.zadd(f'{key}:rebuild', {best['player_uid']: best['time']})
+            pipe.hset(f'{key}:replay:rebuild', best['player_uid'], best['uid'])
+            if len(pipe) >= 1000:
+                await pipe.execute()
+        if level is not None:
+            await self.swap(pipe, game, level)
+
+        for key in stale:
+            await self.redis.delete(key, key + b':replay')
+        return levels
+
+    async def swap(self, pipe: aioredis.client.Pipeline, game: str, level: int):
+        key = self.key(game, level)
+        pipe.rename(f'{key}:rebuild', key)
+        pipe.rename(f'{key}:replay:rebuild', f'{key}:replay')
+        await pipe.execute()
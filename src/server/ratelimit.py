@@ -0,0 +1,147 @@
+import logging
+import time
+from typing import Optional
+
+import redis.asyncio as aioredis
+from redis.exceptions import RedisError
+
+from .cache import LocalCache
+
+logger = logging.getLogger(__name__)
+
+# Takes up to ARGV[4] tokens from a bucket refilled at ARGV[1] tokens per second up to ARGV[2], ARGV[3] is now in ms
+# Returns the tokens granted and, when none, the ms until one is available
+TAKE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local want = tonumber(ARGV[4])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'at')
+local tokens = tonumber(bucket[1]) or burst
+local at = tonumber(bucket[2]) or now
+if now > at then
+    tokens = math.min(burst, tokens + (now - at) * rate / 1000)
+    at = now
+end
+local granted = math.min(want, math.floor(tokens))
+tokens = tokens - granted
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'at', at)
+redis.call('PEXPIRE', KEYS[1], math.ceil((burst - tokens) * 1000 / rate) + 1000)
+if granted > 0 then
+    return {granted, 0}
+end
+return {0, math.ceil((1 - tokens) * 1000 / rate)}
+"""
+
+# Tokens per second and burst of each client on a route, login and submissions are the costly ones
+routeLimits: dict[str, tuple[float, int]] = {
+    '/auth/user/new': (0.2, 3),
+    '/auth/client/login': (1.0, 10),
+    '/client/{game}/score/submit': (5.0, 30),
+    '/client/{game}/score/submit/batch': (1.0, 5),
+    '/client/{game}/score/upload': (5.0, 30)
+}
+defaultLimit: tuple[float, int] = (50.0, 200)
+# Routes never limited nor shed, so monitoring keeps working under load
+exemptRoutes = ('/', '/status', '/metrics')
+# Seconds tokens taken from Redis stay usable by this worker
+leaseTime = 1.0
+
+
+class Lease:
+    """Tokens of a bucket taken by this worker, or the time the bucket refills when it was empty
+    """
+    __slots__ = ('tokens', 'expires', 'deniedUntil')
+
+    def __init__(self):
+        self.tokens: int = 0
+        self.expires: float = 0.0
+        self.deniedUntil: float = 0.0
+
+
+class RateLimiter:
+    """### Token buckets per client and route in Redis, with the tokens leased by each worker in batches
+
+    A worker takes up to a tenth of the burst of a bucket at once and spends it without asking Redis,
+    and refuses a client whose bucket was empty until it refills, also without asking Redis.
+    Leased tokens a worker didn't spend within leaseTime are dropped, so a client gets slightly less than its limit.
+    Redis errors let requests through.
+    """
+
+    def __init__(self, redis: aioredis.Redis, scale: float = 1.0, max_inflight: int = 0, local_size: int = 100000):
+        self.redis = redis
+        # Multiplies every rate and burst, 0 turns the buckets off
+        self.scale = scale
+        # Requests handled at once by this worker before shedding, 0 for no limit
+        self.maxInflight = max_inflight
+        self.leases: LocalCache[str, Lease] = LocalCache(local_size, 60.0)
+        self.takeScript = redis.register_script(TAKE_SCRIPT)
+        self.inflight: int = 0
+        self.localChecks: int = 0
+        self.remoteChecks: int = 0
+        self.limited: int = 0
+        self.shed: int = 0
+
+    def limit(self, route: str) -> tuple[float, int]:
+        rate, burst = routeLimits.get(route, defaultLimit)
+        return rate * self.scale, max(1, round(burst * self.scale))
+
+    async def admit(self, client: str, route: str) -> float:
+        """### Take a token of the client on the route
+
+        Args:
+            client (str): client identity, session or address
+            route (str): route template
+
+        Returns:
+            float: 0 when admitted, otherwise seconds until the client may retry
+        """
+        if not self.scale:
+            return 0.0
+        key = f'{route} {client}'
+        now = time.monotonic()
+        if (lease := self.leases.get(key)) is None:
+            lease = Lease()
+            self.leases.set(key, lease)
+        if lease.deniedUntil > now:
+            self.localChecks += 1
+            self.limited += 1
+            return lease.deniedUntil - now
+        if lease.tokens > 0 and lease.expires > now:
+            self.localChecks += 1
+            lease.tokens -= 1
+            return 0.0
+
+        rate, burst = self.limit(route)
+        self.remoteChecks += 1
+        try:
+            granted, wait = await self.takeScript(
+                keys=[f'ratelimit:{route}:{client}'],
+                args=[rate, burst, int(time.time() * 1000), max(1, burst // 10)]
+            )
+        except RedisError:
+            logger.warning("Rate limit check failed, admitting", exc_info=True)
+            return 0.0
+        if not granted:
+            self.limited += 1
+            lease.deniedUntil = now + wait / 1000
+            return wait / 1000
+        lease.tokens = granted - 1
+        lease.expires = now + leaseTime
+        return 0.0
+
+    def overloaded(self) -> bool:
+        if self.maxInflight and self.inflight >= self.maxInflight:
+            self.shed += 1
+            return True
+        return False
+
+    def metrics(self) -> dict[str, Optional[int]]:
+        return {
+            "inflight": self.inflight,
+            "max_inflight": self.maxInflight or None,
+            "local_checks": self.localChecks,
+            "redis_checks": self.remoteChecks,
+            "limited": self.limited,
+            "shed": self.shed
+        }
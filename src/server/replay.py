@@ -1,4 +1,6 @@
-from typing import TypeAlias
+import hashlib
+import json
+from typing import Optional, TypeAlias
 
 JSON: TypeAlias = dict[str, "JSON"] | list["JSON"] | str | int | float | bool | None
 
@@ -8,8 +10,7 @@ def validateReplayJson(replayFile: JSON) -> bool:
     return all([ 
         validateReplayBlock(replayFile, "player", ["uid", "nickname"]), 
         validateReplayBlock(replayFile, "info", ["level_id", "score", "time"]), 
-        "replay" in replayFile,
-        isinstance(replayFile['replay'], list)
+        isinstance(replayFile.get('replay'), list)
     ])
 
 def validateReplayBlock(replayFile: JSON, blockName: str, keys: list[str]) -> bool:
@@ -21,3 +22,75 @@ def validateReplayBlock(replayFile: JSON, blockName: str, keys: list[str]) -> bo
     if not isinstance(block, dict):
         return False
     return all(key in block for key in keys)
+
+def replayColumns(replayFile: JSON) -> Optional[dict[str, int]]:
+    """Typed columns stored next to a validated replay
+
+    Returns:
+        Optional[dict[str, int]]: level_id, score, time and player_uid, None when one of them is missing or not an integer
+    """
+    try:
+        return {
+            "level_id": toInteger(replayFile["info"]["level_id"]),
+            "score": toInteger(replayFile["info"]["score"], 2 ** 63),
+            "time": toInteger(replayFile["info"]["time"]),
+            "player_uid": toInteger(replayFile["player"]["uid"])
+        }
+    except (KeyError, TypeError, ValueError):
+        return None
+
+def toInteger(value: JSON, limit: int = 2 ** 31) -> int:
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise TypeError(f"{value!r} is not an integer")
+    if isinstance(value, float) and not value.is_integer():
+        raise ValueError(f"{value!r} is not an integer")
+    if not -limit <= (result := int(value)) < limit:
+        raise ValueError(f"{value!r} out of range")
+    return result
+
+def canonicalJson(value: JSON) -> bytes:
+    return json.dumps(value, sort_keys=True, separators=(",", ":"), ensure_ascii=False).encode()
+
+def replayDigest(replayFile: JSON) -> bytes:
+    """Content digest of a validated replay, identical for replays with the same content
+
+    The event list is hashed on its own and folded into the digest of the header, 
+    so it can be digested without holding the whole replay.
+
+    Returns:
+        bytes: sha256 digest
+    """
+    events = EventsDigest()
+    for event in replayFile["replay"]:
+        events.update(event)
+    header = {key: value for key, value in replayFile.items() if key != "replay"}
+    return headerDigest(header, events.digest())
+
+def headerDigest(header: JSON, events: bytes) -> bytes:
+    return hashlib.sha256(canonicalJson(header) + events).digest()
+
+class EventsDigest:
+    """Digest of the canonical event list, fed one event at a time
+
+    With keep, the canonical event list is also kept in encoded.
+    """
+
+    def __init__(self, keep: bool = False):
+        self.hash = hashlib.sha256(b"[")
+        self.count: int = 0
+        self.encoded: Optional[bytearray] = bytearray(b"[") if keep else None
+
+    def update(self, event: JSON):
+        encoded = (b"," if self.count else b"") + canonicalJson(event)
+        self.hash.update(encoded)
+        if self.encoded is not None:
+            self.encoded += encoded
+        self.count += 1
+
+    def events(self) -> bytes:
+        return bytes(self.encoded) + b"]"
+
+    def digest(self) -> bytes:
+        final = self.hash.copy()
+        final.update(b"]")
+        return final.digest()
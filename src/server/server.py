@@ -1,34 +1,79 @@
-import json
+import asyncio
+import base64
+import binascii
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Optional
 
 from aiohttp import web
 
-from . import preprocess
-from .database import PostgresDB
+from . import aioargon2, codec, deadlines, ingest, metrics, preprocess
+from .cache import LeaderboardCache, ReplayCache
+from .database import PostgresDB, leaderboardOrders, leaderboardSize, submitBatchSize
+from .ranking import Rankings
+from .ratelimit import RateLimiter
+from .replay import replayColumns
+from .session import Session, SessionStore
+from .submissions import SubmissionQueue, recordSubmitted, splitReplay
 
 routes = web.RouteTableDef()
+rankingPageLimit = 100
+# Seconds each kind of request has to be answered in, uploads include reading the body
+readTimeout = 5.0
+loginTimeout = 5.0
+submitTimeout = 10.0
+batchTimeout = 30.0
+uploadTimeout = 60.0
+# Seconds a store has once started, whether its request is still waiting for it or not
+storeTimeout = 30.0
 
 @routes.get('/')
 async def homePage(request: web.Request) -> web.Response:
     return web.Response(text="Score API Server")
 
+@routes.get('/status')
+@preprocess.request_to_params()
+@preprocess.with_database
+@preprocess.with_leaderboard
+@preprocess.with_replays
+@preprocess.with_submissions
+@preprocess.with_limiter
+async def serverStatus(request: web.Request, database: PostgresDB, leaderboard: LeaderboardCache, replays: ReplayCache, submissions: Optional[SubmissionQueue], limiter: RateLimiter) -> preprocess.Response:
+    return preprocess.Response(body={
+        "database": database.poolMetrics(),
+        "hasher": aioargon2.pool().metrics(),
+        "user_cache": database.users.metrics(),
+        "games": database.games.metrics(),
+        "leaderboard_cache": leaderboard.metrics(),
+        "replay_cache": replays.metrics(),
+        "submission_queue": await submissions.metrics() if submissions else None,
+        "admission": limiter.metrics()
+    })
+
+@routes.get('/metrics')
+async def serverMetrics(request: web.Request) -> web.Response:
+    return metrics.export()
+
 @routes.post('/auth/user/new')
-@preprocess.request_to_params(body_param=['username', 'nickname', 'email'])
+@preprocess.request_to_params(body_param=['username', 'nickname', 'email'], timeout=loginTimeout)
 @preprocess.with_database
 async def userNew(request: web.Request, database: PostgresDB, username: str, nickname: str, email: str) -> preprocess.Response:
     status = await database.createUser(username, nickname, email)
     return preprocess.Response(status=status['status'], body=status)
 
 @routes.post('/auth/client/login')
-@preprocess.request_to_params(body_param=['username', 'password'])
+@preprocess.request_to_params(body_param=['username', 'password'], timeout=loginTimeout)
 @preprocess.with_database
-async def clientLogin(request: web.Request, database: PostgresDB, username: str, password: str) -> preprocess.Response:
+@preprocess.with_sessions
+async def clientLogin(request: web.Request, database: PostgresDB, sessions: SessionStore, username: str, password: str) -> preprocess.Response:
     uid, nickname = await database.authenticateUser(username, password)
     if (uid) > 0:
         status = {
             "status": 200, 
             "message": "Success. User Verified. ",
             "uid": uid, 
-            "nickname": nickname
+            "nickname": nickname,
+            "token": await sessions.create(uid, nickname),
+            "expires_in": sessions.ttl
         }
     else:
         match uid:
@@ -46,44 +91,454 @@ async def clientLogin(request: web.Request, database: PostgresDB, username: str,
                 assert False
     return preprocess.Response(status=status["status"], message=status["message"], body=status)
 
+@routes.post('/auth/client/logout')
+@preprocess.request_to_params()
+@preprocess.with_sessions
+async def clientLogout(request: web.Request, sessions: SessionStore) -> preprocess.Response:
+    if (token := preprocess.bearer_token(request)) is None or not await sessions.revoke(token):
+        return preprocess.Response(status=401, body={
+            "status": 401, 
+            "message": "Invalid or expired session! "
+        })
+    return preprocess.Response(message="Success. Logged out. ")
+
 @routes.post('/client/{game}/score/submit')
-@preprocess.request_to_params(url_match=['game'], query_param=['uid'], body_param=['replay'])
+@preprocess.request_to_params(url_match=['game'], body_param=['replay'], timeout=submitTimeout)
+@preprocess.require_session
 @preprocess.with_database
-async def scoreSubmit(request: web.Request, database: PostgresDB, game: str, uid: str, replay: str) -> preprocess.Response:
+@preprocess.with_leaderboard
+@preprocess.with_rankings
+@preprocess.with_sessions
+@preprocess.with_submissions
+async def scoreSubmit(request: web.Request, database: PostgresDB, leaderboard: LeaderboardCache, rankings: Rankings, sessions: SessionStore, submissions: Optional[SubmissionQueue], session: Session, game: str, replay: str) -> preprocess.Response:
     try:
-        replay_json = json.loads(replay)
-        status = await database.submitScore(game, int(uid), replay_json)
-    except json.decoder.JSONDecodeError:
+        replay_json = codec.loads(replay)
+        columns = replayColumns(replay_json)
+        if columns is not None and columns['player_uid'] != session['uid']:
+            status = {
+                "status": 403, 
+                "message": "Replay belongs to another player! "
+            }
+        elif submissions:
+            if (split := splitReplay(replay_json)) is None:
+                status = {
+                    "status": 400, 
+                    "message": "Invalid Replay File! "
+                }
+            else:
+                return await queueScore(database, submissions, game, session['uid'], *split)
+        else:
+            status = await shieldStore(storeScore(
+                database.submitScore(game, session['uid'], replay_json, verifiedUser=True),
+                leaderboard, rankings, sessions, game, columns
+            ))
+    except codec.DecodeError:
         status = {
             "status": 415, 
             "message": "Replay file must be in json format! "
         }
     return preprocess.Response(status=status["status"], message=status["message"], body=status)
 
+def shieldStore(store: Awaitable[dict[str, Any]]) -> Awaitable[dict[str, Any]]:
+    # A client leaving or the request timing out after the insert started doesn't skip updating the caches,
+    # the store runs under storeTimeout instead of the request deadline
+    async def detached() -> dict[str, Any]:
+        with deadlines.detached(storeTimeout):
+            async with asyncio.timeout(storeTimeout):
+                return await store
+    return asyncio.shield(detached())
+
+async def storeScore(store: Awaitable[dict[str, Any]], leaderboard: LeaderboardCache, rankings: Rankings, sessions: SessionStore, game: str, columns: Optional[dict[str, int]]) -> dict[str, Any]:
+    status = await store
+    if status["status"] == 200:
+        await recordSubmitted(leaderboard, rankings, sessions, game, columns, status['replay_uid'])
+    return status
+
+async def queueScore(database: PostgresDB, submissions: SubmissionQueue, game: str, userUID: int, header: dict[str, Any], events: bytes, digest: bytes, columns: dict[str, int]) -> preprocess.Response:
+    if not await database.hasGame(game):
+        return preprocess.Response(status=400, body={
+            "status": 400, 
+            "message": "Invalid Game! "
+        })
+    state, provisional_id = await submissions.enqueue(game, userUID, header, events, digest, columns)
+    if state == 'full':
+        return preprocess.Response(status=503, headers={'Retry-After': '5'}, body={
+            "status": 503, 
+            "message": "Too many submissions queued, retry later! "
+        })
+    if state == 'duplicate':
+        return preprocess.Response(status=400, body={
+            "status": 400, 
+            "message": "Replay File already submitted! ", 
+            "provisional_id": provisional_id
+        })
+    return preprocess.Response(status=202, body={
+        "status": 202, 
+        "message": "Accepted, Score Queued. ", 
+        "provisional_id": provisional_id
+    })
+
+@routes.post('/client/{game}/score/upload')
+@preprocess.request_to_params(url_match=['game'], timeout=uploadTimeout)
+@preprocess.require_session
+@preprocess.with_config
+@preprocess.with_database
+@preprocess.with_leaderboard
+@preprocess.with_rankings
+@preprocess.with_sessions
+@preprocess.with_submissions
+async def scoreUpload(request: web.Request, config: dict[str, Any], database: PostgresDB, leaderboard: LeaderboardCache, rankings: Rankings, sessions: SessionStore, submissions: Optional[SubmissionQueue], session: Session, game: str) -> preprocess.Response:
+    if not await database.hasGame(game):
+        return preprocess.Response(status=400, body={
+            "status": 400, 
+            "message": "Invalid Game! "
+        })
+    if (request.content_length or 0) > config['replay_max_size']:
+        return preprocess.Response(status=413, body={
+            "status": 413, 
+            "message": "Replay file too large! "
+        })
+    try:
+        replay = await ingest.readReplay(request.content, config['replay_max_size'], session['uid'])
+    except ingest.ReplayRejected as e:
+        return preprocess.Response(status=e.status, body={
+            "status": e.status, 
+            "message": e.message
+        })
+    if submissions:
+        return await queueScore(database, submissions, game, session['uid'], replay.header, replay.events, replay.digest, replay.columns)
+    status = await shieldStore(storeScore(
+        database.storeScore(game, session['uid'], replay.header, replay.events, replay.digest, replay.columns),
+        leaderboard, rankings, sessions, game, replay.columns
+    ))
+    return preprocess.Response(status=status["status"], message=status["message"], body=status)
+
+@routes.post('/client/{game}/score/submit/batch')
+@preprocess.request_to_params(url_match=['game'], body_param=['replays'], timeout=batchTimeout)
+@preprocess.require_session
+@preprocess.with_database
+@preprocess.with_leaderboard
+@preprocess.with_rankings
+@preprocess.with_sessions
+async def scoreSubmitBatch(request: web.Request, database: PostgresDB, leaderboard: LeaderboardCache, rankings: Rankings, sessions: SessionStore, session: Session, game: str, replays: list) -> preprocess.Response:
+    if not isinstance(replays, list) or not 0 < len(replays) <= submitBatchSize:
+        return preprocess.Response(status=400, body={
+            "status": 400, 
+            "message": f"Replays must be a list of 1 to {submitBatchSize} replays! "
+        })
+
+    results: list[dict | None] = [None] * len(replays)
+    accepted: list[tuple[int, dict, dict[str, int] | None]] = []
+    for index, replay in enumerate(replays):
+        # Replays are sent as objects, json strings like the single submission are accepted too
+        if isinstance(replay, str):
+            try:
+                replay = codec.loads(replay)
+            except codec.DecodeError:
+                results[index] = {
+                    "status": 415, 
+                    "message": "Replay file must be in json format! "
+                }
+                continue
+        columns = replayColumns(replay) if isinstance(replay, dict) else None
+        if columns is not None and columns['player_uid'] != session['uid']:
+            results[index] = {
+                "status": 403, 
+                "message": "Replay belongs to another player! "
+            }
+            continue
+        accepted.append((index, replay, columns))
+
+    async def store() -> dict[str, Any]:
+        status = await database.submitScores(game, session['uid'], [replay for _, replay, _ in accepted], verifiedUser=True)
+        if status["status"] != 200:
+            return status
+        fastest: dict[int, int] = {}
+        for (index, _, columns), result in zip(accepted, status['results']):
+            results[index] = result
+            if result["status"] == 200:
+                fastest[columns['level_id']] = min(fastest.get(columns['level_id'], columns['time']), columns['time'])
+                await rankings.record(game, columns['level_id'], columns['player_uid'], columns['time'], result['replay_uid'])
+        for level_id, time in fastest.items():
+            await leaderboard.submitted(game, level_id, time)
+        if fastest:
+            await sessions.wrote(session['uid'])
+        return status
+
+    if accepted:
+        # Shielded like single submissions, the caches follow whatever the insert stored
+        status = await shieldStore(store())
+        if status["status"] != 200:
+            return preprocess.Response(status=status["status"], message=status["message"], body=status)
+
+    return preprocess.Response(body={
+        "status": 200, 
+        "message": "Success, Batch Processed. ", 
+        "submitted": sum(result["status"] == 200 for result in results),
+        "results": results
+    })
+
+@routes.get('/client/{game}/score/pending')
+@preprocess.request_to_params(url_match=['game'], query_param=['id'], timeout=readTimeout)
+@preprocess.require_session
+@preprocess.with_submissions
+async def scorePending(request: web.Request, submissions: Optional[SubmissionQueue], session: Session, game: str, id: str) -> preprocess.Response:
+    if not submissions:
+        return preprocess.Response(status=404, body={
+            "status": 404, 
+            "message": "Submissions are not queued! "
+        })
+    if (result := await submissions.result(id, game, session['uid'])) is None:
+        return preprocess.Response(status=404, body={
+            "status": 404, 
+            "message": "Unknown Submission! "
+        })
+    return preprocess.Response(body={
+        "status": 200, 
+        "message": "Success. ", 
+        "submission": result
+    })
+
 @routes.get('/client/{game}/score/get')
-@preprocess.request_to_params(url_match=['game'], query_param=['uid'])
+@preprocess.request_to_params(url_match=['game'], query_param=['uid'], query_default={'level': ''}, timeout=readTimeout)
+@preprocess.require_session
 @preprocess.with_database
-async def scoreGet(request: web.Request, database: PostgresDB, game: str, uid: str) -> preprocess.Response:
+@preprocess.with_replays
+async def scoreGet(request: web.Request, database: PostgresDB, replays: ReplayCache, session: Session, game: str, uid: str, level: str) -> preprocess.Response:
+    if not await database.hasGame(game):
+        return preprocess.Response(status=400, body={
+            "status": 400, 
+            "message": "Invalid Game! "
+        })
     try:
-        result = await database.fetchScore(game, int(uid))
+        replay_uid = int(uid)
     except ValueError:
-        result = {
+        return preprocess.Response(status=400, body={
             "status": 400, 
             "message": "Invalid Replay UID! "
-        }
-    http_code:int = result.get('status', 200)
-    return preprocess.Response(status=http_code, body=result)
+        })
+    # The level is optional, it narrows the lookup to one partition of partitioned games
+    try:
+        level_id = int(level) if level else None
+    except ValueError:
+        return preprocess.Response(status=400, body={
+            "status": 400, 
+            "message": "Invalid Level ID! "
+        })
+    async def load() -> Optional[bytes]:
+        result = await database.fetchScore(game, replay_uid, level_id)
+        if result.get('status', 200) != 200:
+            return None
+        return preprocess.Response(body=result).encode()
+
+    # Cached by uid alone, the level only narrows the database lookup
+    if (body := await replays.fetch(game, replay_uid, load)) is None:
+        return preprocess.Response(status=400, body={
+            "status": 400, 
+            "message": "Invalid Replay UID! "
+        })
+    # Stored replays never change, the uid identifies the content. Checked once the replay is known to exist
+    etag = f'"replay-{game}-{replay_uid}"'
+    if preprocess.etag_matches(request, etag):
+        return preprocess.NotModifiedResponse(etag)
+    return preprocess.EncodedResponse(body, headers={"ETag": etag})
 
 @routes.get('/client/{game}/score/leaderboard')
-@preprocess.request_to_params(url_match=['game'], query_param=['level'])
+@preprocess.request_to_params(url_match=['game'], query_param=['level'], query_default={'view': 'full'}, timeout=readTimeout)
+@preprocess.require_session
 @preprocess.with_database
-async def scoreLeaderBoard(request: web.Request, database: PostgresDB, game: str, level: str) -> preprocess.Response:
+@preprocess.with_leaderboard
+async def scoreLeaderBoard(request: web.Request, database: PostgresDB, leaderboard: LeaderboardCache, session: Session, game: str, level: str, view: str) -> preprocess.Response:
     try:
-        result = await database.fetchLeaderBoard(game, int(level))
+        level_id = int(level)
     except ValueError:
-        result = {
+        return preprocess.Response(status=400, body={
             "status": 400, 
             "message": "Invalid Level ID! "
-        }
-    http_code = 200 if isinstance(result, list) else result.get("status", 200)
-    return preprocess.Response(status=http_code, body=result)
+        })
+    if view not in leaderboardViews:
+        return preprocess.Response(status=400, body={
+            "status": 400, 
+            "message": "Invalid parameter: view! "
+        })
+    # Polling clients with an unchanged board are answered from Redis alone
+    if 'If-None-Match' in request.headers and preprocess.etag_matches(request, etag := await leaderboard.etag(game, level_id, view)):
+        return preprocess.NotModifiedResponse(etag)
+
+    async def load() -> tuple[bytes, int | None] | None:
+        return await leaderboardViews[view](database, game, level_id)
+
+    if (cached := await leaderboard.fetch(game, level_id, load, view)) is None:
+        return preprocess.Response(status=400, body={
+            "status": 400, 
+            "message": "Invalid Game! "
+        })
+    body, etag = cached
+    if preprocess.etag_matches(request, etag):
+        return preprocess.NotModifiedResponse(etag)
+    return preprocess.EncodedResponse(body, headers={"ETag": etag})
+
+# Cached boards are loaded from the primary, a lagging replica would cache a board missing the submission that invalidated it
+async def leaderboardFull(database: PostgresDB, game: str, level_id: int) -> tuple[bytes, int | None] | None:
+    # Stored replays go into the response without being decoded
+    if (result := await database.fetchLeaderBoardEncoded(game, level_id, primary=True)) is None:
+        return None
+    cutoff = result[-1][0] if len(result) >= leaderboardSize else None
+    return preprocess.Response(body=[replay for _, replay in result]).encode(), cutoff
+
+async def leaderboardSummary(database: PostgresDB, game: str, level_id: int) -> tuple[bytes, int | None] | None:
+    if (result := await database.fetchLeaderBoardSummary(game, level_id, primary=True)) is None:
+        return None
+    cutoff = result[-1]['time'] if len(result) >= leaderboardSize else None
+    return preprocess.Response(body=result).encode(), cutoff
+
+# Leaderboard views, summary leaves the replays out, to be fetched one by one with score/get
+leaderboardViews = {
+    'full': leaderboardFull,
+    'summary': leaderboardSummary
+}
+
+def windowStart(window: str) -> Optional[datetime]:
+    """Start of the current UTC day or ISO week, None for the all time board
+    """
+    today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    if window == 'day':
+        return today
+    if window == 'week':
+        return today - timedelta(days=today.weekday())
+    return None
+
+# Leaderboard page windows
+leaderboardWindows = ('all', 'day', 'week')
+leaderboardModes = ('all', 'best')
+
+def encodeCursor(sort: str, mode: str, entry: dict[str, Any], rank: int) -> str:
+    """Opaque cursor after an entry of a leaderboard page
+    """
+    key = [sort, mode, entry[sort], entry['replay_uid'], rank]
+    return base64.urlsafe_b64encode(codec.dumps(key)).rstrip(b'=').decode()
+
+def decodeCursor(cursor: str, sort: str, mode: str) -> Optional[tuple[int, int, int]]:
+    """Sort value, replay uid and rank of the entry a cursor points after
+
+    Returns:
+        Optional[tuple[int, int, int]]: None when the cursor is malformed or from another ordering
+    """
+    try:
+        key = codec.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (binascii.Error, ValueError):
+        return None
+    if not isinstance(key, list) or len(key) != 5 or key[:2] != [sort, mode]:
+        return None
+    if not all(type(value) is int for value in key[2:]):
+        return None
+    return key[2], key[3], key[4]
+
+async def rankingParams(game: str, database: PostgresDB, **params: str) -> tuple[dict[str, int], preprocess.Response | None]:
+    """Parse integer query parameters of the ranking endpoints
+
+    Returns:
+        tuple[dict[str, int], preprocess.Response | None]: parsed parameters, or the error response
+    """
+    if not await database.hasGame(game):
+        return {}, preprocess.Response(status=400, body={
+            "status": 400, 
+            "message": "Invalid Game! "
+        })
+    parsed: dict[str, int] = {}
+    for name, value in params.items():
+        try:
+            parsed[name] = int(value)
+        except ValueError:
+            return {}, preprocess.Response(status=400, body={
+                "status": 400, 
+                "message": f"Invalid parameter: {name}! "
+            })
+    return parsed, None
+
+@routes.get('/client/{game}/score/leaderboard/page')
+@preprocess.request_to_params(url_match=['game'], query_param=['level'], query_default={
+    'sort': 'time', 'mode': 'all', 'window': 'all', 'size': str(leaderboardSize), 'cursor': ''
+}, timeout=readTimeout)
+@preprocess.require_session
+@preprocess.with_database
+@preprocess.with_sessions
+async def scoreLeaderBoardPage(request: web.Request, database: PostgresDB, sessions: SessionStore, session: Session, game: str, level: str, sort: str, mode: str, window: str, size: str, cursor: str) -> preprocess.Response:
+    params, error = await rankingParams(game, database, level=level, size=size)
+    if error:
+        return error
+    for name, value, allowed in (('sort', sort, leaderboardOrders), ('mode', mode, leaderboardModes), ('window', window, leaderboardWindows)):
+        if value not in allowed:
+            return preprocess.Response(status=400, body={
+                "status": 400, 
+                "message": f"Invalid parameter: {name}! "
+            })
+    after: Optional[tuple[int, int]] = None
+    rank = 0
+    if cursor:
+        if (key := decodeCursor(cursor, sort, mode)) is None:
+            return preprocess.Response(status=400, body={
+                "status": 400, 
+                "message": "Invalid parameter: cursor! "
+            })
+        after, rank = key[:2], key[2]
+    pageSize = min(max(params['size'], 1), rankingPageLimit)
+    # One extra row tells whether there is a next page
+    result = await database.fetchLeaderBoardPage(
+        game, params['level'], sort=sort, best=mode == 'best', since=windowStart(window), after=after, size=pageSize + 1,
+        # Players see their own submissions even while the replicas catch up
+        primary=await sessions.wroteRecently(session['uid'])
+    )
+    if result is None:
+        return preprocess.Response(status=400, body={
+            "status": 400, 
+            "message": "Invalid Game! "
+        })
+    entries = [{"rank": rank + position} | entry for position, entry in enumerate(result[:pageSize], start=1)]
+    next_cursor = encodeCursor(sort, mode, result[pageSize - 1], rank + pageSize) if len(result) > pageSize else None
+    return preprocess.Response(body={"entries": entries, "next_cursor": next_cursor})
+
+@routes.get('/client/{game}/score/rank')
+@preprocess.request_to_params(url_match=['game'], query_param=['level', 'player'], timeout=readTimeout)
+@preprocess.require_session
+@preprocess.with_database
+@preprocess.with_rankings
+async def scoreRank(request: web.Request, database: PostgresDB, rankings: Rankings, session: Session, game: str, level: str, player: str) -> preprocess.Response:
+    params, error = await rankingParams(game, database, level=level, player=player)
+    if error:
+        return error
+    if (result := await rankings.rank(game, params['level'], params['player'])) is None:
+        return preprocess.Response(status=404, body={
+            "status": 404, 
+            "message": "Player not ranked on this level! "
+        })
+    return preprocess.Response(body=result)
+
+@routes.get('/client/{game}/score/around')
+@preprocess.request_to_params(url_match=['game'], query_param=['level', 'player'], query_default={'count': '5'}, timeout=readTimeout)
+@preprocess.require_session
+@preprocess.with_database
+@preprocess.with_rankings
+async def scoreAround(request: web.Request, database: PostgresDB, rankings: Rankings, session: Session, game: str, level: str, player: str, count: str) -> preprocess.Response:
+    params, error = await rankingParams(game, database, level=level, player=player, count=count)
+    if error:
+        return error
+    if (result := await rankings.around(game, params['level'], params['player'], min(max(params['count'], 0), rankingPageLimit))) is None:
+        return preprocess.Response(status=404, body={
+            "status": 404, 
+            "message": "Player not ranked on this level! "
+        })
+    return preprocess.Response(body={"entries": result})
+
+@routes.get('/client/{game}/score/range')
+@preprocess.request_to_params(url_match=['game'], query_param=['level'], query_default={'page': '1', 'size': str(leaderboardSize)}, timeout=readTimeout)
+@preprocess.require_session
+@preprocess.with_database
+@preprocess.with_rankings
+async def scoreRange(request: web.Request, database: PostgresDB, rankings: Rankings, session: Session, game: str, level: str, page: str, size: str) -> preprocess.Response:
+    params, error = await rankingParams(game, database, level=level, page=page, size=size)
+    if error:
+        return error
+    return preprocess.Response(body=await rankings.page(
+        game, params['level'], max(params['page'], 1), min(max(params['size'], 1), rankingPageLimit)
+    ))
@@ -0,0 +1,126 @@
+import base64
+import hashlib
+import hmac
+import secrets
+from typing import Any, Optional
+
+import redis.asyncio as aioredis
+
+from .cache import LocalCache
+
+Session = dict[str, Any]
+
+# Session of KEYS[1] when it is as recent as the last time its user's sessions were ended, deleted otherwise
+# KEYS: session, generation of its user; ARGV: uid the session is expected to belong to
+VALIDATE_SCRIPT = """
+local session = redis.call('HMGET', KEYS[1], 'uid', 'nickname', 'generation')
+if not session[1] or session[1] ~= ARGV[1] then
+    return false
+end
+if (session[3] or '0') ~= (redis.call('GET', KEYS[2]) or '0') then
+    redis.call('DEL', KEYS[1])
+    return false
+end
+return {session[1], session[2]}
+"""
+
+
+class SessionStore:
+    """### Signed session tokens backed by Redis
+
+    A token is `<session id>.<HMAC of the session id>`, forged tokens are refused without any lookup.
+    Session ids start with `<uid>:` so validation can name the generation key of the user upfront.
+    Session state lives in Redis and is cached in process for a few seconds,
+    so a revoked session can stay usable on other workers for up to that long.
+    Sessions carry the generation of their user, ending every session of a user bumps it.
+    Users who submitted in the last write_window seconds are remembered, so their reads can skip lagging replicas.
+    """
+    generationPrefix = 'session-generation:'
+
+    def __init__(self, redis: aioredis.Redis, secret: bytes, ttl: int, local_ttl: float = 5.0, local_size: int = 10000, write_window: int = 0):
+        self.redis = redis
+        self.secret = secret
+        self.ttl = ttl
+        self.writeWindow = write_window
+        self.local: LocalCache[str, Session] = LocalCache(local_size, local_ttl)
+        self.validateScript = redis.register_script(VALIDATE_SCRIPT)
+
+    @staticmethod
+    def key(session_id: str) -> str:
+        return f'session:{session_id}'
+
+    @staticmethod
+    def generationKey(uid: int) -> str:
+        return f'{SessionStore.generationPrefix}{uid}'
+
+    def sign(self, session_id: str) -> str:
+        digest = hmac.new(self.secret, session_id.encode(), hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest).rstrip(b'=').decode()
+
+    def verify(self, token: str) -> Optional[str]:
+        """### Check the token signature
+
+        Returns:
+            Optional[str]: session id, None when the token is malformed or forged
+        """
+        session_id, _, signature = token.partition('.')
+        if not session_id or not hmac.compare_digest(self.sign(session_id), signature):
+            return None
+        return session_id
+
+    async def create(self, uid: int, nickname: str) -> str:
+        """### Start a session for a verified user
+
+        Returns:
+            str: session token
+        """
+        session_id = f'{uid}:{secrets.token_urlsafe(24)}'
+        generation = await self.redis.get(self.generationKey(uid)) or 0
+        await self.redis.hset(self.key(session_id), mapping={"uid": uid, "nickname": nickname, "generation": generation})
+        await self.redis.expire(self.key(session_id), self.ttl)
+        return f'{session_id}.{self.sign(session_id)}'
+
+    async def validate(self, token: str) -> Optional[Session]:
+        """### Session of a token
+
+        Returns:
+            Optional[Session]: uid and nickname of the user, None when the token is invalid or the session ended
+        """
+        if (session_id := self.verify(token)) is None:
+            return None
+        if (session := self.local.get(session_id)) is not None:
+            return session
+        uid, sep, _ = session_id.partition(':')
+        if not sep:
+            # Sessions created before ids carried their uid
+            if (uid := await self.redis.hget(self.key(session_id), 'uid')) is None:
+                return None
+            uid = uid.decode()
+        keys = [self.key(session_id), self.generationKey(int(uid))]
+        if not (stored := await self.validateScript(keys=keys, args=[uid])):
+            return None
+        session = {"uid": int(stored[0]), "nickname": stored[1].decode()}
+        self.local.set(session_id, session)
+        return session
+
+    async def wrote(self, uid: int):
+        if self.writeWindow:
+            await self.redis.set(f'session-write:{uid}', 1, ex=self.writeWindow)
+
+    async def wroteRecently(self, uid: int) -> bool:
+        """### Whether the user submitted within the write window, on any worker
+        """
+        if not self.writeWindow:
+            return False
+        return bool(await self.redis.exists(f'session-write:{uid}'))
+
+    async def endUser(self, uid: int):
+        """### End every session of a user, their tokens are refused once out of the local caches
+        """
+        await self.redis.incr(self.generationKey(uid))
+
+    async def revoke(self, token: str) -> bool:
+        if (session_id := self.verify(token)) is None:
+            return False
+        self.local.pop(session_id)
+        return bool(await self.redis.delete(self.key(session_id)))
@@ -1,41 +1,232 @@
 
 import argparse
+import asyncio
+import contextlib
+import logging
 import os
+import secrets
+from typing import Any
+
 from aiohttp import web
 import redis.asyncio as aioredis
 
-from .database import PostgresDB
+from . import aioargon2
+from .cache import LeaderboardCache, ReplayCache
+from .database import PostgresDB, submitBatchSize
+from .ranking import Rankings
+from .ratelimit import RateLimiter
+from .session import SessionStore
+from .submissions import SubmissionQueue
+
+logger = logging.getLogger(__name__)
 
-config_key = web.AppKey("config", dict[str, str | None])
+config_key = web.AppKey("config", dict[str, Any])
 postgres_key = web.AppKey("postgres", PostgresDB)
 redis_key = web.AppKey("redis", aioredis.Redis)
+leaderboard_key = web.AppKey("leaderboard", LeaderboardCache)
+replays_key = web.AppKey("replays", ReplayCache)
+limiter_key = web.AppKey("limiter", RateLimiter)
+rankings_key = web.AppKey("rankings", Rankings)
+sessions_key = web.AppKey("sessions", SessionStore)
+submissions_key = web.AppKey("submissions", SubmissionQueue)
 
-def parse_config(argv: list[str]) -> dict[str, str | None]:
+def parse_config(argv: list[str]) -> dict[str, Any]:
     parser = argparse.ArgumentParser(
         prog='Score API Server', 
         description="Server for Score Storage and Leaderboard. ", 
         epilog=r'Github: https://github.com/zznyjidi/score-server'
     )
+    parser.add_argument('--host', help='Address to listen on', default=None)
+    parser.add_argument('--port', help='Port to listen on', type=int, default=None)
+    parser.add_argument('--workers', help='Number of server processes sharing the port', type=int, default=None)
+    parser.add_argument('--hasher-workers', help='Password hashing processes for the whole host', type=int, default=None)
+    parser.add_argument('--hasher-queue', help='Password hashing calls allowed to wait for a process, for the whole host', type=int, default=None)
+    parser.add_argument('--hasher-max-wait', help='Seconds of expected hashing queue wait before refusing logins', type=float, default=None)
+    parser.add_argument('--json-codec', help='JSON library, orjson or json', choices=['orjson', 'json'], default=None)
     parser.add_argument('--postgres', help='Connection URL for PostgreSQL', default=None)
+    parser.add_argument('--postgres-replica', help='Connection URL of a PostgreSQL read replica, repeat for more', action='append', default=None)
+    parser.add_argument('--replica-max-lag', help='Seconds a replica may lag behind before reads skip it', type=float, default=None)
+    parser.add_argument('--statement-timeout', help='Seconds Postgres runs a statement before cancelling it, 0 for no limit', type=float, default=None)
+    parser.add_argument('--read-your-writes', help='Seconds after a submission the reads of that player skip replicas, 0 to disable', type=int, default=None)
     parser.add_argument('--redis', help='Connection URL for Redis', default=None)
+    parser.add_argument('--pool-min', help='Minimum PostgreSQL connections kept open by each worker', type=int, default=None)
+    parser.add_argument('--pool-max', help='Maximum PostgreSQL connections of each worker', type=int, default=None)
+    parser.add_argument('--user-cache-size', help='User records cached by each worker', type=int, default=None)
+    parser.add_argument('--user-cache-ttl', help='Seconds a cached user record is kept', type=float, default=None)
+    parser.add_argument('--replay-max-size', help='Largest replay in bytes accepted by the streaming upload, after decompression', type=int, default=None)
+    parser.add_argument('--write-behind', help='Acknowledge submissions once queued in Redis, stored in batches by a background consumer', action='store_true', default=None)
+    parser.add_argument('--write-behind-max-depth', help='Queued submissions refused beyond, across every server', type=int, default=None)
+    parser.add_argument('--write-behind-batch', help='Queued submissions stored per insert', type=int, default=None)
+    parser.add_argument('--leaderboard-ttl', help='Seconds a cached leaderboard is kept', type=int, default=None)
+    parser.add_argument('--replay-cache-size', help='Bytes of replays cached by each worker', type=int, default=None)
+    parser.add_argument('--replay-cache-ttl', help='Seconds a replay is kept in the Redis cache', type=int, default=None)
+    parser.add_argument('--session-secret', help='Key signing session tokens, shared by every server', default=None)
+    parser.add_argument('--session-ttl', help='Seconds a login session stays valid', type=int, default=None)
+    parser.add_argument('--rate-limit-scale', help='Multiplies the request rate allowed per client on every route, 0 to disable', type=float, default=None)
+    parser.add_argument('--max-inflight', help='Requests handled at once by each worker before answering 503, 0 for no limit', type=int, default=None)
+    parser.add_argument('--metrics-dir', help='Directory the workers share their metrics through, a temporary one by default', default=None)
     arg_config, _ = parser.parse_known_args(argv)
 
-    config: dict[str, str | None] = {
+    config: dict[str, Any] = {
+        'host': arg_config.host,
+        'port': arg_config.port,
+        'workers': arg_config.workers,
+        'hasher_workers': arg_config.hasher_workers,
+        'hasher_queue': arg_config.hasher_queue,
+        'hasher_max_wait': arg_config.hasher_max_wait,
+        'json_codec': arg_config.json_codec,
         'postgres': arg_config.postgres, 
-        'redis': arg_config.redis
+        'postgres_replicas': arg_config.postgres_replica,
+        'replica_max_lag': arg_config.replica_max_lag,
+        'statement_timeout': arg_config.statement_timeout,
+        'read_your_writes': arg_config.read_your_writes,
+        'redis': arg_config.redis,
+        'pool_min': arg_config.pool_min,
+        'pool_max': arg_config.pool_max,
+        'user_cache_size': arg_config.user_cache_size,
+        'user_cache_ttl': arg_config.user_cache_ttl,
+        'replay_max_size': arg_config.replay_max_size,
+        'write_behind': arg_config.write_behind,
+        'write_behind_max_depth': arg_config.write_behind_max_depth,
+        'write_behind_batch': arg_config.write_behind_batch,
+        'leaderboard_ttl': arg_config.leaderboard_ttl,
+        'replay_cache_size': arg_config.replay_cache_size,
+        'replay_cache_ttl': arg_config.replay_cache_ttl,
+        'session_secret': arg_config.session_secret,
+        'session_ttl': arg_config.session_ttl,
+        'rate_limit_scale': arg_config.rate_limit_scale,
+        'max_inflight': arg_config.max_inflight,
+        'metrics_dir': arg_config.metrics_dir
     }
 
+    if config['host'] is None:
+        config['host'] = os.getenv('SCORE_HOST') or '0.0.0.0'
+    if config['port'] is None:
+        config['port'] = int(os.getenv('SCORE_PORT') or 8080)
+    if config['workers'] is None:
+        config['workers'] = int(os.getenv('SCORE_WORKERS') or 1)
+    if config['hasher_workers'] is None:
+        config['hasher_workers'] = int(os.getenv('SCORE_HASHER_WORKERS') or os.cpu_count() or 1)
+    if config['hasher_queue'] is None:
+        config['hasher_queue'] = int(os.getenv('SCORE_HASHER_QUEUE') or 64)
+    if config['hasher_max_wait'] is None:
+        config['hasher_max_wait'] = float(os.getenv('SCORE_HASHER_MAX_WAIT') or 2.0)
+    if config['json_codec'] is None:
+        config['json_codec'] = os.getenv('SCORE_JSON_CODEC')
+    if config['postgres_replicas'] is None:
+        config['postgres_replicas'] = [dsn.strip() for dsn in os.getenv('POSTGRES_REPLICAS', '').split(',') if dsn.strip()]
+    if config['replica_max_lag'] is None:
+        config['replica_max_lag'] = float(os.getenv('POSTGRES_REPLICA_MAX_LAG') or 5.0)
+    if config['statement_timeout'] is None:
+        config['statement_timeout'] = float(os.getenv('POSTGRES_STATEMENT_TIMEOUT') or 30.0)
+    if config['read_your_writes'] is None:
+        config['read_your_writes'] = int(os.getenv('SCORE_READ_YOUR_WRITES') or 10)
     if config['redis'] is None:
         config['redis'] = os.getenv('REDIS_URL')
+    if config['pool_min'] is None:
+        config['pool_min'] = int(os.getenv('POSTGRES_POOL_MIN') or 2)
+    if config['pool_max'] is None:
+        config['pool_max'] = int(os.getenv('POSTGRES_POOL_MAX') or 10)
+    if config['user_cache_size'] is None:
+        config['user_cache_size'] = int(os.getenv('SCORE_USER_CACHE_SIZE') or 10000)
+    if config['user_cache_ttl'] is None:
+        config['user_cache_ttl'] = float(os.getenv('SCORE_USER_CACHE_TTL') or 60.0)
+    if config['replay_max_size'] is None:
+        config['replay_max_size'] = int(os.getenv('SCORE_REPLAY_MAX_SIZE') or 8 * 1024 * 1024)
+    if config['write_behind'] is None:
+        config['write_behind'] = os.getenv('SCORE_WRITE_BEHIND', '').lower() in ('1', 'true', 'yes')
+    if config['write_behind_max_depth'] is None:
+        config['write_behind_max_depth'] = int(os.getenv('SCORE_WRITE_BEHIND_MAX_DEPTH') or 50000)
+    if config['write_behind_batch'] is None:
+        config['write_behind_batch'] = int(os.getenv('SCORE_WRITE_BEHIND_BATCH') or submitBatchSize)
+    if config['leaderboard_ttl'] is None:
+        config['leaderboard_ttl'] = int(os.getenv('SCORE_LEADERBOARD_TTL') or 60)
+    if config['replay_cache_size'] is None:
+        config['replay_cache_size'] = int(os.getenv('SCORE_REPLAY_CACHE_SIZE') or 64 * 1024 * 1024)
+    if config['replay_cache_ttl'] is None:
+        config['replay_cache_ttl'] = int(os.getenv('SCORE_REPLAY_CACHE_TTL') or 3600)
+    if config['session_secret'] is None:
+        config['session_secret'] = os.getenv('SCORE_SESSION_SECRET')
+    if not config['session_secret']:
+        # Generated before the workers start so they all accept each other's tokens
+        logger.warning("No session secret set, sessions will not survive a restart")
+        config['session_secret'] = secrets.token_urlsafe(32)
+    if config['session_ttl'] is None:
+        config['session_ttl'] = int(os.getenv('SCORE_SESSION_TTL') or 7 * 24 * 3600)
+    if config['rate_limit_scale'] is None:
+        config['rate_limit_scale'] = float(os.getenv('SCORE_RATE_LIMIT_SCALE') or 1.0)
+    if config['max_inflight'] is None:
+        config['max_inflight'] = int(os.getenv('SCORE_MAX_INFLIGHT') or 512)
+    if config['metrics_dir'] is None:
+        config['metrics_dir'] = os.getenv('SCORE_METRICS_DIR')
 
     return config
 
 async def init_database(app: web.Application):
-    app[postgres_key] = await PostgresDB(dsn=app[config_key].get('postgres'))
+    config = app[config_key]
+    app[postgres_key] = await PostgresDB(
+        dsn=config.get('postgres'), 
+        min_size=config['pool_min'], 
+        max_size=config['pool_max'], 
+        user_cache_size=config['user_cache_size'], 
+        user_cache_ttl=config['user_cache_ttl'],
+        replicas=config['postgres_replicas'],
+        replica_max_lag=config['replica_max_lag'],
+        statement_timeout=config['statement_timeout']
+    )
+    monitor = asyncio.create_task(app[postgres_key].monitorReplicas()) if config['postgres_replicas'] else None
+    evictor = asyncio.create_task(app[postgres_key].evictIdleGames())
     yield
+    for task in (monitor, evictor):
+        if task is not None:
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
     await app[postgres_key].close()
 
 async def init_cache(app: web.Application):
     app[redis_key] = await aioredis.from_url(app[config_key].get('redis'))
+    app[leaderboard_key] = LeaderboardCache(app[redis_key], app[config_key]['leaderboard_ttl'])
+    app[replays_key] = ReplayCache(app[redis_key], app[config_key]['replay_cache_size'], app[config_key]['replay_cache_ttl'])
+    app[limiter_key] = RateLimiter(app[redis_key], app[config_key]['rate_limit_scale'], app[config_key]['max_inflight'])
+    app[rankings_key] = Rankings(app[redis_key])
+    app[sessions_key] = SessionStore(
+        app[redis_key], 
+        app[config_key]['session_secret'].encode(), 
+        app[config_key]['session_ttl'],
+        # Remembering writers only matters with replicas
+        write_window=app[config_key]['read_your_writes'] if app[config_key]['postgres_replicas'] else 0
+    )
+    app[postgres_key].sessions = app[sessions_key]
+    # Share user record invalidations with the other workers
+    listener = asyncio.create_task(app[postgres_key].users.listen(app[redis_key]))
     yield
+    listener.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await listener
     await app[redis_key].aclose()
+
+async def init_submissions(app: web.Application):
+    config = app[config_key]
+    if not config['write_behind']:
+        yield
+        return
+    app[submissions_key] = SubmissionQueue(app[redis_key], config['write_behind_max_depth'], config['write_behind_batch'])
+    consumer = asyncio.create_task(app[submissions_key].consume(
+        app[postgres_key], app[leaderboard_key], app[rankings_key], app[sessions_key]
+    ))
+    yield
+    consumer.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await consumer
+
+async def init_hasher(app: web.Application):
+    # The hashing budget is for the whole host, split between the workers
+    config = app[config_key]
+    aioargon2.configure(
+        max(1, config['hasher_workers'] // config['workers']), 
+        max(1, config['hasher_queue'] // config['workers']), 
+        config['hasher_max_wait']
+    )
+    yield
+    aioargon2.shutdown()
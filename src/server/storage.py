@@ -0,0 +1,169 @@
+import struct
+from typing import Any, Optional
+
+import asyncpg
+
+try:
+    from compression import zstd
+except ImportError:
+    # Python before 3.14
+    from backports import zstd
+
+from . import codec
+
+# Event payload: format version, dictionary uid (0 for none) and length of the encoded events, then one zstd frame
+payloadHeader = struct.Struct('>BII')
+payloadVersion = 1
+compressionLevel = 3
+dictionarySize = 64 * 1024
+# Replays needed before training a dictionary is worth it
+dictionaryMinSamples = 100
+dictionaryMaxSamples = 5000
+
+
+class UnknownDictionaryError(Exception):
+    """Raised when a payload was compressed with a dictionary this process hasn't loaded
+    """
+
+    def __init__(self, uid: int):
+        super().__init__(f"Unknown replay dictionary {uid}")
+        self.uid = uid
+
+
+async def ensureTable(conn: asyncpg.Connection):
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS replay_dictionaries (
+            uid SERIAL NOT NULL PRIMARY KEY,
+            game text NOT NULL,
+            dictionary bytea NOT NULL,
+            created_at timestamptz NOT NULL DEFAULT now()
+        )
+    ''')
+
+
+class ReplayStorage:
+    """### Compression of replay event lists, with the zstd dictionaries of every game
+
+    New replays use the latest dictionary of their game known to this process,
+    payloads of any older or newer dictionary can be read once it is loaded.
+    """
+
+    def __init__(self):
+        self.dictionaries: dict[int, zstd.ZstdDict] = {}
+        self.current: dict[str, int] = {}
+        self.compressors: dict[int, zstd.ZstdCompressor] = {}
+
+    def addDictionary(self, uid: int, game: str, dictionary: bytes):
+        self.dictionaries[uid] = zstd.ZstdDict(dictionary)
+        if uid > self.current.get(game, 0):
+            self.current[game] = uid
+
+    async def load(self, conn: asyncpg.Connection, uids: Optional[list[int]] = None):
+        """### Load dictionaries from the database
+
+        Args:
+            conn (asyncpg.Connection): database connection
+            uids (Optional[list[int]], optional): dictionaries to load. Defaults to all of them.
+        """
+        if uids is None:
+            rows = await conn.fetch('SELECT uid, game, dictionary FROM replay_dictionaries')
+        else:
+            rows = await conn.fetch('SELECT uid, game, dictionary FROM replay_dictionaries WHERE uid = ANY($1)', uids)
+        for row in rows:
+            self.addDictionary(row['uid'], row['game'], row['dictionary'])
+
+    def compressor(self, uid: int) -> zstd.ZstdCompressor:
+        if (compressor := self.compressors.get(uid)) is None:
+            dictionary = self.dictionaries.get(uid)
+            compressor = zstd.ZstdCompressor(
+                level=compressionLevel, zstd_dict=dictionary.as_digested_dict if dictionary is not None else None
+            )
+            self.compressors[uid] = compressor
+        return compressor
+
+    def decompressor(self, uid: int) -> zstd.ZstdDecompressor:
+        # A decompressor reads a single frame, only the digested dictionary is kept
+        if uid and uid not in self.dictionaries:
+            raise UnknownDictionaryError(uid)
+        dictionary = self.dictionaries.get(uid)
+        return zstd.ZstdDecompressor(zstd_dict=dictionary.as_digested_dict if dictionary is not None else None)
+
+    def encodeEvents(self, game: str, events: bytes) -> bytes:
+        """### Compress an encoded event list
+
+        Args:
+            game (str): game of the replay
+            events (bytes): event list as json
+
+        Returns:
+            bytes: event payload
+        """
+        uid = self.current.get(game, 0)
+        return payloadHeader.pack(payloadVersion, uid, len(events)) + self.compressor(uid).compress(events, zstd.ZstdCompressor.FLUSH_FRAME)
+
+    def decodeEvents(self, payload: bytes) -> bytes:
+        """### Decompress an event payload back to the event list json
+
+        Raises:
+            UnknownDictionaryError: when the dictionary of the payload isn't loaded
+
+        Returns:
+            bytes: event list as json
+        """
+        version, uid, length = payloadHeader.unpack_from(payload)
+        if version != payloadVersion:
+            raise ValueError(f"Unknown replay payload version {version}")
+        return self.decompressor(uid).decompress(payload[payloadHeader.size:], max_length=length)
+
+    def missingDictionaries(self, payloads: list[bytes]) -> list[int]:
+        uids = {payloadHeader.unpack_from(payload)[1] for payload in payloads}
+        return [uid for uid in uids if uid and uid not in self.dictionaries]
+
+    @staticmethod
+    def train(samples: list[bytes]) -> Optional[bytes]:
+        """### Train a dictionary on encoded event lists
+
+        Returns:
+            Optional[bytes]: dictionary, None with too few samples
+        """
+        if len(samples) < dictionaryMinSamples:
+            return None
+        return zstd.train_dict(samples, dictionarySize).dict_content
+
+
+class StoredReplay:
+    """### Replay read from a game table, the event list is decompressed on first use
+    """
+
+    def __init__(self, header: str, payload: bytes, storage: ReplayStorage):
+        self.headerText = header
+        self.payload = payload
+        self.storage = storage
+        self.decodedHeader: Optional[dict[str, Any]] = None
+        self.encodedEvents: Optional[bytes] = None
+
+    @property
+    def header(self) -> dict[str, Any]:
+        """player, info and the other blocks besides the event list
+        """
+        if self.decodedHeader is None:
+            self.decodedHeader = codec.loads(self.headerText)
+        return self.decodedHeader
+
+    def eventsEncoded(self) -> bytes:
+        if self.encodedEvents is None:
+            self.encodedEvents = self.storage.decodeEvents(self.payload)
+        return self.encodedEvents
+
+    def events(self) -> list[Any]:
+        return codec.loads(self.eventsEncoded())
+
+    def to_json(self) -> dict[str, Any]:
+        return self.header | {"replay": self.events()}
+
+    def fragment(self) -> codec.Fragment:
+        """Whole replay as json, without decoding the event list
+        """
+        header = self.headerText.rstrip()[:-1].rstrip()
+        separator = '' if header == '{' else ','
+        return codec.Fragment(f'{header}{separator}"replay":'.encode() + self.eventsEncoded() + b'}')
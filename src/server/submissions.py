@@ -0,0 +1,264 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+from typing import Any, Optional
+
+import redis.asyncio as aioredis
+from redis.exceptions import ConnectionError, ResponseError
+
+from . import codec, replay
+from .cache import LeaderboardCache
+from .database import PostgresDB, submitBatchSize
+from .ranking import Rankings
+from .replay import JSON
+from .session import SessionStore
+
+logger = logging.getLogger(__name__)
+
+# Refuses a digest already queued and a full stream, otherwise queues the submission and claims its digest
+# KEYS: stream, digest claim; ARGV: max depth, claim ttl, then the fields of the entry
+ENQUEUE_SCRIPT = """
+local claimed = redis.call('GET', KEYS[2])
+if claimed then
+    return {'duplicate', claimed}
+end
+if redis.call('XLEN', KEYS[1]) >= tonumber(ARGV[1]) then
+    return {'full', ''}
+end
+local id = redis.call('XADD', KEYS[1], '*', unpack(ARGV, 3))
+redis.call('SET', KEYS[2], id, 'EX', ARGV[2])
+return {'queued', id}
+"""
+
+
+async def recordSubmitted(leaderboard: LeaderboardCache, rankings: Rankings, sessions: SessionStore, game: str, columns: dict[str, int], replay_uid: int):
+    """Update the caches after a replay is stored
+    """
+    await leaderboard.submitted(game, columns['level_id'], columns['time'])
+    await rankings.record(game, columns['level_id'], columns['player_uid'], columns['time'], replay_uid)
+    await sessions.wrote(columns['player_uid'])
+
+def splitReplay(replayJson: JSON) -> Optional[tuple[dict[str, JSON], bytes, bytes, dict[str, int]]]:
+    """Header, event list as json, digest and typed columns of a decoded replay, None when it isn't valid
+    """
+    if not replay.validateReplayJson(replayJson) or (columns := replay.replayColumns(replayJson)) is None:
+        return None
+    header = {key: value for key, value in replayJson.items() if key != 'replay'}
+    return header, codec.dumps(replayJson['replay']), replay.replayDigest(replayJson), columns
+
+
+class SubmissionQueue:
+    """### Write-behind queue of score submissions on a Redis stream
+
+    Submissions are acknowledged with the id of their stream entry, the consumer of every worker stores them in batches.
+    Entries are deleted once their batch committed, entries of a consumer that died are claimed by another after claim_idle seconds.
+    """
+    stream = 'submissions'
+    group = 'writers'
+
+    def __init__(self, redis: aioredis.Redis, max_depth: int, batch: int = submitBatchSize, result_ttl: int = 3600, claim_idle: float = 30.0):
+        self.redis = redis
+        self.maxDepth = max_depth
+        self.batch = batch
+        # Seconds results and digest claims are kept, a replay resubmitted later is found by the insert instead
+        self.resultTtl = result_ttl
+        self.claimIdle = claim_idle
+        self.consumer = f'{socket.gethostname()}-{os.getpid()}'
+        self.enqueueScript = redis.register_script(ENQUEUE_SCRIPT)
+        self.queued: int = 0
+        self.refused: int = 0
+        self.stored: int = 0
+        self.duplicates: int = 0
+        self.failed: int = 0
+
+    @staticmethod
+    def digestKey(game: str, digest: bytes) -> str:
+        return f'submission-digest:{game}:{digest.hex()}'
+
+    @staticmethod
+    def resultKey(provisional_id: str) -> str:
+        return f'submission:{provisional_id}'
+
+    async def enqueue(self, game: str, userUID: int, header: JSON, events: bytes, digest: bytes, columns: dict[str, int]) -> tuple[str, str]:
+        """### Queue a validated replay
+
+        Returns:
+            tuple[str, str]: 'queued', 'duplicate' or 'full', with the provisional id of the queued or earlier submission
+        """
+        state, provisional_id = await self.enqueueScript(
+            keys=[self.stream, self.digestKey(game, digest)],
+            args=[
+                self.maxDepth, self.resultTtl,
+                'game', game, 'user', userUID, 'header', codec.dumps(header), 'events', events,
+                'digest', digest, 'columns', codec.dumps(columns)
+            ]
+        )
+        state = state.decode()
+        if state == 'full':
+            self.refused += 1
+        elif state == 'queued':
+            self.queued += 1
+        return state, provisional_id.decode()
+
+    async def result(self, provisional_id: str, game: str, userUID: int) -> Optional[dict[str, JSON]]:
+        """### Outcome of a queued submission
+
+        Args:
+            provisional_id (str): id given when the submission was queued
+            game (str): game the submission must be for
+            userUID (int): user who must have submitted it
+
+        Returns:
+            Optional[dict[str, JSON]]: state 'queued', 'stored', 'duplicate' or 'failed', with the replay uid once known.
+                None for an unknown or expired id, or a submission of another user or game
+        """
+        if stored := await self.redis.hgetall(self.resultKey(provisional_id)):
+            if stored.get(b'game') != game.encode() or stored.get(b'user') != str(userUID).encode():
+                return None
+            result: dict[str, JSON] = {"state": stored[b'state'].decode(), "message": stored[b'message'].decode()}
+            if b'replay_uid' in stored:
+                result["replay_uid"] = int(stored[b'replay_uid'])
+            return result
+        try:
+            entries = await self.redis.xrange(self.stream, provisional_id, provisional_id, count=1)
+        except ResponseError:
+            # Not a stream id
+            return None
+        for _, fields in entries:
+            if fields.get(b'game') == game.encode() and fields.get(b'user') == str(userUID).encode():
+                return {"state": "queued", "message": "Score Queued. "}
+        return None
+
+    async def metrics(self) -> dict[str, JSON]:
+        """### Queue depth of every worker together, and the counters of this one
+        """
+        depth = await self.redis.xlen(self.stream)
+        try:
+            pending = (await self.redis.xpending(self.stream, self.group))['pending']
+        except ResponseError:
+            # No consumer created the group yet
+            pending = 0
+        return {
+            "depth": depth,
+            "in_progress": pending,
+            "max_depth": self.maxDepth,
+            "queued": self.queued,
+            "refused": self.refused,
+            "stored": self.stored,
+            "duplicates": self.duplicates,
+            "failed": self.failed
+        }
+
+    async def consume(self, database: PostgresDB, leaderboard: LeaderboardCache, rankings: Rankings, sessions: SessionStore):
+        """### Store queued submissions in batches, runs until cancelled
+
+        Entries of a batch that failed stay pending on this consumer and are retried first.
+        """
+        retry = True
+        lastClaim = 0.0
+        while True:
+            try:
+                await self.redis.xgroup_create(self.stream, self.group, '0', mkstream=True)
+            except ResponseError:
+                # Created by another worker already
+                pass
+            except ConnectionError:
+                await asyncio.sleep(1)
+                continue
+            try:
+                while True:
+                    entries: list[tuple[bytes, dict[bytes, bytes]]] = []
+                    if retry:
+                        # Own entries not stored yet
+                        streams = await self.redis.xreadgroup(self.group, self.consumer, {self.stream: '0'}, count=self.batch)
+                        entries = streams[0][1] if streams else []
+                        retry = bool(entries)
+                    if not entries and time.monotonic() - lastClaim > self.claimIdle:
+                        lastClaim = time.monotonic()
+                        _, entries, _ = await self.redis.xautoclaim(
+                            self.stream, self.group, self.consumer, int(self.claimIdle * 1000), '0-0', count=self.batch
+                        )
+                        retry = bool(entries)
+                    if not entries:
+                        streams = await self.redis.xreadgroup(self.group, self.consumer, {self.stream: '>'}, count=self.batch, block=1000)
+                        entries = streams[0][1] if streams else []
+                    if entries:
+                        await self.store(entries, database, leaderboard, rankings, sessions)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Storing queued submissions failed, retrying")
+                retry = True
+                await asyncio.sleep(1)
+
+    async def store(
+        self, entries: list[tuple[bytes, dict[bytes, bytes]]],
+        database: PostgresDB, leaderboard: LeaderboardCache, rankings: Rankings, sessions: SessionStore
+    ):
+        """### Store a batch of stream entries, one insert per game
+
+        Redelivered entries whose result was already stored are not inserted again, which would report them as duplicates.
+        """
+        games: dict[str, list[tuple[str, dict[bytes, bytes]]]] = {}
+        for entry_id, fields in entries:
+            if not fields:
+                # Deleted after storing, only the acknowledgement was lost
+                continue
+            games.setdefault(fields[b'game'].decode(), []).append((entry_id.decode(), fields))
+
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for queued in games.values():
+                for entry_id, _ in queued:
+                    pipe.hmget(self.resultKey(entry_id), 'state', 'replay_uid')
+            earlier = iter(await pipe.execute())
+
+        for game, received in games.items():
+            queued = []
+            for entry_id, fields in received:
+                state, replay_uid = next(earlier)
+                if state == b'stored':
+                    # Stored before the acknowledgement was lost, the caches may have missed it
+                    await recordSubmitted(leaderboard, rankings, sessions, game, codec.loads(fields[b'columns']), int(replay_uid))
+                else:
+                    queued.append((entry_id, fields))
+            if not queued:
+                continue
+            scores = [(
+                int(fields[b'user']),
+                codec.loads(fields[b'header']),
+                fields[b'events'],
+                fields[b'digest'],
+                codec.loads(fields[b'columns'])
+            ) for _, fields in queued]
+            status = await database.storeScores(game, scores)
+            results: list[dict[str, Any]] = status['results'] if status["status"] == 200 else [status] * len(queued)
+
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for (entry_id, fields), result in zip(queued, results):
+                    if result["status"] == 200:
+                        state = 'stored'
+                        self.stored += 1
+                    elif 'replay_uid' in result:
+                        state = 'duplicate'
+                        self.duplicates += 1
+                    else:
+                        state = 'failed'
+                        self.failed += 1
+                    # Only the submitting user reads the result, through the route of its game
+                    mapping = {"state": state, "message": result["message"], "game": game, "user": fields[b'user']}
+                    if 'replay_uid' in result:
+                        mapping["replay_uid"] = result['replay_uid']
+                    pipe.hset(self.resultKey(entry_id), mapping=mapping)
+                    pipe.expire(self.resultKey(entry_id), self.resultTtl)
+                await pipe.execute()
+            for score, result in zip(scores, results):
+                if result["status"] == 200:
+                    await recordSubmitted(leaderboard, rankings, sessions, game, score[4], result['replay_uid'])
+
+        ids = [entry_id for entry_id, _ in entries]
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.xack(self.stream, self.group, *ids)
+            pipe.xdel(self.stream, *ids)
+            await pipe.execute()
@@ -0,0 +1,90 @@
+import logging
+import multiprocessing
+import multiprocessing.connection
+import signal
+import time
+from typing import Any, Callable
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+AppFactory = Callable[[dict[str, Any]], web.Application]
+
+# Workers exiting sooner than this after starting are restarted with a growing delay
+crashWindow = 10.0
+maxRestartDelay = 30.0
+# Time given to workers to finish their requests and close their pools on shutdown
+shutdownTimeout = 75.0
+
+
+def serve(factory: AppFactory, config: dict[str, Any]):
+    """Worker process, every worker binds the same port with SO_REUSEPORT
+    """
+    web.run_app(
+        factory(config),
+        host=config['host'],
+        port=config['port'],
+        reuse_port=True,
+        handler_cancellation=True,
+        print=None
+    )
+
+def run(factory: AppFactory, config: dict[str, Any]):
+    """Run config['workers'] server processes, restart the ones that crash and stop them on SIGTERM / SIGINT
+
+    Args:
+        factory (AppFactory): builds the aiohttp application inside each worker
+        config (dict[str, Any]): server config
+    """
+    context = multiprocessing.get_context('spawn')
+    workers: dict[int, multiprocessing.Process] = {}
+    started: dict[int, float] = {}
+    crashes: dict[int, int] = {}
+    restartAt: dict[int, float] = {}
+    stopping = False
+
+    def stop(signum: int, frame: Any):
+        nonlocal stopping
+        stopping = True
+
+    def start(index: int):
+        if index in workers:
+            workers[index].close()
+        workers[index] = context.Process(target=serve, args=(factory, config), name=f'score-worker-{index}')
+        workers[index].start()
+        started[index] = time.monotonic()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for index in range(config['workers']):
+        start(index)
+    logger.info("Running %d workers on http://%s:%d", config['workers'], config['host'], config['port'])
+
+    while not stopping:
+        multiprocessing.connection.wait([worker.sentinel for worker in workers.values() if worker.is_alive()], timeout=1.0)
+        now = time.monotonic()
+        for index, worker in workers.items():
+            if stopping or worker.is_alive():
+                continue
+            if index not in restartAt:
+                crashes[index] = crashes.get(index, 0) + 1 if now - started[index] < crashWindow else 0
+                delay = min(2 ** crashes[index] - 1, maxRestartDelay)
+                logger.warning("Worker %d exited with code %s, restarting in %.0fs", index, worker.exitcode, delay)
+                restartAt[index] = now + delay
+            if now >= restartAt[index]:
+                del restartAt[index]
+                start(index)
+
+    logger.info("Stopping workers")
+    for worker in workers.values():
+        if worker.is_alive():
+            worker.terminate()
+    deadline = time.monotonic() + shutdownTimeout
+    for index, worker in workers.items():
+        worker.join(max(0.0, deadline - time.monotonic()))
+        if worker.is_alive():
+            logger.warning("Worker %d did not stop in time, killing it", index)
+            worker.kill()
+            worker.join()
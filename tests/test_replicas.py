@@ -0,0 +1,159 @@
+import asyncio
+import contextlib
+
+import asyncpg
+import pytest
+
+from server import deadlines
+from server.database import GameRegistry, PostgresDB, Replica
+from server.session import SessionStore
+
+statement = 'fetchLeaderboardPage'
+
+
+class StubConnection:
+    def __init__(self, target: str, error: BaseException = None, lag: float = 0.0):
+        self.target = target
+        self.error = error
+        self.lag = lag
+
+    async def fetch(self, query: str, *args, timeout=None):
+        if self.error is not None:
+            raise self.error
+        return [{"target": self.target, "query": query, "args": args}]
+
+    async def fetchval(self, query: str, *args, timeout=None):
+        if self.error is not None:
+            raise self.error
+        return self.lag
+
+
+class StubPool:
+    def __init__(self, target: str, error: BaseException = None, lag: float = 0.0):
+        self.connection = StubConnection(target, error, lag)
+        self.acquired = 0
+
+    @contextlib.asynccontextmanager
+    async def acquire(self, timeout=None):
+        self.acquired += 1
+        yield self.connection
+
+
+class StubRedis:
+    def __init__(self):
+        self.keys: dict[str, object] = {}
+
+    def register_script(self, script: str):
+        return None
+
+    async def set(self, key: str, value, ex=None):
+        self.keys[key] = value
+
+    async def exists(self, key: str) -> int:
+        return int(key in self.keys)
+
+
+def database(*replicas: StubPool, max_lag: float = 5.0) -> PostgresDB:
+    # The constructor connects, the routing only needs the pools
+    db = object.__new__(PostgresDB)
+    db.queries = {statement: 'SELECT 1'}
+    db.games = GameRegistry(lambda name: {})
+    db.sessions = None
+    db.replicaMaxLag = max_lag
+    db.replicas = [Replica(pool, index) for index, pool in enumerate(replicas)]
+    db.nextReplica = 0
+    db.acquireCount = 0
+    db.acquireWaitTotal = 0.0
+    db.acquireWaitMax = 0.0
+    db.connectionsInUse = 0
+    db.pool = StubPool('primary')
+    return db
+
+def target(rows) -> str:
+    return rows[0]["target"]
+
+
+def test_reads_from_healthy_replica():
+    db = database(StubPool('replica'))
+    asyncio.run(db.checkReplicas())
+    assert target(asyncio.run(db.fetchReadOnly(statement))) == 'replica'
+    assert db.replicas[0].reads == 1
+    assert db.pool.acquired == 0
+
+def test_lagging_replica_falls_back_to_primary():
+    db = database(StubPool('replica', lag=30.0), max_lag=5.0)
+    asyncio.run(db.checkReplicas())
+    assert not db.replicas[0].healthy
+    assert db.replicas[0].lag == 30.0
+    assert target(asyncio.run(db.fetchReadOnly(statement))) == 'primary'
+    assert db.replicas[0].pool.acquired == 1
+
+def test_unreachable_replica_falls_back_to_primary():
+    db = database(StubPool('replica', error=ConnectionRefusedError()))
+    asyncio.run(db.checkReplicas())
+    assert not db.replicas[0].healthy
+    assert db.replicas[0].lag is None
+    assert target(asyncio.run(db.fetchReadOnly(statement))) == 'primary'
+
+def test_failing_replica_is_marked_unhealthy():
+    replica = StubPool('replica')
+    db = database(replica)
+    asyncio.run(db.checkReplicas())
+    replica.connection.error = asyncpg.exceptions.CannotConnectNowError()
+    assert target(asyncio.run(db.fetchReadOnly(statement))) == 'primary'
+    assert not db.replicas[0].healthy
+    assert db.replicas[0].failures == 1
+    # Later reads skip it until the next check
+    assert target(asyncio.run(db.fetchReadOnly(statement))) == 'primary'
+    assert replica.acquired == 2
+
+def test_round_robin_skips_unhealthy_replicas():
+    db = database(StubPool('first'), StubPool('second', lag=30.0), StubPool('third'))
+    asyncio.run(db.checkReplicas())
+    assert [target(asyncio.run(db.fetchReadOnly(statement))) for _ in range(4)] == ['first', 'third', 'first', 'third']
+
+def test_expired_deadline_is_not_blamed_on_the_replica():
+    db = database(StubPool('replica', error=asyncio.TimeoutError()))
+    db.replicas[0].healthy = True
+
+    async def read():
+        with deadlines.within(0.01):
+            await asyncio.sleep(0.02)
+            return await db.fetchReadOnly(statement)
+
+    with pytest.raises(deadlines.DeadlineExceeded):
+        asyncio.run(read())
+    assert db.replicas[0].healthy
+
+def test_primary_reads_skip_replicas():
+    db = database(StubPool('replica'))
+    asyncio.run(db.checkReplicas())
+    assert target(asyncio.run(db.fetchReadOnly(statement, primary=True))) == 'primary'
+    assert db.replicas[0].pool.acquired == 1
+
+def test_recent_writers_read_from_primary():
+    db = database(StubPool('replica'))
+    sessions = SessionStore(StubRedis(), b'secret', ttl=60, write_window=10)
+
+    async def read(uid: int) -> str:
+        return target(await db.fetchReadOnly(statement, primary=await sessions.wroteRecently(uid)))
+
+    async def run():
+        await db.checkReplicas()
+        assert await read(1) == 'replica'
+        await sessions.wrote(1)
+        assert await read(1) == 'primary'
+        assert await read(2) == 'replica'
+
+    asyncio.run(run())
+
+def test_no_write_window_reads_from_replica():
+    db = database(StubPool('replica'))
+    sessions = SessionStore(StubRedis(), b'secret', ttl=60)
+
+    async def run():
+        await db.checkReplicas()
+        await sessions.wrote(1)
+        return target(await db.fetchReadOnly(statement, primary=await sessions.wroteRecently(1)))
+
+    assert asyncio.run(run()) == 'replica'